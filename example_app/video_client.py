@@ -8,15 +8,17 @@ import socket
 import sys
 import os
 import json
+import struct
 import signal
+import threading
 import sys
 import RPi.GPIO as GPIO
 
 # Customize the below variables 
 manager_ip = "172.0.0.2"
 request_port = 60001
-shutdown_port = 60002
 image = "cdesiniotis/face_rec_server"
+lease_ttl = 30
 #-----------------------------
 
 
@@ -40,30 +42,115 @@ def create_connection(ip, port):
     #print("\n[INFO] Successfully connected to the request server\n", file=sys.stderr)
     return s
 
-def shutdown_application(manager_ip, shutdown_port, request):
-    print("\n[INFO] Connecting to the shutdown server...\n")
-    s = create_connection(manager_ip, shutdown_port)
-
+# Messages to and from the manager are length-prefixed JSON frames
+def send_message(s, message):
+    body = json.dumps(message).encode()
+    s.sendall(struct.pack("!I", len(body)) + body)
+
+def recv_exactly(s, size):
+    buf = b""
+    while len(buf) < size:
+        chunk = s.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed by manager")
+        buf += chunk
+    return buf
+
+def recv_message(s):
+    (length,) = struct.unpack("!I", recv_exactly(s, 4))
+    return json.loads(recv_exactly(s, length).decode())
+
+# A reader thread receives every message from the manager.
+# Responses are handed to the request waiting for their id;
+# "migrate" messages, pushed when the manager moves the
+# application to another access point, update manager_resp
+# and tell the streaming loop to connect to the new one
+request_lock = threading.Lock()
+responses = {}
+responses_cond = threading.Condition()
+manager_closed = False
+migrated = threading.Event()
+
+def read_messages(s):
+    global manager_closed
+    while True:
+        try:
+            message = recv_message(s)
+        except (ConnectionError, OSError, ValueError) as e:
+            print("[ERROR] Connection to manager lost: ", e)
+            with responses_cond:
+                manager_closed = True
+                responses_cond.notify_all()
+            return
+        if message.get("op") == "migrate":
+            print("[INFO] Application moved to {}:{}".format(message["ip"], message["port"]))
+            manager_resp["service_id"] = message["new_service_id"]
+            manager_resp["lease_id"] = message["new_service_id"]
+            manager_resp["ip"] = message["ip"]
+            manager_resp["port"] = message["port"]
+            migrated.set()
+            continue
+        with responses_cond:
+            responses[message.get("id")] = message
+            responses_cond.notify_all()
+
+# Send a request and wait for the response carrying its id
+def send_request(s, request):
+    with request_lock:
+        send_message(s, request)
+    with responses_cond:
+        while request["id"] not in responses:
+            if manager_closed:
+                raise ConnectionError("connection closed by manager")
+            responses_cond.wait()
+        return responses.pop(request["id"])
+
+# Renew the application's lease, otherwise the manager removes
+# it once lease_ttl seconds pass without a heartbeat
+def send_heartbeats(s, manager_resp):
+    ttl = manager_resp["lease_ttl"]
+    while True:
+        time.sleep(ttl / 3)
+        # The lease id changes when the application is moved
+        request = {"op":"heartbeat","id":"heartbeat","service_id":manager_resp["lease_id"]}
+        try:
+            resp = send_request(s, request)
+        except (ConnectionError, OSError) as e:
+            print("[ERROR] Heartbeat failed: ", e)
+            return
+        if resp["resp-code"] != 0:
+            print("[ERROR] Heartbeat rejected: ", resp["failure-msg"])
+            return
+        ttl = resp["lease_ttl"]
+
+def shutdown_application(s, manager_resp):
     print("[INFO] Sending shutdown request...\n")
-    s.sendall(json.dumps(request).encode())
-    print("[INFO] Successfully sent: \n{}\n".format(json.dumps(request, indent=3)))
-    resp = s.recv(1024)
-    resp = json.loads(resp.decode())
-    print("[INFO] RESPONSE: ", resp)
+    request = {"op":"shutdown","id":"shutdown",
+               "service_id":manager_resp["service_id"],"ip":manager_resp["ip"]}
+    if "lease_id" in manager_resp:
+        request["lease_id"] = manager_resp["lease_id"]
+    print("[INFO] Sending: \n{}\n".format(json.dumps(request, indent=3)))
+    try:
+        resp = send_request(s, request)
+        print("[INFO] RESPONSE: ", resp)
+    except (ConnectionError, OSError) as e:
+        print("[ERROR] Shutdown request failed: ", e)
     s.close()
 
+# The control connection stays open for the lifetime of the application
 print("\n[INFO] Connecting to the request server...")
 s = create_connection(manager_ip, request_port)
 print("\n[INFO] Successfully connected to request server\n")
+threading.Thread(target=read_messages, args=(s,), daemon=True).start()
 
 print("[INFO] Sending request...\n")
-request = {"image":image,"application_port":5555,"protocol":"tcp"}
-s.sendall(json.dumps(request).encode())
-print("[INFO] Successfully sent: \n{}\n".format(json.dumps(request, indent=3)))
-manager_resp = s.recv(1024)
-manager_resp = json.loads(manager_resp.decode())
+# Wait for the application to be serving, so the first frame
+# is not sent to a port nobody listens on yet
+request = {"op":"deploy","id":"deploy","image":image,"application_port":5555,"protocol":"tcp",
+           "wait_ready":True,"lease_ttl":lease_ttl}
+print("[INFO] Sending: \n{}\n".format(json.dumps(request, indent=3)))
+manager_resp = send_request(s, request)
 print("[INFO] Server response: \n{}\n".format(json.dumps(manager_resp, indent=3)))
-s.close()
 
 if manager_resp["resp-code"] != 0:
     print("[ERROR] Non-zero response code from server.")
@@ -71,12 +158,15 @@ if manager_resp["resp-code"] != 0:
     print("[ERROR] Exiting...")
     sys.exit(-1)
 
+if "lease_ttl" in manager_resp:
+    threading.Thread(target=send_heartbeats, args=(s, manager_resp), daemon=True).start()
+
 # Signal handler
 # Makes sure to send a shutdown request when a signal is received
 # i.e. shutdown app when killing the program
 def handler(signal, frame):
     print("\n[INFO] Received signal ", signal)
-    shutdown_application(manager_ip, shutdown_port, manager_resp)
+    shutdown_application(s, manager_resp)
     sys.exit(0)
 
 # Register all catchable signals
@@ -84,9 +174,19 @@ catchable_sigs = set(signal.Signals) - {signal.SIGKILL, signal.SIGSTOP, signal.S
 for sig in catchable_sigs:
     signal.signal(sig, handler)
 
-ip = manager_resp["ip"]
-port = manager_resp["port"]
-sender = imagezmq.ImageSender(connect_to="tcp://{}:{}".format(ip,port))
+def connect_sender():
+    return imagezmq.ImageSender(connect_to="tcp://{}:{}".format(manager_resp["ip"], manager_resp["port"]))
+
+# Switch to the new access point once the application was moved;
+# the old one keeps serving for a moment, so no frame is lost
+def current_sender(sender):
+    if not migrated.is_set():
+        return sender
+    migrated.clear()
+    sender.zmq_socket.close(linger=0)
+    return connect_sender()
+
+sender = connect_sender()
 
 cam = cv2.VideoCapture(0)
 cam.set(3, 640)
@@ -104,7 +204,7 @@ try:
     print("[INFO] Successfully connected to application\n")
 except Exception as e:
     print("\n[ERROR] e\n")
-    shutdown_application(manager_ip, shutdown_port, manager_resp)
+    shutdown_application(s, manager_resp)
     sys.exit(-1)
 
 if use_motion:
@@ -113,11 +213,12 @@ if use_motion:
             try:
                 _, frame = cam.read()
                 print("\n[INFO] Sending image\n")
+                sender = current_sender(sender)
                 resp = sender.send_image((minW, minH),frame)
                 #print("[INFO] Server response: ", resp)
             except Exception as e:
                 print("\n[ERROR] e\n")
-                shutdown_application(manager_ip, shutdown_port, manager_resp)
+                shutdown_application(s, manager_resp)
                 sys.exit(-1)
 else:
     count = 0
@@ -126,6 +227,7 @@ else:
         try:
             _, frame = cam.read()
             #print("\n[INFO] Sending image\n")
+            sender = current_sender(sender)
             resp = sender.send_image((minW, minH),frame)
             count += 1
             if count%5 == 0:
@@ -133,6 +235,6 @@ else:
             #print("[INFO] Server response: ", resp)
         except Exception as e:
             print("\n\t[ERROR] e\n")
-            shutdown_application(manager_ip, shutdown_port, manager_resp)
+            shutdown_application(s, manager_resp)
             sys.exit(-1)
     duration = time.time() - start
@@ -0,0 +1,191 @@
+import time
+import threading
+import collections
+import swarm as swarm_module
+
+'''
+	Admission control for deploys.
+
+	Starting a service pulls its image and starts its container
+	on the chosen access point, and a burst of deploys to one
+	small access point can overcommit it until none of them run
+	well. The AdmissionController lets at most a given number
+	of deploys start on each access point at once. Further
+	deploys wait in a bounded queue, in order, until a slot is
+	free or their deadline passes; deploys that find the queue
+	full or wait too long are answered with the number of
+	seconds after which to retry.
+
+	Only deploys that are starting hold a slot: it is released
+	once the service is created. Services that are running are
+	not counted here, the CapacityLedger of the swarm keeps
+	their reservations within what each access point has.
+'''
+
+# Capacity of an access point whose CPU count can not be read
+DEFAULT_CAPACITY = 2
+
+'''
+	Class: AdmissionController
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services run on
+		capacity:
+			Number of deploys starting at once on every
+			access point, or None to use its CPU count
+		capacities:
+			Dictionary mapping IP of managed nodes to their
+			capacity, overriding capacity
+		queue_size:
+			Number of deploys waiting at most, across all
+			access points
+		max_wait:
+			Seconds a deploy waits at most for a slot
+		in_flight:
+			Dictionary mapping IP of managed nodes to the
+			number of deploys starting on it
+		waiters:
+			Dictionary mapping IP of managed nodes to the
+			queue of events of the deploys waiting for it
+		hold_time:
+			Moving average of the seconds a deploy holds its
+			slot, to estimate when to retry
+		stats:
+			Counters of deploys admitted, queued, rejected
+			because the queue was full, expired in the queue
+			and admitted after waiting, and of the time spent
+			waiting
+'''
+class AdmissionController:
+
+    def __init__(self, swarm, capacity=None, capacities=None, queue_size=64, max_wait=10):
+        self.swarm = swarm
+        self.capacity = capacity
+        self.capacities = dict(capacities or {})
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.measured = {}
+        self.in_flight = collections.defaultdict(int)
+        self.waiters = collections.defaultdict(collections.deque)
+        self.waiting = 0
+        self.hold_time = 1.0
+        self.lock = threading.Lock()
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected": 0,
+            "expired": 0,
+            "waited": 0,
+            "max_depth": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    '''
+	Function:	capacity_of
+
+	Description:	Return the number of deploys that may start at
+			once on the node with IP server_ip: the configured
+			capacity, or its CPU count.
+    '''
+    def capacity_of(self, server_ip):
+        if server_ip in self.capacities:
+            return self.capacities[server_ip]
+        if self.capacity is not None:
+            return self.capacity
+        if server_ip not in self.measured:
+            client = self.swarm.nodes.get(server_ip)
+            info = swarm_module.get_info(client) if client is not None else None
+            if info is None:
+                return DEFAULT_CAPACITY
+            self.measured[server_ip] = max(info.get("NCPU", DEFAULT_CAPACITY), 1)
+        return self.measured[server_ip]
+
+    '''
+	Function:	admit
+
+	Description:	Take a slot to start a service on the node with
+			IP server_ip, waiting at most max_wait seconds
+			(and at most the configured max_wait) behind
+			earlier deploys. Return (True, seconds waited) once
+			admitted, or (False, seconds after which to retry).
+    '''
+    def admit(self, server_ip, max_wait=None):
+        capacity = self.capacity_of(server_ip)
+        try:
+            max_wait = min(float(max_wait), self.max_wait)
+        except (TypeError, ValueError):
+            max_wait = self.max_wait
+
+        with self.lock:
+            if not self.waiters[server_ip] and self.in_flight[server_ip] < capacity:
+                self.in_flight[server_ip] += 1
+                self.stats["admitted"] += 1
+                return (True, 0.0)
+            if self.waiting >= self.queue_size or max_wait <= 0:
+                self.stats["rejected"] += 1
+                return (False, self.retry_after(server_ip, capacity))
+            event = threading.Event()
+            self.waiters[server_ip].append(event)
+            self.waiting += 1
+            self.stats["queued"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.waiting)
+
+        start = time.monotonic()
+        event.wait(max_wait)
+        waited = time.monotonic() - start
+        with self.lock:
+            # release may have handed over a slot right after the timeout
+            if not event.is_set():
+                self.waiters[server_ip].remove(event)
+                self.waiting -= 1
+                self.stats["expired"] += 1
+                return (False, self.retry_after(server_ip, capacity))
+            self.stats["admitted"] += 1
+            self.stats["waited"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+        return (True, waited)
+
+    '''
+	Function:	release
+
+	Description:	Give back the slot of a deploy on the node with
+			IP server_ip that held it for held seconds. The
+			slot goes to the oldest deploy waiting for the
+			node, if any.
+    '''
+    def release(self, server_ip, held):
+        with self.lock:
+            self.hold_time = 0.8 * self.hold_time + 0.2 * held
+            if self.waiters[server_ip]:
+                self.waiting -= 1
+                self.waiters[server_ip].popleft().set()
+            else:
+                self.in_flight[server_ip] -= 1
+
+    def retry_after(self, server_ip, capacity):
+        # Time until the deploys ahead have started, at least one second
+        ahead = self.in_flight[server_ip] + len(self.waiters[server_ip]) + 1
+        return max(1, int(round(self.hold_time * ahead / max(capacity, 1))))
+
+    '''
+	Function:	get_stats
+
+	Description:	Return the admission counters, the number of
+			deploys waiting and starting on each node and the
+			capacity of each node.
+    '''
+    def get_stats(self):
+        capacity = {ip: self.capacity_of(ip) for ip in list(self.swarm.nodes.keys())}
+        with self.lock:
+            stats = dict(self.stats)
+            stats["depth"] = self.waiting
+            stats["queue_size"] = self.queue_size
+            stats["in_flight"] = {ip: count for ip, count in self.in_flight.items() if count}
+            stats["waiting"] = {ip: len(waiters) for ip, waiters in self.waiters.items() if waiters}
+        stats["capacity"] = capacity
+        if stats["waited"]:
+            stats["wait_seconds_avg"] = stats["wait_seconds_total"] / stats["waited"]
+        return stats
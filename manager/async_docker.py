@@ -0,0 +1,578 @@
+import ssl
+import json
+import types
+import asyncio
+import threading
+import collections
+import urllib.parse
+import docker
+
+'''
+	Asyncio client for the Docker Engine API.
+
+	docker.APIClient makes one blocking HTTP request per call,
+	so every call to an access point occupies a thread for its
+	whole round trip. AsyncDockerClient speaks HTTP/1.1 to the
+	daemon from an event loop instead, over the unix socket or
+	TCP (with TLS), and keeps a pool of keep-alive connections
+	to it, so many calls can be in flight at once without a
+	thread or a new connection each.
+
+	It covers the calls DockerSwarm makes, with the same names,
+	arguments and results as docker.APIClient. DockerClient
+	wraps it for synchronous callers: its calls run on one
+	shared event loop thread and block only the calling thread,
+	so DockerSwarm can use it in place of docker.APIClient.
+'''
+
+DEFAULT_API_VERSION = "1.40"
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_CONNECTIONS = 8
+# Requests that only read state, sent again on a new connection
+# if a reused one is lost; others may have been acted on
+RETRIED_METHODS = ("GET", "HEAD")
+
+'''
+	Class: ConnectionPool
+
+	Member Variables:
+		opener:
+			Coroutine function opening a new connection, a
+			(StreamReader, StreamWriter) tuple
+		max_connections:
+			Number of connections open at most; further
+			requests wait for one to be released
+		idle:
+			Deque of the open connections not in use
+'''
+class ConnectionPool:
+
+    def __init__(self, opener, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.opener = opener
+        self.max_connections = max_connections
+        self.idle = collections.deque()
+        self.semaphore = asyncio.Semaphore(max_connections)
+
+    '''
+	Function:	acquire
+
+	Description:	Return (connection, reused): an idle connection
+			still open, or a new one.
+    '''
+    async def acquire(self):
+        await self.semaphore.acquire()
+        try:
+            while self.idle:
+                (reader, writer) = self.idle.pop()
+                if not reader.at_eof() and not writer.is_closing():
+                    return ((reader, writer), True)
+                writer.close()
+            return (await self.opener(), False)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self, connection, reuse):
+        if reuse:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+        self.semaphore.release()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+'''
+	Class: AsyncDockerClient
+
+	Member Variables:
+		base_url:
+			Address of the daemon, unix://<socket path> or
+			tcp://<host>:<port>
+		tls:
+			docker.tls.TLSConfig for TCP connections, or None
+		timeout:
+			Seconds a call may take; a streamed call, e.g. a
+			pull, may take longer as long as its response
+			keeps coming with no gap longer than timeout
+		max_connections:
+			Number of connections to the daemon open at most
+		api_version:
+			Docker Engine API version of the requests
+'''
+class AsyncDockerClient:
+
+    def __init__(self, base_url, tls=None, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, version=DEFAULT_API_VERSION):
+        self.base_url = base_url
+        self.tls = tls
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.api_version = version
+        url = urllib.parse.urlparse(base_url)
+        if url.scheme in ("unix", "http+unix"):
+            # unix://var/run/docker.sock is /var/run/docker.sock
+            self.socket_path = "/" + (url.netloc + url.path).lstrip("/")
+            self.host = "localhost"
+        else:
+            self.socket_path = None
+            self.host = url.hostname
+            self.port = url.port or (2376 if tls else 2375)
+        self.ssl_context = create_ssl_context(tls) if tls else None
+        self.pool = None
+
+    async def open_connection(self):
+        if self.socket_path is not None:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+
+    def get_pool(self):
+        # Created on first use, from the loop the client runs on
+        if self.pool is None:
+            self.pool = ConnectionPool(self.open_connection, self.max_connections)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+    '''
+	Function:	request
+
+	Description:	Send a request to the daemon and return the
+			decoded JSON body of the response (the text if
+			it is not JSON, None if it is empty). Raise
+			docker.errors.APIError for error responses and
+			OSError if the daemon can not be reached in
+			time. If streamed, the call has no deadline but
+			each read of the response must return within
+			timeout.
+    '''
+    async def request(self, method, path, params=None, body=None, timeout=None, streamed=False):
+        timeout = self.timeout if timeout is None else timeout
+        if streamed:
+            (status, reason, data) = await self.exchange(method, path, params, body, timeout)
+        else:
+            try:
+                (status, reason, data) = await asyncio.wait_for(
+                    self.exchange(method, path, params, body), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("{} {} timed out after {}s".format(method, path, timeout)) from None
+        check_status(status, reason, data)
+        return decode_body(data)
+
+    async def exchange(self, method, path, params, body, read_timeout=None):
+        pool = self.get_pool()
+        request = self.encode_request(method, path, params, body)
+        while True:
+            (connection, reused) = await timed(pool.acquire(), read_timeout)
+            (reader, writer) = connection
+            if read_timeout is not None:
+                reader = TimedReader(reader, read_timeout)
+            try:
+                writer.write(request)
+                await timed(writer.drain(), read_timeout)
+                (status, reason, headers, keep_alive) = await read_head(reader)
+                data = await read_body(reader, headers, method)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                pool.release(connection, False)
+                if reused and method in RETRIED_METHODS:
+                    # The daemon closed the idle connection, retry on a new one
+                    continue
+                raise ConnectionError("connection to {} lost: {}".format(self.base_url, e)) from e
+            except BaseException:
+                pool.release(connection, False)
+                raise
+            pool.release(connection, keep_alive)
+            return (status, reason, data)
+
+    def encode_request(self, method, path, params, body):
+        target = "/v{}{}".format(self.api_version, path)
+        if params:
+            query = {key: value for key, value in params.items() if value is not None}
+            if query:
+                target += "?" + urllib.parse.urlencode(query)
+        lines = ["{} {} HTTP/1.1".format(method, target),
+                 "Host: {}".format(self.host),
+                 "User-Agent: edgeap",
+                 "Connection: keep-alive"]
+        data = b""
+        if body is not None:
+            data = json.dumps(body).encode()
+            lines.append("Content-Type: application/json")
+        if body is not None or method in ("POST", "PUT"):
+            lines.append("Content-Length: {}".format(len(data)))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode() + data
+
+    '''
+	Function:	stream
+
+	Description:	Send a request whose response is a stream of
+			JSON objects, e.g. events, and yield them as
+			they arrive. The stream's connection is not
+			shared and is closed when the stream ends. The
+			daemon must answer within timeout, after which
+			the stream may stay idle for any time.
+    '''
+    async def stream(self, method, path, params=None):
+        (reader, writer) = await timed(self.open_connection(), self.timeout)
+        try:
+            writer.write(self.encode_request(method, path, params, None))
+            await timed(writer.drain(), self.timeout)
+            (status, reason, headers, _) = await read_head(TimedReader(reader, self.timeout))
+            if status >= 400:
+                check_status(status, reason, await read_body(TimedReader(reader, self.timeout), headers, method))
+            buffer = b""
+            async for chunk in read_chunks(reader, headers):
+                buffer += chunk
+                while b"\n" in buffer:
+                    (line, buffer) = buffer.split(b"\n", 1)
+                    if line.strip():
+                        yield json.loads(line)
+            if buffer.strip():
+                yield json.loads(buffer)
+        finally:
+            writer.close()
+
+    # ------------------------ Engine API ------------------------ #
+
+    async def version(self):
+        return await self.request("GET", "/version")
+
+    async def info(self):
+        return await self.request("GET", "/info")
+
+    async def images(self):
+        return await self.request("GET", "/images/json")
+
+    async def pull(self, repository, tag=None, **kwargs):
+        # The progress stream is read to the end, as docker.APIClient does,
+        # however long the pull takes as long as progress keeps coming
+        result = await self.request("POST", "/images/create",
+                                    {"fromImage": repository, "tag": tag or "latest"},
+                                    timeout=kwargs.get("timeout"), streamed=True)
+        return result if isinstance(result, str) else json.dumps(result)
+
+    async def containers(self, all=False, **kwargs):
+        return await self.request("GET", "/containers/json", {"all": int(bool(all))})
+
+    async def stats(self, container, decode=None, stream=False):
+        return await self.request("GET", "/containers/{}/stats".format(container), {"stream": "false"})
+
+    async def init_swarm(self, advertise_addr=None, listen_addr="0.0.0.0:2377", force_new_cluster=False):
+        return await self.request("POST", "/swarm/init",
+                                  body={"AdvertiseAddr": advertise_addr, "ListenAddr": listen_addr,
+                                        "ForceNewCluster": force_new_cluster, "Spec": {}})
+
+    async def inspect_swarm(self):
+        return await self.request("GET", "/swarm")
+
+    async def join_swarm(self, remote_addrs, join_token, listen_addr="0.0.0.0:2377", advertise_addr=None):
+        await self.request("POST", "/swarm/join",
+                           body={"ListenAddr": listen_addr, "AdvertiseAddr": advertise_addr,
+                                 "RemoteAddrs": remote_addrs, "JoinToken": join_token})
+        return True
+
+    async def leave_swarm(self, force=False):
+        try:
+            await self.request("POST", "/swarm/leave", {"force": str(bool(force)).lower()})
+        except docker.errors.APIError as e:
+            # Leaving when not part of a swarm is not an error
+            if force and getattr(e, "status_code", None) == 503:
+                return True
+            raise
+        return True
+
+    async def nodes(self, filters=None):
+        return await self.request("GET", "/nodes", {"filters": convert_filters(filters)})
+
+    async def inspect_node(self, node_id):
+        return await self.request("GET", "/nodes/{}".format(node_id))
+
+    async def remove_node(self, node_id, force=False):
+        await self.request("DELETE", "/nodes/{}".format(node_id), {"force": str(bool(force)).lower()})
+        return True
+
+    async def services(self, filters=None):
+        return await self.request("GET", "/services", {"filters": convert_filters(filters)})
+
+    async def inspect_service(self, service):
+        return await self.request("GET", "/services/{}".format(service))
+
+    async def create_service(self, task_template, name=None, labels=None, mode=None,
+                             update_config=None, networks=None, endpoint_config=None,
+                             endpoint_spec=None, **kwargs):
+        body = {"TaskTemplate": task_template}
+        if name is not None:
+            body["Name"] = name
+        if labels is not None:
+            body["Labels"] = labels
+        if mode is not None:
+            body["Mode"] = mode
+        if endpoint_spec is not None:
+            body["EndpointSpec"] = endpoint_spec
+        return await self.request("POST", "/services/create", body=body)
+
+    async def update_service(self, service, version, labels=None, fetch_current_spec=False, **kwargs):
+        spec = {}
+        if fetch_current_spec:
+            spec = dict((await self.inspect_service(service))["Spec"])
+        if labels is not None:
+            spec["Labels"] = labels
+        return await self.request("POST", "/services/{}/update".format(service),
+                                  {"version": version}, body=spec)
+
+    async def remove_service(self, service):
+        await self.request("DELETE", "/services/{}".format(service))
+        return True
+
+    async def tasks(self, filters=None):
+        return await self.request("GET", "/tasks", {"filters": convert_filters(filters)})
+
+    def events(self, since=None, until=None, filters=None, decode=True):
+        return self.stream("GET", "/events", {"since": since, "until": until,
+                                              "filters": convert_filters(filters)})
+
+'''
+	Class: DockerClient
+
+	Member Variables:
+		client:
+			AsyncDockerClient the calls are made with, on the
+			shared event loop thread
+		timeout:
+			Seconds a call may take
+'''
+class DockerClient:
+
+    def __init__(self, base_url, tls=None, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, version=DEFAULT_API_VERSION):
+        self.client = AsyncDockerClient(base_url, tls, timeout, max_connections, version)
+        self.timeout = timeout
+        self.loop = shared_loop()
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name.startswith("_") or not asyncio.iscoroutinefunction(method):
+            return method
+
+        def call(*args, **kwargs):
+            future = asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self.loop)
+            return future.result()
+        return call
+
+    def events(self, since=None, until=None, filters=None, decode=True):
+        return EventStream(self.client.events(since, until, filters, decode), self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.client.close)
+
+'''
+	Class: EventStream
+
+	Iterates over the objects of a stream from an
+	AsyncDockerClient for a synchronous caller, like the stream
+	docker.APIClient.events returns. close ends the iteration,
+	also from another thread.
+'''
+class EventStream:
+
+    def __init__(self, stream, loop):
+        self.stream = stream
+        self.loop = loop
+        self.future = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if self.closed:
+                raise StopIteration
+            self.future = asyncio.run_coroutine_threadsafe(self.stream.__anext__(), self.loop)
+        try:
+            return self.future.result()
+        except (StopAsyncIteration, asyncio.CancelledError):
+            raise StopIteration from None
+        except Exception:
+            if self.closed:
+                raise StopIteration from None
+            raise
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            future = self.future
+        if future is not None:
+            future.cancel()
+        asyncio.run_coroutine_threadsafe(self.stream.aclose(), self.loop)
+
+SHARED_LOOP = None
+SHARED_LOOP_LOCK = threading.Lock()
+
+'''
+	Function:	shared_loop
+
+	Description:	Return the event loop the DockerClients run
+			their calls on, started on a daemon thread on
+			first use.
+'''
+def shared_loop():
+    global SHARED_LOOP
+    with SHARED_LOOP_LOCK:
+        if SHARED_LOOP is None:
+            SHARED_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=SHARED_LOOP.run_forever, name="edgeap-docker", daemon=True).start()
+        return SHARED_LOOP
+
+'''
+	Class: TimedReader
+
+	Reads from a StreamReader like it, raising TimeoutError if
+	no data arrives for timeout seconds.
+'''
+class TimedReader:
+
+    def __init__(self, reader, timeout):
+        self.reader = reader
+        self.timeout = timeout
+
+    def at_eof(self):
+        return self.reader.at_eof()
+
+    async def readline(self):
+        return await timed(self.reader.readline(), self.timeout)
+
+    async def read(self, n=-1):
+        if n >= 0:
+            return await timed(self.reader.read(n), self.timeout)
+        data = []
+        while True:
+            chunk = await timed(self.reader.read(65536), self.timeout)
+            if not chunk:
+                return b"".join(data)
+            data.append(chunk)
+
+    async def readexactly(self, n):
+        data = []
+        left = n
+        while left > 0:
+            chunk = await timed(self.reader.read(min(left, 65536)), self.timeout)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"".join(data), n)
+            data.append(chunk)
+            left -= len(chunk)
+        return b"".join(data)
+
+'''
+	Function:	timed
+
+	Description:	Await coroutine, raising TimeoutError if it
+			takes longer than timeout seconds, or for as long
+			as it takes if timeout is None.
+'''
+async def timed(coroutine, timeout):
+    if timeout is None:
+        return await coroutine
+    try:
+        return await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError("no response from the daemon within {}s".format(timeout)) from None
+
+def create_ssl_context(tls):
+    verify = getattr(tls, "verify", False)
+    ca_cert = getattr(tls, "ca_cert", None)
+    context = ssl.create_default_context(cafile=ca_cert if verify else None)
+    # Access points are addressed by IP, as with docker.APIClient
+    context.check_hostname = False
+    if not verify:
+        context.verify_mode = ssl.CERT_NONE
+    cert = getattr(tls, "cert", None)
+    if cert:
+        context.load_cert_chain(*cert) if isinstance(cert, tuple) else context.load_cert_chain(cert)
+    return context
+
+'''
+	Function:	convert_filters
+
+	Description:	Return filters as the JSON string the Engine
+			API expects, every value a list, as
+			docker.utils.convert_filters does.
+'''
+def convert_filters(filters):
+    if not filters:
+        return None
+    converted = {}
+    for key, value in filters.items():
+        if isinstance(value, bool):
+            value = str(value).lower()
+        converted[key] = value if isinstance(value, list) else [str(value)]
+    return json.dumps(converted)
+
+async def read_head(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by the daemon")
+    parts = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    (http_version, status, reason) = (parts + [""])[:3]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        (name, _, value) = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = http_version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    if "content-length" not in headers and "chunked" not in headers.get("transfer-encoding", ""):
+        # The body ends when the connection does
+        keep_alive = False
+    return (int(status), reason, headers, keep_alive)
+
+async def read_body(reader, headers, method):
+    if method == "HEAD":
+        return b""
+    if "chunked" in headers.get("transfer-encoding", ""):
+        return b"".join([chunk async for chunk in read_chunks(reader, headers)])
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"]))
+    return await reader.read()
+
+async def read_chunks(reader, headers):
+    if "chunked" not in headers.get("transfer-encoding", ""):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+    while True:
+        size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            # Trailers, if any, end with an empty line
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return
+        data = await reader.readexactly(size)
+        await reader.readexactly(2)
+        yield data
+
+def decode_body(data):
+    if not data:
+        return None
+    text = data.decode()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def check_status(status, reason, data):
+    if status < 400:
+        return
+    message = decode_body(data)
+    if isinstance(message, dict):
+        message = message.get("message", reason)
+    response = types.SimpleNamespace(status_code=status, reason=reason)
+    error = docker.errors.NotFound if status == 404 else docker.errors.APIError
+    raise error("{} {}: {}".format(status, reason, message), response=response, explanation=message)
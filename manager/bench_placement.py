@@ -0,0 +1,87 @@
+import time
+import random
+import statistics
+import argparse
+import placement
+import fake_docker
+
+'''
+	Placement simulation benchmark.
+
+	Deploys a mix of applications on a fleet of fake access
+	points with every placement strategy, then reports how
+	evenly the fleet ended up loaded and how long each
+	placement decision took. No Docker daemon is needed.
+'''
+
+# (image, cpu cores, memory bytes) of the simulated applications
+APPS = [
+    ("cdesiniotis/face_rec_server", 0.60, 200 * fake_docker.MB),
+    ("ubuntu", 0.05, 16 * fake_docker.MB),
+    ("nginx", 0.10, 32 * fake_docker.MB),
+]
+
+def simulate(strategy, num_nodes, num_services, refresh_every, seed):
+    rng = random.Random(seed)
+    image_costs = {image: (cpu, memory) for image, cpu, memory in APPS}
+    (_, swarm_obj, _) = fake_docker.create_fake_swarm(num_nodes, image_costs=image_costs)
+    placer = placement.Placer(swarm_obj, strategy=strategy)
+    placer.refresh()
+
+    decisions = []
+    rejected = 0
+    failed = 0
+    for i in range(num_services):
+        if i % refresh_every == 0:
+            placer.refresh()
+        (image, _, _) = rng.choice(APPS)
+        request = {"image": image, "application_port": 5555, "protocol": "tcp"}
+        start = time.perf_counter()
+        ip = placer.place(request)
+        decisions.append(time.perf_counter() - start)
+        if ip is None:
+            rejected += 1
+            continue
+        # A failed deploy would skew the results, count it
+        (resp, _) = swarm_obj.create_service(ip, request)
+        if resp is False:
+            failed += 1
+
+    placer.refresh()
+    utilization = [load.utilization() for load in placer.node_loads()]
+    decisions.sort()
+    return {
+        "strategy": strategy,
+        "nodes": num_nodes,
+        "used": sum(1 for u in utilization if u > 0),
+        "rejected": rejected,
+        "failed": failed,
+        "max": max(utilization),
+        "stdev": statistics.pstdev(utilization),
+        "p50": decisions[len(decisions) // 2],
+        "p99": decisions[int(len(decisions) * 0.99)],
+    }
+
+def main():
+    argparser = argparse.ArgumentParser(description='EdgeAP placement benchmark')
+    argparser.add_argument('-n', '--nodes', type=int, nargs='+', default=[100, 250, 500],
+                           help='fleet sizes to simulate (default is 100 250 500)')
+    argparser.add_argument('-s', '--services-per-node', type=float, default=3,
+                           help='services deployed per node (default is 3)')
+    argparser.add_argument('-r', '--refresh-every', type=int, default=50,
+                           help='deploys between two load refreshes (default is 50)')
+    argparser.add_argument('--seed', type=int, default=1)
+    args = argparser.parse_args()
+
+    print("{:<13} {:>6} {:>6} {:>9} {:>7} {:>9} {:>7} {:>10} {:>10}".format(
+        "strategy", "nodes", "used", "rejected", "failed", "max util", "stdev", "p50 (us)", "p99 (us)"))
+    for num_nodes in args.nodes:
+        for strategy in sorted(placement.STRATEGIES):
+            r = simulate(strategy, num_nodes, int(num_nodes * args.services_per_node),
+                         args.refresh_every, args.seed)
+            print("{:<13} {:>6} {:>6} {:>9} {:>7} {:>9.2f} {:>7.3f} {:>10.1f} {:>10.1f}".format(
+                r["strategy"], r["nodes"], r["used"], r["rejected"], r["failed"], r["max"], r["stdev"],
+                r["p50"] * 1e6, r["p99"] * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import time
+import random
+import argparse
+import ports
+
+'''
+	Port allocation micro-benchmark.
+
+	Fills one node's port range to a given occupancy, then
+	times allocating and releasing a port with the previous
+	random retry over a list of used ports and with the
+	PortAllocator.
+'''
+
+def random_retry(used):
+    # generate_port_num before the PortAllocator
+    port = random.randint(ports.PORT_RANGE_START, ports.PORT_RANGE_END)
+    while port in used:
+        port = random.randint(ports.PORT_RANGE_START, ports.PORT_RANGE_END)
+    return port
+
+def bench_random_retry(occupancy, iterations, rng):
+    size = ports.PORT_RANGE_END - ports.PORT_RANGE_START + 1
+    used = rng.sample(range(ports.PORT_RANGE_START, ports.PORT_RANGE_END + 1), int(size * occupancy))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        port = random_retry(used)
+        used.append(port)
+        used.remove(rng.choice(used))
+    return (time.perf_counter() - start) / iterations
+
+def bench_allocator(occupancy, iterations, rng):
+    allocator = ports.PortAllocator()
+    used = [allocator.allocate() for _ in range(int(allocator.size * occupancy))]
+    rng.shuffle(used)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        used.append(allocator.allocate())
+        allocator.release(used.pop(rng.randrange(len(used))))
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    argparser = argparse.ArgumentParser(description='EdgeAP port allocation benchmark')
+    argparser.add_argument('-o', '--occupancy', type=float, nargs='+',
+                           default=[0.5, 0.9, 0.99, 0.999],
+                           help='fractions of the port range in use (default is 0.5 0.9 0.99 0.999)')
+    argparser.add_argument('-i', '--iterations', type=int, default=2000,
+                           help='allocations timed per occupancy (default is 2000)')
+    argparser.add_argument('--seed', type=int, default=1)
+    args = argparser.parse_args()
+
+    print("{:>10} {:>18} {:>18}".format("occupancy", "random retry (us)", "allocator (us)"))
+    for occupancy in args.occupancy:
+        retry = bench_random_retry(occupancy, args.iterations, random.Random(args.seed))
+        allocator = bench_allocator(occupancy, args.iterations, random.Random(args.seed))
+        print("{:>10.3f} {:>18.1f} {:>18.1f}".format(occupancy, retry * 1e6, allocator * 1e6))
+
+if __name__ == "__main__":
+    main()
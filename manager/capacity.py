@@ -0,0 +1,274 @@
+import math
+import threading
+import docker
+
+'''
+	CPU and memory reservations and limits of services, and the
+	capacity they take on each access point.
+
+	A deploy request may ask for resources:
+
+		"resources": {"cpu": 0.5, "memory": "128m",
+			      "cpu_limit": 1, "memory_limit": "256m"}
+
+	cpu and cpu_limit are in cores, memory and memory_limit in
+	bytes or with a unit as in "128m". Values the request leaves
+	out come from the defaults of its image in the config, then
+	from the global defaults. They are passed to the swarm as the
+	Resources of the service's TaskTemplate, so Docker reserves
+	the CPU and memory and caps the container at the limits.
+
+	The CapacityLedger adds up the reservations of the services
+	tracked on each access point and of those being created, and
+	compares them with the access point's CPUs and memory less a
+	headroom left to the access point itself (hostapd, dockerd).
+	A service that does not fit is placed elsewhere, or refused
+	before any Docker API call is made.
+'''
+
+FIELDS = ("cpu", "memory", "cpu_limit", "memory_limit")
+
+NANO = 10 ** 9
+
+'''
+	Class: CapacityLedger
+
+	Member Variables:
+		services:
+			ServiceRegistry of the tracked services, whose
+			records carry their reservations
+		lookup_node:
+			Function returning the swarm node (as from
+			APIClient.nodes) with a given server_ip, or None
+		image_name:
+			Function normalizing image names
+		defaults:
+			Resources of services whose image has none
+		images:
+			Dictionary mapping image name to its resources
+		headroom:
+			CPU (cores) and memory (bytes) of every node
+			that are never reserved
+		pending:
+			Dictionary mapping node IP to the [cpu, memory]
+			reserved for services being created
+'''
+class CapacityLedger:
+
+    def __init__(self, services, lookup_node, image_name, defaults=None, images=None, headroom=None):
+        self.services = services
+        self.lookup_node = lookup_node
+        self.image_name = image_name
+        self.defaults = parse_resources(defaults)
+        self.images = {image_name(image): parse_resources(spec) for image, spec in (images or {}).items()}
+        headroom = parse_resources(headroom)
+        self.headroom = (headroom.get("cpu", 0.0), headroom.get("memory", 0))
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    '''
+	Function:	resources_for
+
+	Description:	Return the resources of a deploy request, its
+			own completed with the defaults of its image and
+			the global defaults. Raise ValueError if the
+			request's are malformed.
+    '''
+    def resources_for(self, request):
+        resources = dict(self.defaults)
+        if request.get("image") is not None:
+            resources.update(self.images.get(self.image_name(request["image"]), {}))
+        resources.update(parse_resources(request.get("resources")))
+        check_limits(resources)
+        return resources
+
+    '''
+	Function:	capacity
+
+	Description:	Return the (cpu, memory) of the node with IP
+			server_ip that services may reserve, or None if
+			the node is not known yet.
+    '''
+    def capacity(self, server_ip):
+        node = self.lookup_node(server_ip=server_ip)
+        if node is None:
+            return None
+        resources = node.get("Description", {}).get("Resources", {})
+        return (max(resources.get("NanoCPUs", 0) / NANO - self.headroom[0], 0.0),
+                max(resources.get("MemoryBytes", 0) - self.headroom[1], 0))
+
+    def committed(self, server_ip):
+        cpu = 0.0
+        memory = 0
+        for record in self.services.node_services(server_ip):
+            cpu += record.cpu
+            memory += record.memory
+        (pending_cpu, pending_memory) = self.pending.get(server_ip, (0.0, 0))
+        return (cpu + pending_cpu, memory + pending_memory)
+
+    '''
+	Function:	fits
+
+	Description:	Return True if the node with IP server_ip has
+			the reservations of resources left. Services
+			reserving nothing fit anywhere.
+    '''
+    def fits(self, server_ip, resources):
+        cpu = resources.get("cpu", 0.0)
+        memory = resources.get("memory", 0)
+        if not cpu and not memory:
+            return True
+        capacity = self.capacity(server_ip)
+        if capacity is None:
+            return True
+        with self.lock:
+            (used_cpu, used_memory) = self.committed(server_ip)
+        # Allow for rounding of the CPU shares
+        return used_cpu + cpu <= capacity[0] + 1e-9 and used_memory + memory <= capacity[1]
+
+    '''
+	Function:	reserve
+
+	Description:	Set the reservations of resources aside on the
+			node with IP server_ip for a service about to be
+			created. Return False if they do not fit.
+    '''
+    def reserve(self, server_ip, resources):
+        cpu = resources.get("cpu", 0.0)
+        memory = resources.get("memory", 0)
+        if not cpu and not memory:
+            return True
+        capacity = self.capacity(server_ip)
+        with self.lock:
+            if capacity is not None:
+                (used_cpu, used_memory) = self.committed(server_ip)
+                if used_cpu + cpu > capacity[0] + 1e-9 or used_memory + memory > capacity[1]:
+                    return False
+            pending = self.pending.setdefault(server_ip, [0.0, 0])
+            pending[0] += cpu
+            pending[1] += memory
+        return True
+
+    '''
+	Function:	release
+
+	Description:	Drop the reservations set aside by reserve,
+			once the service is tracked or failed to start.
+    '''
+    def release(self, server_ip, resources):
+        cpu = resources.get("cpu", 0.0)
+        memory = resources.get("memory", 0)
+        if not cpu and not memory:
+            return
+        with self.lock:
+            pending = self.pending.get(server_ip)
+            if pending is None:
+                return
+            pending[0] = max(pending[0] - cpu, 0.0)
+            pending[1] = max(pending[1] - memory, 0)
+            if not pending[0] and not pending[1]:
+                del self.pending[server_ip]
+
+    '''
+	Function:	get_stats
+
+	Description:	Return the reserved and reservable CPU and
+			memory of the nodes with IPs in server_ips.
+    '''
+    def get_stats(self, server_ips):
+        stats = {}
+        for ip in server_ips:
+            capacity = self.capacity(ip)
+            with self.lock:
+                (cpu, memory) = self.committed(ip)
+            stats[ip] = {"cpu": cpu, "memory": memory}
+            if capacity is not None:
+                stats[ip]["cpu_capacity"] = capacity[0]
+                stats[ip]["memory_capacity"] = capacity[1]
+        return stats
+
+'''
+	Function:	parse_resources
+
+	Description:	Return a resources dictionary (see above) with
+			cpu values in cores and memory values in bytes.
+			Raise ValueError if it is malformed, negative or
+			not finite.
+'''
+def parse_resources(spec):
+    if spec is None:
+        return {}
+    if not isinstance(spec, dict):
+        raise ValueError("resources must be an object")
+    unknown = set(spec) - set(FIELDS)
+    if unknown:
+        raise ValueError("unknown resources: {}".format(", ".join(sorted(unknown))))
+    resources = {}
+    for field, value in spec.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            raise ValueError("invalid {}: {}".format(field, value))
+        try:
+            if field.startswith("cpu"):
+                value = float(value)
+            else:
+                value = docker.utils.parse_bytes(value) if isinstance(value, str) else int(value)
+        except (TypeError, ValueError, OverflowError, docker.errors.DockerException) as e:
+            raise ValueError("invalid {}: {}".format(field, e))
+        if not math.isfinite(value):
+            raise ValueError("{} must be finite".format(field))
+        if value < 0:
+            raise ValueError("{} must not be negative".format(field))
+        resources[field] = value
+    check_limits(resources)
+    return resources
+
+def check_limits(resources):
+    for (reservation, limit) in (("cpu", "cpu_limit"), ("memory", "memory_limit")):
+        if limit in resources and resources[limit] < resources.get(reservation, 0):
+            raise ValueError("{} is lower than {}".format(limit, reservation))
+
+'''
+	Function:	to_docker
+
+	Description:	Return resources as the docker.types.Resources
+			of a TaskTemplate, or None if they set nothing.
+'''
+def to_docker(resources):
+    kwargs = {}
+    if resources.get("cpu"):
+        kwargs["cpu_reservation"] = int(resources["cpu"] * NANO)
+    if resources.get("memory"):
+        kwargs["mem_reservation"] = int(resources["memory"])
+    if resources.get("cpu_limit"):
+        kwargs["cpu_limit"] = int(resources["cpu_limit"] * NANO)
+    if resources.get("memory_limit"):
+        kwargs["mem_limit"] = int(resources["memory_limit"])
+    return docker.types.Resources(**kwargs) if kwargs else None
+
+'''
+	Function:	reservations
+
+	Description:	Return the reserved (cpu, memory) of a service
+			dictionary, as from APIClient.services.
+'''
+def reservations(service):
+    try:
+        reserved = service["Spec"]["TaskTemplate"]["Resources"]["Reservations"]
+    except (KeyError, TypeError):
+        return (0.0, 0)
+    return (reserved.get("NanoCPUs", 0) / NANO, reserved.get("MemoryBytes", 0))
+
+'''
+	Function:	limits
+
+	Description:	Return the (cpu, memory) limits of a service
+			dictionary, 0 where it has none.
+'''
+def limits(service):
+    try:
+        limited = service["Spec"]["TaskTemplate"]["Resources"]["Limits"]
+    except (KeyError, TypeError):
+        return (0.0, 0)
+    return (limited.get("NanoCPUs", 0) / NANO, limited.get("MemoryBytes", 0))
@@ -0,0 +1,8 @@
+'''
+	pytest configuration. The tests run against the in-memory
+	fake of the Docker API in fake_docker.py; test_swarm.py and
+	test_request.py are scripts for a real swarm and manager,
+	and are not collected.
+'''
+
+collect_ignore = ["test_swarm.py", "test_request.py"]
@@ -1,6 +1,7 @@
 import manager
 import sys
 import signal
+import threading
 import time
 import argparse
 
@@ -10,11 +11,16 @@ def main():
     argparser.add_argument('-c', '--config', type=str,
                            default="manager.conf",
                            help='configuration file (default is "manager.conf")')
+    argparser.add_argument('-a', '--asyncio', action='store_true',
+                           help='serve requests concurrently from an asyncio event loop')
+    argparser.add_argument('-w', '--workers', type=int,
+                           default=manager.DEFAULT_WORKERS,
+                           help='number of requests handled at once (default is {})'.format(manager.DEFAULT_WORKERS))
     args = argparser.parse_args()
     config_file = args.config
 
     # Create manager object
-    man_obj = manager.Manager(config_file)
+    man_obj = manager.Manager(config_file, workers=args.workers)
 
     # Signal handler
     def handler(signal, frame):
@@ -23,14 +29,25 @@ def main():
         man_obj.shutdown()
         sys.exit(0)
 
+    # Reload the config on SIGHUP, in the background as joining
+    # new access points takes a while
+    def reload_handler(signal, frame):
+        print("Reloading config file", config_file)
+        threading.Thread(target=man_obj.reload_config, daemon=True).start()
+
     # Register all catchable signals
-    catchable_sigs = set(signal.Signals) - {signal.SIGKILL, signal.SIGSTOP, signal.SIGWINCH}
+    catchable_sigs = set(signal.Signals) - {signal.SIGKILL, signal.SIGSTOP, signal.SIGWINCH,
+                                            signal.SIGHUP}
     for sig in catchable_sigs:
         signal.signal(sig, handler)
+    signal.signal(signal.SIGHUP, reload_handler)
 
     # Start the manager servers
-    man_obj.start_request_server()
-    man_obj.start_shutdown_server()
+    if args.asyncio:
+        man_obj.start_async_server()
+    else:
+        man_obj.start_request_server()
+        man_obj.start_shutdown_server()
 
     # Join threads
     for _, thread in man_obj.threads.items():
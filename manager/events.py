@@ -0,0 +1,129 @@
+import sys
+import time
+import threading
+
+'''
+	Consumer of the Docker events stream of the manager node.
+
+	Services and nodes created, updated or removed by anyone,
+	not just by this manager, are applied to the DockerSwarm
+	bookkeeping and node registry as they happen, so that they
+	stay in sync without listing every service or node.
+'''
+
+EVENT_FILTERS = {"type": ["service", "node"]}
+
+'''
+	Class: EventWatcher
+
+	Member Variables:
+		swarm:
+			DockerSwarm object kept in sync
+		since:
+			Time (seconds since the epoch) of the last
+			event handled, used to resume the stream after
+			a reconnect without missing events
+		retry_interval:
+			Seconds to wait before reconnecting after the
+			stream failed
+		stream:
+			Current events stream
+		handled:
+			Number of events handled, by type and action
+'''
+class EventWatcher:
+
+    def __init__(self, swarm, retry_interval=1.0):
+        self.swarm = swarm
+        self.since = None
+        self.retry_interval = retry_interval
+        self.stream = None
+        self.handled = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # Only events from now on are needed, the current state
+        # was read when the swarm object was created
+        if self.since is None:
+            self.since = int(time.time())
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            stream = self.stream
+        if stream is not None:
+            stream.close()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                stream = self.swarm.manager_conn.events(since=self.since, filters=EVENT_FILTERS,
+                                                        decode=True)
+                with self.lock:
+                    self.stream = stream
+                for event in stream:
+                    if self.stop_event.is_set():
+                        break
+                    self.handle(event)
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+                print("Error: events stream failed: {}".format(e), file=sys.stderr)
+            self.stop_event.wait(self.retry_interval)
+
+    '''
+	Function:	handle
+
+	Description:	Apply one event to the swarm object. Events
+			may be seen twice after a reconnect, so every
+			update is idempotent.
+    '''
+    def handle(self, event):
+        event_type = event.get("Type")
+        action = event.get("Action")
+        actor_id = event.get("Actor", {}).get("ID")
+        if actor_id is None:
+            return
+
+        if event_type == "service":
+            if action == "create" and self.swarm.get_service_node(actor_id) is not None:
+                # Created by this manager and already tracked
+                pass
+            elif action in ("create", "update"):
+                self.service_changed(actor_id)
+            elif action == "remove":
+                self.service_removed(actor_id)
+        elif event_type == "node":
+            if action in ("create", "update"):
+                node = self.swarm.inspect_node(actor_id)
+                if node is not None:
+                    self.swarm.node_registry.add(node)
+            elif action == "remove":
+                self.swarm.node_registry.remove(actor_id)
+
+        key = "{}.{}".format(event_type, action)
+        self.handled[key] = self.handled.get(key, 0) + 1
+        if "time" in event:
+            self.since = max(self.since or 0, event["time"])
+
+    def service_changed(self, service_id):
+        service_info = self.swarm.get_service_info(service_id)
+        if service_info is None:
+            return
+        record = self.swarm.parse_service(service_info)
+        if record is None:
+            return
+        tracked = self.swarm.services.get(service_id)
+        if tracked is not None and (tracked.ip, tracked.port) != (record.ip, record.port):
+            # Moved to another node or port, release the old one
+            self.swarm.untrack_service(service_id)
+        self.swarm.track_service(record)
+
+    def service_removed(self, service_id):
+        # The service is gone, so its port can only be known from
+        # what this manager tracked for it
+        self.swarm.untrack_service(service_id)
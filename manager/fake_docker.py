@@ -0,0 +1,447 @@
+import time
+import itertools
+import threading
+import docker
+import swarm
+
+'''
+	In-memory stand-in for the subset of docker.APIClient used by
+	DockerSwarm, for benchmarks and tests that run without a
+	Docker daemon or access points.
+
+	A FakeSwarm holds the state shared by a FakeManagerClient
+	(the manager's local connection) and one FakeNodeClient per
+	access point. Every service placed on a node runs one fake
+	container whose CPU and memory use is taken from the
+	per-image costs of the FakeSwarm.
+'''
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+# Address of the manager of fake fleets
+MANAGER_IP = "10.255.255.254"
+
+'''
+	Class: FakeSwarm
+
+	Member Variables:
+		nodes:
+			Dictionary mapping swarm node id to node
+			dictionary, as returned by APIClient.nodes
+		services:
+			Dictionary mapping service id to service
+			dictionary, as returned by APIClient.services
+		containers:
+			Dictionary mapping swarm node id to a dictionary
+			mapping container id to (service id, image,
+			cpu cores, memory bytes)
+		images:
+			Dictionary mapping swarm node id to the set of
+			images present on the node
+		image_costs:
+			Dictionary mapping image name to the (cpu cores,
+			memory bytes) a container of it uses
+		event_log:
+			List of the events emitted so far, in the
+			format of APIClient.events(decode=True)
+'''
+class FakeSwarm:
+
+    def __init__(self, image_costs=None, default_cost=(0.25, 64 * MB)):
+        self.nodes = {}
+        self.services = {}
+        self.containers = {}
+        self.images = {}
+        self.image_costs = image_costs or {}
+        self.default_cost = default_cost
+        self.join_token = "SWMTKN-fake"
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+        self.event_log = []
+        self.event_cond = threading.Condition(self.lock)
+        self.initialized = False
+        # While set, changes emit no events, e.g. to set up the
+        # state a recorded event stream is replayed against
+        self.silent = False
+
+    def next_id(self, prefix):
+        return "{}{:06d}".format(prefix, next(self.ids))
+
+    '''
+	Function:	emit
+
+	Description:	Append an event to the event log and wake up
+			the event streams.
+    '''
+    def emit(self, event_type, action, actor_id, attributes=None):
+        self.replay([{
+            "Type": event_type,
+            "Action": action,
+            "Actor": {"ID": actor_id, "Attributes": attributes or {}},
+            "scope": "swarm",
+        }])
+
+    '''
+	Function:	replay
+
+	Description:	Append recorded events to the event log as if
+			the daemon emitted them now. The fake state is
+			not changed, so it should be set up to match
+			the recording.
+    '''
+    def replay(self, events):
+        now = time.time()
+        with self.event_cond:
+            if self.silent:
+                return
+            for event in events:
+                self.event_log.append(dict(event, time=int(now), timeNano=int(now * 10 ** 9)))
+            self.event_cond.notify_all()
+
+    '''
+	Function:	set_node_state
+
+	Description:	Change the state ("ready", "down") of the node
+			with IP ip, as when an access point loses power.
+    '''
+    def set_node_state(self, ip, state):
+        with self.lock:
+            node = self.node_by_ip(ip)
+            old = node["Status"]["State"]
+            node["Status"]["State"] = state
+        self.emit("node", "update", node["ID"], {"state.old": old, "state.new": state})
+
+    # Nodes join from several threads at once, see run_parallel
+    def add_node(self, ip, ncpu=4, memory=1 * GB):
+        node_id = self.next_id("node")
+        with self.lock:
+            self.nodes[node_id] = {
+                "ID": node_id,
+                "Spec": {"Role": "worker", "Availability": "active"},
+                "Description": {"Resources": {"NanoCPUs": ncpu * 10 ** 9, "MemoryBytes": memory}},
+                "Status": {"State": "ready", "Addr": ip},
+            }
+            self.containers[node_id] = {}
+            self.images[node_id] = set()
+        self.emit("node", "create", node_id, {"name": ip})
+        return node_id
+
+    def node_by_ip(self, ip):
+        with self.lock:
+            for node in self.nodes.values():
+                if node["Status"]["Addr"] == ip:
+                    return node
+        return None
+
+class FakeManagerClient:
+
+    def __init__(self, fake_swarm):
+        self.swarm = fake_swarm
+
+    def init_swarm(self, advertise_addr=None, **kwargs):
+        if self.swarm.initialized:
+            raise docker.errors.APIError("This node is already part of a swarm")
+        self.swarm.initialized = True
+        return "swarm-fake"
+
+    def inspect_swarm(self):
+        return {"ID": "swarm-fake", "JoinTokens": {"Worker": self.swarm.join_token}}
+
+    def leave_swarm(self, force=False):
+        self.swarm.initialized = False
+        return True
+
+    def nodes(self, filters=None):
+        with self.swarm.lock:
+            nodes = list(self.swarm.nodes.values())
+        if filters and "role" in filters:
+            nodes = [n for n in nodes if n["Spec"]["Role"] == filters["role"]]
+        return nodes
+
+    def inspect_node(self, node_id):
+        with self.swarm.lock:
+            if node_id not in self.swarm.nodes:
+                raise docker.errors.NotFound("node {} not found".format(node_id))
+            return self.swarm.nodes[node_id]
+
+    def remove_node(self, node_id, force=False):
+        with self.swarm.lock:
+            if self.swarm.nodes.pop(node_id, None) is None:
+                raise docker.errors.NotFound("node {} not found".format(node_id))
+            self.swarm.containers.pop(node_id, None)
+            self.swarm.images.pop(node_id, None)
+        self.swarm.emit("node", "remove", node_id)
+        return True
+
+    def create_service(self, task_template, name=None, labels=None, mode=None,
+                       update_config=None, networks=None, endpoint_config=None,
+                       endpoint_spec=None, rollback_config=None):
+        constraints = task_template.get("Placement", {}).get("Constraints") or []
+        node_id = None
+        for constraint in constraints:
+            if constraint.startswith("node.id=="):
+                node_id = constraint[len("node.id=="):]
+        with self.swarm.lock:
+            if node_id not in self.swarm.nodes:
+                raise docker.errors.APIError("no suitable node for constraint {}".format(constraints))
+            service_id = self.swarm.next_id("svc")
+            spec = {"Name": name or service_id,
+                    "Labels": labels or {},
+                    "TaskTemplate": dict(task_template),
+                    "EndpointSpec": dict(endpoint_spec or {})}
+            self.swarm.services[service_id] = {
+                "ID": service_id,
+                "Version": {"Index": 1},
+                "Spec": spec,
+                "Endpoint": {"Spec": dict(endpoint_spec or {}),
+                             "Ports": (endpoint_spec or {}).get("Ports", [])},
+            }
+            image = task_template["ContainerSpec"]["Image"]
+            cost = self.swarm.image_costs.get(image, self.swarm.default_cost)
+            self.swarm.containers[node_id][self.swarm.next_id("ctr")] = (service_id, image) + tuple(cost)
+            # The node pulls the image to run the container
+            self.swarm.images[node_id].add(image)
+        self.swarm.emit("service", "create", service_id, {"name": spec["Name"]})
+        return {"ID": service_id}
+
+    def inspect_service(self, service, insert_defaults=None):
+        if service not in self.swarm.services:
+            raise docker.errors.NotFound("service {} not found".format(service))
+        return self.swarm.services[service]
+
+    def remove_service(self, service):
+        with self.swarm.lock:
+            if self.swarm.services.pop(service, None) is None:
+                raise docker.errors.NotFound("service {} not found".format(service))
+            for containers in self.swarm.containers.values():
+                for container_id, container in list(containers.items()):
+                    if container[0] == service:
+                        del containers[container_id]
+        self.swarm.emit("service", "remove", service)
+        return True
+
+    def update_service(self, service, version, task_template=None, name=None,
+                       labels=None, endpoint_spec=None, fetch_current_spec=False, **kwargs):
+        with self.swarm.lock:
+            if service not in self.swarm.services:
+                raise docker.errors.NotFound("service {} not found".format(service))
+            service_info = self.swarm.services[service]
+            if version != service_info["Version"]["Index"]:
+                raise docker.errors.APIError("update out of sequence")
+            if labels is not None:
+                service_info["Spec"]["Labels"] = dict(labels)
+            service_info["Version"]["Index"] += 1
+        self.swarm.emit("service", "update", service)
+        return {"Warnings": None}
+
+    def events(self, since=None, until=None, filters=None, decode=None):
+        return FakeEventStream(self.swarm, since, filters)
+
+    def services(self, filters=None):
+        with self.swarm.lock:
+            return list(self.swarm.services.values())
+
+    def tasks(self, filters=None):
+        # Services start at once: one running task per service
+        service_ids = (filters or {}).get("service")
+        if isinstance(service_ids, str):
+            service_ids = [service_ids]
+        return [{"ID": "task-" + service_id, "ServiceID": service_id,
+                 "Status": {"State": "running", "Message": "started"}}
+                for service_id in list(self.swarm.services.keys())
+                if service_ids is None or service_id in service_ids]
+
+'''
+	Class: FakeEventStream
+
+	Iterates over the events of a FakeSwarm from time since on,
+	blocking for new ones until closed, like the stream returned
+	by APIClient.events.
+'''
+class FakeEventStream:
+
+    def __init__(self, fake_swarm, since=None, filters=None):
+        self.swarm = fake_swarm
+        self.types = (filters or {}).get("type")
+        self.closed = False
+        with self.swarm.lock:
+            self.position = 0
+            if since is not None:
+                while (self.position < len(self.swarm.event_log) and
+                       self.swarm.event_log[self.position]["time"] < since):
+                    self.position += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.swarm.event_cond:
+            while True:
+                if self.closed:
+                    raise StopIteration
+                if self.position < len(self.swarm.event_log):
+                    event = self.swarm.event_log[self.position]
+                    self.position += 1
+                    if self.types is None or event["Type"] in self.types:
+                        return event
+                else:
+                    self.swarm.event_cond.wait()
+
+    def close(self):
+        with self.swarm.event_cond:
+            self.closed = True
+            self.swarm.event_cond.notify_all()
+
+class FakeNodeClient:
+
+    def __init__(self, fake_swarm, ip, ncpu, memory):
+        self.swarm = fake_swarm
+        self.ip = ip
+        self.ncpu = ncpu
+        self.memory = memory
+
+    def node_id(self):
+        node = self.swarm.node_by_ip(self.ip)
+        return node["ID"] if node else None
+
+    def join_swarm(self, remote_addrs, join_token, **kwargs):
+        if join_token != self.swarm.join_token:
+            raise docker.errors.APIError("invalid join token")
+        if self.node_id() is None:
+            self.swarm.add_node(self.ip, self.ncpu, self.memory)
+        return True
+
+    def leave_swarm(self, force=False):
+        return True
+
+    def info(self):
+        return {"NCPU": self.ncpu, "MemTotal": self.memory}
+
+    def version(self):
+        return {"Version": "fake"}
+
+    def images(self):
+        images = self.swarm.images.get(self.node_id(), set())
+        return [{"Id": image, "RepoTags": [image]} for image in sorted(images)]
+
+    def pull(self, repository, tag=None, **kwargs):
+        node_id = self.node_id()
+        if node_id is None:
+            raise docker.errors.APIError("node {} is not in the swarm".format(self.ip))
+        self.swarm.images[node_id].add("{}:{}".format(repository, tag or "latest"))
+        return ""
+
+    def containers(self, all=False, **kwargs):
+        containers = self.swarm.containers.get(self.node_id(), {})
+        return [{"Id": container_id, "Image": container[1], "State": "running",
+                 "Labels": {"com.docker.swarm.service.id": container[0]}}
+                for container_id, container in list(containers.items())]
+
+    def stats(self, container, decode=None, stream=True):
+        containers = self.swarm.containers.get(self.node_id(), {})
+        if container not in containers:
+            raise docker.errors.NotFound("container {} not found".format(container))
+        (_, _, cpu, memory) = containers[container]
+        # One second of system time across all CPUs between samples
+        system_delta = self.ncpu * 10 ** 9
+        return {
+            "cpu_stats": {"cpu_usage": {"total_usage": int(cpu * 10 ** 9)},
+                          "system_cpu_usage": 2 * system_delta,
+                          "online_cpus": self.ncpu},
+            "precpu_stats": {"cpu_usage": {"total_usage": 0},
+                             "system_cpu_usage": system_delta},
+            "memory_stats": {"usage": memory, "limit": self.memory},
+            "networks": {"eth0": {"rx_bytes": 0, "tx_bytes": 0}},
+        }
+
+'''
+	Class: FaultInjector
+
+	Wraps a fake client and makes chosen methods fail, e.g. to
+	simulate an access point that lost power. A failing call
+	waits delay seconds, like a connection attempt timing out,
+	then raises error; it fails times times, or until heal is
+	called if times is None.
+'''
+class FaultInjector:
+
+    def __init__(self, client):
+        self.client = client
+        self.faults = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def fail(self, method="*", times=None, error=ConnectionError, delay=0.0):
+        with self.lock:
+            self.faults[method] = [times, error, delay]
+
+    def heal(self):
+        with self.lock:
+            self.faults.clear()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                fault = self.faults.get(name) or self.faults.get("*")
+                if fault is not None and fault[0] is not None:
+                    fault[0] -= 1
+                    if fault[0] < 0:
+                        fault = None
+            if fault is not None:
+                time.sleep(fault[2])
+                raise fault[1]("injected failure of {}".format(name))
+            return attribute(*args, **kwargs)
+        return call
+
+'''
+	Function:	create_fake_fleet
+
+	Description:	Return a (FakeSwarm, FakeManagerClient,
+			managed nodes dictionary) tuple for a fleet of
+			num_nodes access points, ready to be passed to
+			DockerSwarm.
+'''
+def create_fake_fleet(num_nodes, ncpu=4, memory=1 * GB, image_costs=None):
+    fake_swarm = FakeSwarm(image_costs=image_costs)
+    managed_nodes = {}
+    for i in range(num_nodes):
+        ip = "10.{}.{}.1".format(i // 256, i % 256)
+        managed_nodes[ip] = FakeNodeClient(fake_swarm, ip, ncpu, memory)
+    return (fake_swarm, FakeManagerClient(fake_swarm), managed_nodes)
+
+'''
+	Function:	create_fake_swarm
+
+	Description:	Return a (FakeSwarm, DockerSwarm, managed nodes
+			dictionary) tuple: a DockerSwarm managing a fake
+			fleet of num_nodes access points. The node
+			clients are passed through wrap first, if given,
+			e.g. to inject faults; the dictionary holds them
+			as wrapped. Other keyword arguments go to
+			DockerSwarm.
+'''
+def create_fake_swarm(num_nodes=2, wrap=None, ncpu=4, memory=1 * GB, image_costs=None, **kwargs):
+    (fake_swarm, manager_conn, managed_nodes) = create_fake_fleet(num_nodes, ncpu, memory, image_costs)
+    if wrap is not None:
+        managed_nodes = {ip: wrap(client) for ip, client in managed_nodes.items()}
+    swarm_obj = swarm.DockerSwarm(None, manager_ip=MANAGER_IP, managed_nodes=dict(managed_nodes),
+                                  manager_conn=manager_conn, **kwargs)
+    return (fake_swarm, swarm_obj, managed_nodes)
+
+'''
+	Function:	create_other_swarm
+
+	Description:	Return a DockerSwarm managing no access points
+			on its own connection to the manager of
+			fake_swarm, to change the swarm behind the back
+			of the DockerSwarm under test.
+'''
+def create_other_swarm(fake_swarm):
+    return swarm.DockerSwarm(None, manager_ip=MANAGER_IP, managed_nodes={},
+                             manager_conn=FakeManagerClient(fake_swarm))
@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import threading
+import docker
+import metrics
+
+'''
+	Connections to the access points of the fleet.
+
+	The manager used to open a Docker connection to every access
+	point in the config when it started and keep them all open.
+	Each access point now gets a LazyClient instead, which opens
+	its connection on the first call made through it. A
+	ClientPool closes the connections that have not been used
+	for a while, and the least recently used ones when more than
+	max_open are open; the next call opens a new one.
+
+	A ConfigWatcher notices when the config file changes, so the
+	manager can pick up access points added to or removed from
+	it without restarting.
+'''
+
+OPENED = metrics.counter("edgeap_remote_connections_opened_total",
+                         "Connections opened to access points", ("node",))
+EVICTED = metrics.counter("edgeap_remote_connections_evicted_total",
+                          "Connections to access points closed by the pool", ("node",))
+
+'''
+	Class: LazyClient
+
+	Member Variables:
+		factory:
+			Function returning a new Docker API client for
+			the node, or None if it can not connect
+		node:
+			IP of the node
+		client:
+			The open client, or None until the next call
+		last_used:
+			Time of the last call
+		on_open:
+			Function called with the LazyClient once it has
+			opened its client
+'''
+class LazyClient:
+
+    def __init__(self, factory, node, on_open=None):
+        self.factory = factory
+        self.node = node
+        self.on_open = on_open
+        self.client = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        # Connect when the method is called rather than looked up,
+        # so connection errors are raised by the call
+        def call(*args, **kwargs):
+            return getattr(self.connect(), name)(*args, **kwargs)
+        return call
+
+    '''
+	Function:	connect
+
+	Description:	Return the node's client, opening it if it is
+			not open. Raise ConnectionError if it can not be
+			opened.
+    '''
+    def connect(self):
+        opened = False
+        with self.lock:
+            self.last_used = time.monotonic()
+            if self.client is None:
+                try:
+                    self.client = self.factory()
+                except (docker.errors.DockerException, OSError) as e:
+                    raise ConnectionError("could not connect to {}: {}".format(self.node, e)) from e
+                if self.client is None:
+                    raise ConnectionError("could not connect to {}".format(self.node))
+                opened = True
+            client = self.client
+        if opened:
+            OPENED.inc(self.node)
+            if self.on_open is not None:
+                self.on_open(self)
+        return client
+
+    def is_open(self):
+        return self.client is not None
+
+    '''
+	Function:	reconfigure
+
+	Description:	Close the client and open the next one with
+			factory, e.g. once the node's port or
+			certificates changed in the config.
+    '''
+    def reconfigure(self, factory):
+        with self.lock:
+            self.factory = factory
+        self.close()
+
+    def close(self):
+        with self.lock:
+            client = self.client
+            self.client = None
+        if client is None:
+            return False
+        # A caller still holding the client can keep using it,
+        # docker.APIClient reconnects after close
+        try:
+            if hasattr(client, "close"):
+                client.close()
+        except Exception as e:
+            print("Error: closing connection to {}: {}".format(self.node, e), file=sys.stderr)
+        return True
+
+'''
+	Class: ClientPool
+
+	Member Variables:
+		idle_timeout:
+			Seconds a connection may go unused before it is
+			closed, or None to keep it open
+		max_open:
+			Number of connections kept open at most, or None
+			for no limit
+		interval:
+			Seconds between two checks for idle connections
+		clients:
+			Dictionary mapping node IP to its LazyClient
+		stats:
+			Counters of connections opened and evicted
+'''
+class ClientPool:
+
+    def __init__(self, idle_timeout=300, max_open=None, interval=30):
+        self.idle_timeout = idle_timeout
+        self.max_open = max_open
+        self.interval = interval
+        self.clients = {}
+        self.stats = {"opened": 0, "evicted": 0}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    '''
+	Function:	add
+
+	Description:	Return a new LazyClient for the node with IP
+			server_ip, opening its connections with factory.
+    '''
+    def add(self, server_ip, factory):
+        client = LazyClient(factory, server_ip, self.opened)
+        with self.lock:
+            old = self.clients.get(server_ip)
+            self.clients[server_ip] = client
+        if old is not None:
+            old.close()
+        return client
+
+    def get(self, server_ip):
+        with self.lock:
+            return self.clients.get(server_ip)
+
+    def remove(self, server_ip):
+        with self.lock:
+            client = self.clients.pop(server_ip, None)
+        if client is not None:
+            client.close()
+
+    def start(self):
+        if self.idle_timeout is None:
+            return
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.evict_idle()
+
+    '''
+	Function:	opened
+
+	Description:	Count a connection opened and, if more than
+			max_open are open, close the least recently
+			used others.
+    '''
+    def opened(self, client):
+        with self.lock:
+            self.stats["opened"] += 1
+            if self.max_open is None:
+                return
+            others = sorted((c for c in self.clients.values() if c is not client and c.is_open()),
+                            key=lambda c: c.last_used)
+            excess = others[:max(len(others) + 1 - self.max_open, 0)]
+        for other in excess:
+            self.evict(other)
+
+    '''
+	Function:	evict_idle
+
+	Description:	Close the connections unused for idle_timeout
+			seconds. Return the number closed.
+    '''
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [c for c in self.clients.values() if c.is_open() and c.last_used < deadline]
+        return sum(1 for client in idle if self.evict(client))
+
+    def evict(self, client):
+        if not client.close():
+            return False
+        EVICTED.inc(client.node)
+        with self.lock:
+            self.stats["evicted"] += 1
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["nodes"] = len(self.clients)
+            stats["open"] = sum(1 for client in self.clients.values() if client.is_open())
+        return stats
+
+'''
+	Class: ConfigWatcher
+
+	Member Variables:
+		path:
+			Path of the config file
+		callback:
+			Function called once the file changed
+		enabled:
+			If False, the file is not watched
+		interval:
+			Seconds between two checks of the file
+'''
+class ConfigWatcher:
+
+    def __init__(self, path, callback, enabled=True, interval=5):
+        self.path = path
+        self.callback = callback
+        self.enabled = enabled
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.signature = self.stat()
+
+    def start(self):
+        if not self.enabled:
+            return
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    '''
+	Function:	check
+
+	Description:	Call callback if the file's modification time
+			or size changed since the last check. Return
+			True if it did.
+    '''
+    def check(self):
+        signature = self.stat()
+        if signature == self.signature or signature is None:
+            return False
+        self.signature = signature
+        try:
+            self.callback()
+        except Exception as e:
+            print("Error: reloading {} failed: {}".format(self.path, e), file=sys.stderr)
+        return True
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
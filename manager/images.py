@@ -0,0 +1,208 @@
+import threading
+import collections
+import concurrent.futures
+import swarm as swarm_module
+
+'''
+	Tracking of the images present on each access point.
+
+	Pulling an image over an access point's uplink dominates the
+	first deploy of that image on it. The ImageCache keeps the
+	set of images each node holds, refreshed in the background
+	with the node's remote connection, and pre-pulls configured
+	and frequently requested images to every node so that
+	deploys find them already there.
+'''
+
+'''
+	Class: ImageCache
+
+	Member Variables:
+		swarm:
+			DockerSwarm object whose nodes are tracked
+		refresh_interval:
+			Seconds between two refreshes of the image lists
+		prepull:
+			List of images pulled to every node
+		popular_threshold:
+			Images deployed at least this many times are
+			pulled to every node as well (None to disable)
+		prefer_cached:
+			If True, placement prefers nodes that already
+			hold the requested image
+		images:
+			Dictionary mapping IP of managed nodes to the
+			set of (normalized) image names they hold
+		deploys:
+			Counter of deploy requests per image
+		pulling:
+			Set of (node IP, image) pulls in progress
+'''
+class ImageCache:
+
+    def __init__(self, swarm, refresh_interval=60, prepull=None, popular_threshold=None,
+                 prefer_cached=True, pull_workers=2):
+        self.swarm = swarm
+        self.refresh_interval = refresh_interval
+        self.prepull = [swarm_module.image_name(image) for image in (prepull or [])]
+        self.popular_threshold = popular_threshold
+        self.prefer_cached = prefer_cached
+        self.images = {}
+        self.deploys = collections.Counter()
+        self.pulling = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=pull_workers,
+                                                              thread_name_prefix="edgeap-pull")
+        self.stats = {"hits": 0, "misses": 0, "pulls": 0, "pull_failures": 0}
+
+    def start(self):
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
+
+    def refresh_loop(self):
+        while not self.stop_event.is_set():
+            self.refresh()
+            self.prepull_images()
+            self.stop_event.wait(self.refresh_interval)
+
+    '''
+	Function:	refresh
+
+	Description:	List the images held by every node.
+			Nodes that can not be queried keep their
+			previous list.
+    '''
+    def refresh(self):
+        ips = list(self.swarm.nodes.keys())
+        if not ips:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ips), 16)) as pool:
+            listings = dict(zip(ips, pool.map(self.list_images, ips)))
+
+        with self.lock:
+            for ip, listing in listings.items():
+                if listing is None:
+                    continue
+                self.images[ip] = listed_images(listing, self.images.get(ip, set()))
+
+    '''
+	Function:	prepull_images
+
+	Description:	Pull the configured and the popular images to
+			every node that does not hold them yet.
+    '''
+    def prepull_images(self):
+        with self.lock:
+            wanted = set(self.prepull)
+            if self.popular_threshold is not None:
+                wanted |= {image for image, count in self.deploys.items()
+                           if count >= self.popular_threshold}
+        for image in wanted:
+            for ip in list(self.swarm.nodes.keys()):
+                if not self.swarm.is_node_draining(ip):
+                    self.schedule_pull(ip, image)
+
+    def schedule_pull(self, server_ip, image):
+        with self.lock:
+            if image in self.images.get(server_ip, ()) or (server_ip, image) in self.pulling:
+                return
+            self.pulling.add((server_ip, image))
+        self.executor.submit(self.pull, server_ip, image)
+
+    def list_images(self, server_ip):
+        # The node may have been drained since the listing started
+        client = self.swarm.nodes.get(server_ip)
+        return swarm_module.get_images(client) if client is not None else None
+
+    def pull(self, server_ip, image):
+        client = self.swarm.nodes.get(server_ip)
+        resp = swarm_module.pull_image(client, image) if client is not None else None
+        with self.lock:
+            self.pulling.discard((server_ip, image))
+            if resp is None:
+                self.stats["pull_failures"] += 1
+                return
+            self.stats["pulls"] += 1
+            self.images.setdefault(server_ip, set()).add(image)
+
+    '''
+	Function:	nodes_with
+
+	Description:	Return the set of node IPs holding image.
+    '''
+    def nodes_with(self, image):
+        image = swarm_module.image_name(image)
+        with self.lock:
+            return {ip for ip, images in self.images.items() if image in images}
+
+    '''
+	Function:	preferred_nodes
+
+	Description:	Return the set of node IPs placement should
+			prefer for request.
+    '''
+    def preferred_nodes(self, request):
+        if not self.prefer_cached:
+            return set()
+        return self.nodes_with(request["image"])
+
+    def holds(self, server_ip, image):
+        image = swarm_module.image_name(image)
+        with self.lock:
+            return image in self.images.get(server_ip, ())
+
+    '''
+	Function:	record_deploy
+
+	Description:	Record a successful deploy of image on the node
+			with IP server_ip; cached tells whether the node
+			held the image beforehand, as from holds. The
+			node holds it from now on, since the swarm
+			pulled it to run the service.
+    '''
+    def record_deploy(self, server_ip, image, cached):
+        image = swarm_module.image_name(image)
+        with self.lock:
+            self.deploys[image] += 1
+            self.images.setdefault(server_ip, set()).add(image)
+            self.stats["hits" if cached else "misses"] += 1
+            popular = (self.popular_threshold is not None and
+                       self.deploys[image] == self.popular_threshold)
+        if popular:
+            for ip in list(self.swarm.nodes.keys()):
+                self.schedule_pull(ip, image)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["nodes"] = {ip: len(images) for ip, images in self.images.items()}
+        return stats
+
+'''
+	Function:	listed_images
+
+	Description:	Return the set of (normalized) image names in a
+			listing of a node's images, as from
+			APIClient.images. known is the set the node was
+			known to hold before.
+'''
+def listed_images(listing, known):
+    names = set()
+    for image in listing:
+        tags = [tag for tag in (image.get("RepoTags") or []) if tag != "<none>:<none>"]
+        names.update(swarm_module.image_name(tag) for tag in tags)
+        if tags:
+            continue
+        # The swarm pulls the image of a service by digest, which
+        # often leaves it without a tag: keep the tags of its
+        # repository known from deploys, or else its default tag
+        for digest in image.get("RepoDigests") or []:
+            name = swarm_module.image_name(digest)
+            repository = name.rsplit(":", 1)[0]
+            tagged = {known_name for known_name in known if known_name.rsplit(":", 1)[0] == repository}
+            names.update(tagged or {name})
+    return names
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import threading
+
+'''
+	Persistence of the manager's state across restarts.
+
+	Every change to the tracked services is appended to a
+	journal file as one JSON line, and the whole state is
+	periodically written to a snapshot file. A restarted
+	manager loads the snapshot and replays the journal entries
+	written after it instead of listing every service of the
+	swarm, then reconciles with the swarm in the background.
+
+	Entries carry increasing sequence numbers; a snapshot
+	records the sequence number of the last entry it includes.
+	Taking a snapshot first moves the journal aside, so entries
+	appended while the snapshot is written go to a new journal.
+'''
+
+'''
+	Class: Journal
+
+	Member Variables:
+		path:
+			Path prefix of the files: <path>.snapshot,
+			<path>.journal, and <path>.journal.old while a
+			snapshot is written
+		fsync:
+			If True, every entry is synced to disk before
+			append returns, so it survives a power loss and
+			not just a crash of the manager
+		seq:
+			Sequence number of the last entry
+		entries:
+			Number of entries since the last snapshot
+'''
+class Journal:
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.journal_path = path + ".journal"
+        self.old_path = self.journal_path + ".old"
+        self.fsync = fsync
+        self.seq = 0
+        self.entries = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    '''
+	Function:	load
+
+	Description:	Return (state, entries): the state of the last
+			snapshot (None if there is none) and the list of
+			journal entries written after it, in order.
+    '''
+    def load(self):
+        state = read_json(self.snapshot_path)
+        seq = state.get("seq", 0) if state else 0
+        entries = [entry for path in (self.old_path, self.journal_path)
+                   for entry in read_lines(path)
+                   if entry.get("seq", 0) > seq]
+        with self.lock:
+            self.seq = max([seq] + [entry["seq"] for entry in entries])
+            self.entries = len(entries)
+        return (state, entries)
+
+    '''
+	Function:	append
+
+	Description:	Append an entry (a dictionary) to the journal.
+			Return False if it could not be written.
+    '''
+    def append(self, entry):
+        with self.lock:
+            self.seq += 1
+            entry = dict(entry, seq=self.seq)
+            try:
+                if self.file is None:
+                    self.open()
+                self.file.write(json.dumps(entry) + "\n")
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+            except OSError as e:
+                print("Error: could not write to journal {}: {}".format(self.journal_path, e),
+                      file=sys.stderr)
+                return False
+            self.entries += 1
+            return True
+
+    def open(self):
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.journal_path, "a")
+
+    '''
+	Function:	rotate
+
+	Description:	Move the journal aside, so that a snapshot of
+			the state up to now can be written while new
+			entries go to a new journal. Return the sequence
+			number of the last entry moved aside.
+    '''
+    def rotate(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            try:
+                if os.path.exists(self.old_path):
+                    # The last snapshot failed, keep its entries
+                    with open(self.journal_path, "a+") as journal, open(self.old_path, "a") as old:
+                        journal.seek(0)
+                        old.write(journal.read())
+                    os.remove(self.journal_path)
+                elif os.path.exists(self.journal_path):
+                    os.replace(self.journal_path, self.old_path)
+            except OSError as e:
+                print("Error: could not rotate journal {}: {}".format(self.journal_path, e),
+                      file=sys.stderr)
+            self.entries = 0
+            return self.seq
+
+    '''
+	Function:	write_snapshot
+
+	Description:	Write state, which includes every entry up to
+			sequence number seq, as the new snapshot and drop
+			the journal moved aside by rotate. Return True on
+			success.
+    '''
+    def write_snapshot(self, state, seq):
+        state = dict(state, seq=seq)
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if os.path.exists(self.old_path):
+                os.remove(self.old_path)
+        except OSError as e:
+            print("Error: could not write snapshot {}: {}".format(self.snapshot_path, e),
+                  file=sys.stderr)
+            return False
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+'''
+	Class: SnapshotWriter
+
+	Member Variables:
+		swarm:
+			DockerSwarm object whose state is saved
+		interval:
+			Seconds between two snapshots
+		max_entries:
+			A snapshot is also taken once the journal holds
+			this many entries, to bound the replay on restart
+'''
+class SnapshotWriter:
+
+    def __init__(self, swarm, interval=60, max_entries=10000):
+        self.swarm = swarm
+        self.interval = interval
+        self.max_entries = max_entries
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.swarm.journal is None:
+            return
+        threading.Thread(target=self.run, daemon=True).start()
+
+    '''
+	Function:	stop
+
+	Description:	Stop taking snapshots and take a last one, so
+			that the next start has no journal to replay.
+    '''
+    def stop(self):
+        if self.swarm.journal is None:
+            return
+        self.stop_event.set()
+        self.swarm.save_snapshot()
+        self.swarm.journal.close()
+
+    def run(self):
+        elapsed = 0
+        while not self.stop_event.wait(1):
+            elapsed += 1
+            if elapsed >= self.interval or self.swarm.journal.entries >= self.max_entries:
+                if self.swarm.journal.entries:
+                    self.swarm.save_snapshot()
+                elapsed = 0
+
+'''
+	Function:	read_json
+
+	Description:	Return the JSON document in the file at path,
+			or None if it is missing or can not be parsed.
+'''
+def read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print("Error: could not read {}: {}".format(path, e), file=sys.stderr)
+        return None
+
+'''
+	Function:	read_lines
+
+	Description:	Return the entries of the journal file at
+			path. A line that can not be parsed, e.g. the
+			last one after a crash during a write, ends the
+			journal.
+'''
+def read_lines(path):
+    entries = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    print("Error: journal {} is truncated, ignoring the rest".format(path),
+                          file=sys.stderr)
+                    break
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print("Error: could not read {}: {}".format(path, e), file=sys.stderr)
+    return entries
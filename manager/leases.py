@@ -0,0 +1,366 @@
+import sys
+import time
+import math
+import heapq
+import secrets
+import threading
+import collections
+import swarm as swarm_module
+
+'''
+	Lease based lifetimes of deployed services.
+
+	A service deployed with a lease stays up only as long as its
+	client renews the lease with heartbeat requests. A client
+	that crashes, loses power or drops off the network stops
+	sending heartbeats, and once its lease expires a background
+	reaper removes the service, freeing the access point's CPU,
+	memory and port.
+
+	Each client of a shared instance holds a lease of its own,
+	the attachment lease "<service id>/<token>", and a client
+	whose attachment lease expires is detached from the
+	instance; the instance is only removed once its last client
+	is gone.
+
+	Leased services carry the label LEASE_LABEL=<ttl> so that a
+	restarted manager gives them a fresh lease instead of
+	keeping them forever. The clients of a shared instance keep
+	their attachment if they renew it within one TTL of the
+	restart, and the others are detached.
+'''
+
+LEASE_LABEL = "edgeap.lease"
+
+'''
+	Class: LeaseTable
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services run on
+		ttl:
+			Seconds a lease lasts without a heartbeat, or
+			None to grant leases only to requests that ask
+			for one with lease_ttl
+		reap_interval:
+			Seconds between two runs of the reaper
+		workers:
+			Number of expired services removed at once
+		cost:
+			Function returning the (cpu, memory) fraction of
+			an access point a service of an image uses, to
+			account for the resources reaping reclaimed
+		sharing:
+			SharedInstances the attachment leases detach
+			clients from, or None
+		leases:
+			Dictionary mapping lease id, the service id or
+			an attachment lease id, to (expiry, ttl)
+		attachments:
+			Dictionary mapping attachment lease id to the
+			service id of the shared instance
+		adopted:
+			Set of ids of the shared instances adopted after
+			a restart, whose clients are counted again once
+			their lease expires
+		expiries:
+			Heap of (expiry, lease id); entries of renewed
+			or released leases are skipped when popped
+		stats:
+			Counters of granted, renewed and reaped leases,
+			of the clients detached and of the resources
+			reclaimed by the reaper
+'''
+class LeaseTable:
+
+    def __init__(self, swarm, ttl=None, reap_interval=5, workers=8, cost=None, sharing=None):
+        self.swarm = swarm
+        self.ttl = parse_ttl(ttl) if ttl else None
+        self.reap_interval = reap_interval
+        self.workers = workers
+        self.cost = cost
+        self.sharing = sharing
+        self.leases = {}
+        self.attachments = {}
+        self.adopted = set()
+        self.expiries = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = {
+            "granted": 0,
+            "renewed": 0,
+            "reaped": 0,
+            "detached": 0,
+            "reap_failures": 0,
+            "ports_reclaimed": 0,
+            "cpu_reclaimed": 0.0,
+            "memory_reclaimed": 0.0,
+        }
+        self.reclaimed_images = collections.Counter()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.adopt()
+        while not self.stop_event.wait(self.reap_interval):
+            self.reap()
+
+    '''
+	Function:	lease_ttl
+
+	Description:	Return the lease TTL a deploy request gets,
+			or None if it is not leased. Raise ValueError
+			if the request's is not a positive number of
+			seconds.
+    '''
+    def lease_ttl(self, request):
+        ttl = request.get("lease_ttl", self.ttl)
+        return parse_ttl(ttl) if ttl is not None else None
+
+    def labels(self, ttl):
+        return {LEASE_LABEL: str(ttl)} if ttl else None
+
+    '''
+	Function:	adopt
+
+	Description:	Grant a fresh lease to the services labelled
+			as leased, e.g. after the manager restarted. The
+			lease of a shared instance lets its clients renew
+			their attachment leases until it expires.
+    '''
+    def adopt(self):
+        services = self.swarm.get_services()
+        for service in services or []:
+            ttl = service.get("Spec", {}).get("Labels", {}).get(LEASE_LABEL)
+            if ttl is None or self.swarm.services.get(service["ID"]) is None:
+                continue
+            try:
+                self.grant(service["ID"], parse_ttl(ttl))
+            except ValueError:
+                print("Error: service {} has an invalid lease {}".format(service["ID"], ttl),
+                      file=sys.stderr)
+                continue
+            if self.sharing is not None and self.sharing.is_shared(service["ID"]):
+                with self.lock:
+                    self.adopted.add(service["ID"])
+
+    def grant(self, service_id, ttl):
+        with self.lock:
+            self.set_expiry(service_id, ttl)
+            self.stats["granted"] += 1
+
+    '''
+	Function:	attach
+
+	Description:	Grant a lease to a client attaching to the
+			shared instance service_id. Return the id of the
+			attachment lease, which the client renews.
+    '''
+    def attach(self, service_id, ttl):
+        lease_id = "{}/{}".format(service_id, secrets.token_hex(8))
+        with self.lock:
+            self.attachments[lease_id] = service_id
+            self.set_expiry(lease_id, ttl)
+            self.stats["granted"] += 1
+        return lease_id
+
+    '''
+	Function:	renew
+
+	Description:	Extend the lease lease_id by its TTL. Return
+			the TTL, or None if there is no such lease.
+    '''
+    def renew(self, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                lease = self.readopt(lease_id)
+                if lease is None:
+                    return None
+            self.set_expiry(lease_id, lease[1])
+            self.stats["renewed"] += 1
+            return lease[1]
+
+    '''
+	Function:	readopt
+
+	Description:	Return the lease of an attachment made before
+			the manager restarted, taking the TTL of its
+			adopted shared instance, or None if lease_id is
+			not one. Called with the lock held.
+    '''
+    def readopt(self, lease_id):
+        if not isinstance(lease_id, str) or "/" not in lease_id:
+            return None
+        service_id = lease_id.rsplit("/", 1)[0]
+        if service_id not in self.adopted or service_id not in self.leases:
+            return None
+        self.attachments[lease_id] = service_id
+        return self.leases[service_id]
+
+    def release(self, lease_id):
+        with self.lock:
+            self.leases.pop(lease_id, None)
+            self.attachments.pop(lease_id, None)
+
+    '''
+	Function:	service_of
+
+	Description:	Return the id of the service the lease lease_id
+			keeps up, or None if there is no such lease.
+    '''
+    def service_of(self, lease_id):
+        with self.lock:
+            if lease_id not in self.leases:
+                return None
+            return self.attachments.get(lease_id, lease_id)
+
+    def attachment_count(self, service_id):
+        with self.lock:
+            return sum(1 for id in self.attachments.values() if id == service_id)
+
+    def ttl_of(self, service_id):
+        with self.lock:
+            lease = self.leases.get(service_id)
+            return lease[1] if lease is not None else None
+
+    '''
+	Function:	transfer
+
+	Description:	Move the lease of old_id to new_id, e.g. once
+			the service was moved to another node, with a
+			full TTL so its client has time to switch.
+			Return False if old_id has no lease.
+    '''
+    def transfer(self, old_id, new_id):
+        with self.lock:
+            lease = self.leases.pop(old_id, None)
+            if lease is None:
+                return False
+            self.set_expiry(new_id, lease[1])
+            return True
+
+    def set_expiry(self, lease_id, ttl, expiry=None):
+        if expiry is None:
+            expiry = time.monotonic() + ttl
+        self.leases[lease_id] = (expiry, ttl)
+        heapq.heappush(self.expiries, (expiry, lease_id))
+
+    '''
+	Function:	reap
+
+	Description:	Remove the services whose lease expired,
+			several at a time, and detach the clients whose
+			attachment lease expired from their shared
+			instance, removing it once its last client is
+			gone. Services that could not be removed are
+			retried on the next run.
+    '''
+    def reap(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self.expiries and self.expiries[0][0] <= now:
+                (expiry, lease_id) = heapq.heappop(self.expiries)
+                lease = self.leases.get(lease_id)
+                if lease is None or lease[0] != expiry:
+                    continue
+                del self.leases[lease_id]
+                service_id = self.attachments.pop(lease_id, lease_id)
+                adopted = lease_id in self.adopted
+                self.adopted.discard(lease_id)
+                expired.append((lease_id, service_id, lease[1], adopted))
+        if not expired:
+            return
+
+        # Services removed by other means need no reaping
+        leases = {}
+        shared = set()
+        for (lease_id, service_id, ttl, adopted) in expired:
+            if self.swarm.services.get(service_id) is None:
+                continue
+            if lease_id != service_id or adopted:
+                if adopted:
+                    clients = self.sharing.reconcile(service_id, self.attachment_count(service_id))
+                else:
+                    clients = self.sharing.detach(service_id) if self.sharing is not None else None
+                if clients is None:
+                    continue
+                if clients > 0:
+                    print("Detached a client of service {}, lease expired, {} left".format(service_id, clients))
+                    with self.lock:
+                        self.stats["detached"] += 1
+                    continue
+                shared.add(service_id)
+            leases[service_id] = (lease_id, ttl, adopted)
+        records = {service_id: self.swarm.services.get(service_id) for service_id in leases}
+        service_ids = [service_id for service_id, record in records.items() if record is not None]
+        results = swarm_module.run_parallel(
+            lambda service_id: self.swarm.remove_service(records[service_id].ip, service_id),
+            service_ids, self.workers, self.swarm.node_timeout, "reaping expired service")
+
+        for service_id in shared.intersection(service_ids):
+            if results.get(service_id) is True:
+                self.sharing.removed(service_id)
+            else:
+                self.sharing.restore(service_id)
+        with self.lock:
+            for service_id in service_ids:
+                record = records[service_id]
+                (lease_id, ttl, adopted) = leases[service_id]
+                if results.get(service_id) is True:
+                    if service_id in shared:
+                        self.stats["detached"] += 1
+                    print("Reaped service {} on {}, lease expired".format(service_id, record.ip))
+                    self.stats["reaped"] += 1
+                    self.stats["ports_reclaimed"] += 1
+                    self.reclaimed_images[record.image] += 1
+                    if self.cost is not None:
+                        (cpu, memory) = self.cost(record.image)
+                        self.stats["cpu_reclaimed"] += cpu
+                        self.stats["memory_reclaimed"] += memory
+                else:
+                    # Retry on the next run
+                    self.stats["reap_failures"] += 1
+                    self.set_expiry(lease_id, ttl, expiry=now)
+                    if lease_id != service_id:
+                        self.attachments[lease_id] = service_id
+                    if adopted:
+                        self.adopted.add(service_id)
+
+    '''
+	Function:	get_stats
+
+	Description:	Return the lease counters, the number of live
+			leases and the number of services reaped per
+			image.
+    '''
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["active"] = len(self.leases)
+            stats["reclaimed_images"] = dict(self.reclaimed_images)
+        return stats
+
+'''
+	Function:	parse_ttl
+
+	Description:	Return a lease TTL as a number of seconds.
+			Raise ValueError if it is not a positive finite
+			number, as a TTL of 0 would have the service
+			reaped as soon as it is deployed.
+'''
+def parse_ttl(ttl):
+    if isinstance(ttl, bool):
+        raise ValueError("lease_ttl must be a number of seconds")
+    try:
+        ttl = float(ttl)
+    except (TypeError, ValueError):
+        raise ValueError("lease_ttl must be a number of seconds")
+    if not math.isfinite(ttl) or ttl <= 0:
+        raise ValueError("lease_ttl must be positive")
+    return ttl
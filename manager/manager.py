@@ -1,45 +1,305 @@
 import swarm
+import protocol
+import placement
+import pool
+import images
+import events
+import journal
+import readiness
+import leases
+import sharing
+import admission
+import telemetry
+import metrics
+import fleet
+import rebalancer
 import selectors
 import socket
 import threading
-import json
 import types
+import sys
+import collections
+import time
+import asyncio
+import traceback
+import concurrent.futures
 
 request_server_str = "request_server"
 shutdown_server_str = "shutdown_server"
+async_server_str = "async_server"
+
+REQUEST_PORT = 60001
+SHUTDOWN_PORT = 60002
+
+# Number of requests the servers work on at once
+DEFAULT_WORKERS = 32
+# Largest number of deploys or teardowns in one batch request
+MAX_BATCH_SIZE = 1024
+
+CONNECTIONS = metrics.counter("edgeap_connections_accepted_total",
+                              "Client connections accepted", ("server",))
+ACCEPT_SECONDS = metrics.histogram("edgeap_accept_seconds",
+                                   "Time to accept a client connection and set it up for reading",
+                                   ("server",), buckets=(0.0001, 0.00025, 0.0005) + metrics.DEFAULT_BUCKETS)
+PARSE_SECONDS = metrics.histogram("edgeap_parse_seconds",
+                                  "Time spent decoding received data into requests")
+PARSE_ERRORS = metrics.counter("edgeap_parse_errors_total", "Received data that could not be decoded")
+REQUESTS = metrics.counter("edgeap_requests_total", "Requests answered by op and response code",
+                           ("op", "code"))
+REQUEST_SECONDS = metrics.histogram("edgeap_request_seconds", "Time to answer a request by op", ("op",))
+DEPLOY_PHASE_SECONDS = metrics.histogram("edgeap_deploy_phase_seconds",
+                                         "Time spent in each phase of a deploy", ("phase",))
+
+'''
+	Class: SocketChannel
+
+	Member Variables:
+		sock:
+			Client connection of the selector servers
+		decoder:
+			FrameDecoder of the connection
+		lock:
+			Lock held while writing to the connection, so
+			that responses and messages pushed from other
+			threads do not interleave, and while updating
+			the state below
+		pending:
+			Number of requests received on the connection
+			and not answered yet
+		backlog:
+			Requests of a legacy connection waiting for the
+			one being answered; their responses carry no
+			id, so they are answered in order
+		busy:
+			True while a worker answers the backlog
+		closed:
+			True once the client is done sending; the
+			connection is closed after its last response
+'''
+class SocketChannel:
+
+    def __init__(self, sock, decoder):
+        self.sock = sock
+        self.decoder = decoder
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.backlog = collections.deque()
+        self.busy = False
+        self.closed = False
+
+    '''
+	Function:	send
+
+	Description:	Push a message to the client. Return False if
+			the connection is gone.
+    '''
+    def send(self, message):
+        with self.lock:
+            try:
+                self.sock.sendall(self.decoder.encode(message))
+            except OSError as e:
+                print("Error: pushing to client: {}".format(e), file=sys.stderr)
+                return False
+        return True
+
+    '''
+	Function:	finish
+
+	Description:	Count a request as answered. Return True if it
+			was the last one of a connection the client is
+			done with, which should be closed now.
+    '''
+    def finish(self):
+        with self.lock:
+            self.pending -= 1
+            return self.closed and self.pending == 0
+
+    '''
+	Function:	close
+
+	Description:	Mark the client as done sending. Return True if
+			no request is left to answer, so the connection
+			should be closed now.
+    '''
+    def close(self):
+        with self.lock:
+            self.closed = True
+            return self.pending == 0
+
+'''
+	Class: StreamChannel
+
+	Member Variables:
+		writer:
+			StreamWriter of a client connection of the
+			asyncio server
+		decoder:
+			FrameDecoder of the connection
+		loop:
+			Event loop serving the connection; messages
+			are written from it
+'''
+class StreamChannel:
+
+    def __init__(self, writer, decoder, loop):
+        self.writer = writer
+        self.decoder = decoder
+        self.loop = loop
+
+    def send(self, message):
+        if self.writer.is_closing():
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.writer.write, self.decoder.encode(message))
+        except RuntimeError as e:
+            print("Error: pushing to client: {}".format(e), file=sys.stderr)
+            return False
+        return True
 
 class Manager:
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, workers=DEFAULT_WORKERS, docker_swarm=None):
         self.config_file = config_file
-        self.swarm = swarm.DockerSwarm(config_file)
+        # The swarm may be passed in instead of created from the
+        # config, e.g. to run against a fake Docker client
+        self.swarm = docker_swarm if docker_swarm is not None else swarm.DockerSwarm(config_file)
+        self.events = events.EventWatcher(self.swarm)
+        self.events.start()
+        config = swarm.load_config(config_file)
+        self.placer = placement.create_placer(self.swarm, config)
+        self.telemetry = telemetry.TelemetryCollector(self.swarm, **config.get("telemetry", {}))
+        if self.telemetry.enabled:
+            # The placer uses the collector's samples instead of taking its own
+            self.telemetry.subscribe(self.placer.update)
+            self.telemetry.start()
+        else:
+            self.placer.start()
+        self.readiness = readiness.ReadinessChecker(self.swarm, **config.get("readiness", {}))
+        self.pool = pool.WarmPool(self.swarm, readiness=self.readiness, **config.get("warm_pool", {}))
+        self.pool.start()
+        self.sharing = sharing.SharedInstances(self.swarm, **config.get("sharing", {}))
+        self.sharing.start()
+        self.image_cache = images.ImageCache(self.swarm, **config.get("images", {}))
+        self.image_cache.start()
+        self.admission = admission.AdmissionController(self.swarm, **config.get("admission", {}))
+        self.leases = leases.LeaseTable(self.swarm, cost=self.placer.cost, sharing=self.sharing,
+                                        **config.get("leases", {}))
+        self.leases.start()
+        # Services are moved off busy access points, and their clients
+        # told over the connection they deployed or send heartbeats on
+        self.subscribers = rebalancer.Subscribers()
+        self.rebalancer = rebalancer.Rebalancer(self.swarm, self.placer, self.telemetry, self.readiness,
+                                                self.subscribers, leases=self.leases, sharing=self.sharing,
+                                                **config.get("rebalance", {}))
+        self.rebalancer.start()
+        self.metrics_server = metrics.MetricsServer(**config.get("metrics", {}))
+        self.metrics_server.start()
+        journal_config = config.get("journal", {})
+        self.snapshots = journal.SnapshotWriter(self.swarm,
+                                                journal_config.get("snapshot_interval", 60),
+                                                journal_config.get("max_entries", 10000))
+        self.snapshots.start()
+        # Access points added to or removed from the config are
+        # picked up on SIGHUP or once the file changes
+        self.reload_lock = threading.Lock()
+        self.watcher = fleet.ConfigWatcher(config_file, self.reload_config, **config.get("reload", {}))
+        self.watcher.start()
         self.sockets = {}
         self.threads = {}
-        self.mutex = threading.Lock()
+        # Dictionary mapping deploy phase to [count, total seconds,
+        # max seconds]
+        self.deploy_timings = {}
+        self.timings_lock = threading.Lock()
+        # Blocking Docker work is handed to this pool, so the
+        # servers keep accepting and reading from other clients
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix="edgeap-worker")
+        # Items of batch requests run on their own pool, as the
+        # batch itself may be running on self.executor
+        self.batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                                    thread_name_prefix="edgeap-batch")
+        self.loop = None
+        self.async_servers = []
+        # Operations a request may name in its "op" field
+        self.handlers = {
+            "deploy": self.handle_request,
+            "shutdown": self.handle_shutdown,
+            "stats": self.handle_stats,
+            "heartbeat": self.handle_heartbeat,
+            "telemetry": self.handle_telemetry,
+            "batch_deploy": self.handle_batch_deploy,
+            "batch_shutdown": self.handle_batch_shutdown,
+        }
 
     def shutdown(self):
         # Shutdown all sockets
         for _, sock in self.sockets.items():
             sock.shutdown(socket.SHUT_WR)
+        # Shutdown asyncio servers
+        if self.loop is not None:
+            for server in self.async_servers:
+                self.loop.call_soon_threadsafe(server.close)
         # Shutdown all threads
         self.stop_threads = True
+        self.events.stop()
+        self.placer.stop()
+        self.telemetry.stop()
+        self.pool.stop()
+        self.sharing.stop()
+        self.image_cache.stop()
+        self.leases.stop()
+        self.rebalancer.stop()
+        self.snapshots.stop()
+        self.watcher.stop()
+        self.swarm.clients.stop()
+        self.metrics_server.stop()
+        self.executor.shutdown(wait=False)
+        self.batch_executor.shutdown(wait=False)
+
+    '''
+	Function:	reload_config
+
+	Description:	Apply the remotes of the config file again.
+			Access points added join the swarm and get their
+			warm services; access points removed take no new
+			services, lose their warm ones and leave the
+			swarm once the services they run are gone.
+			Return False if the config could not be read.
+    '''
+    def reload_config(self):
+        with self.reload_lock:
+            result = self.swarm.reload_config()
+            if result is None:
+                return False
+            (added, removed) = result
+            for ip in removed:
+                self.pool.discard(ip)
+            if added:
+                self.pool.fill()
+        return True
 
     def accept_connection(self, sock, sel):
+        start = time.perf_counter()
+        server = "deploy" if sock.getsockname()[1] == REQUEST_PORT else "shutdown"
         conn, addr = sock.accept()  # Should be ready to read
         print("accepted connection from ", addr)
+        CONNECTIONS.inc(server)
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
+        decoder = protocol.FrameDecoder()
+        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", decoder=decoder,
+                                     channel=SocketChannel(conn, decoder))
         #events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        events = selectors.EVENT_READ 
+        events = selectors.EVENT_READ
         sel.register(conn, events, data=data)
-        
+        ACCEPT_SECONDS.observe(time.perf_counter() - start, server)
+
     def start_request_server(self):
         self.threads[request_server_str] = threading.Thread(target=self.request_server, daemon=True)
         self.threads[request_server_str].start()
 
     def request_server(self):
         HOST = ""
-        PORT = 60001
+        PORT = REQUEST_PORT
         sel = selectors.DefaultSelector()
 
         # Create, bind, and listen on socket
@@ -49,7 +309,7 @@ class Manager:
         print("listening on", (HOST, PORT))
         self.sockets[request_server_str].setblocking(False)
 
-        # Select self.socks[request_server] for I/O event monitoring 
+        # Select self.socks[request_server] for I/O event monitoring
         sel.register(self.sockets[request_server_str], selectors.EVENT_READ, data=None)
 
         while True:
@@ -61,90 +321,424 @@ class Manager:
                 if key.data is None:
                     self.accept_connection(key.fileobj, sel)
                 else:
-                    self.mutex.acquire()
                     self.process_request(key, mask, sel)
-                    self.mutex.release()
 
     def process_request(self, key, mask, sel):
+        self.process_connection(key, mask, sel, "deploy")
+
+    '''
+	Function:	process_connection
+
+	Description:	Read from a client connection of the selector
+			servers and hand every request that has been
+			completely received to the executor. Requests
+			that do not name an "op" get default_op, which
+			depends on the port the client connected to.
+			Once the client is done, the connection is
+			closed after its last response.
+    '''
+    def process_connection(self, key, mask, sel, default_op):
         sock = key.fileobj
         data = key.data
 
         if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(1024)
-            if recv_data:
-                # Receive and decode request
-                print("Received" , repr(recv_data), "from", data.addr)
-                raw_data = recv_data.decode()
-                request = json.loads(raw_data)
-
-                '''
-                Request Format:
-                {
-                	"image": <image-name>,
-			"application_port": <port-exposed-in-container>,
-                	"protocol": <tcp-or-udp>
-                }
-
-                Response Format:
-                {
-                	"resp-code": <0 on success, -1 on failure>,
-			"service_id": <service id of running application>
-            		"ip": <ip of device running application>,
-			"port": <port for communication>,
-                	"failure-msg": <failure message>
-                }
-                '''
-                response = {}
-                # Check for invalid request
-                if "image" not in request or \
-                   "application_port" not in request or \
-                   "protocol" not in request:
-                    response["resp-code"] = -1
-                    response["failure-msg"] = "Invalid request"
-                    sock.sendall(json.dumps(response).encode())
+            try:
+                if self.serve_connection(sock, data, default_op):
                     return
+            except OSError as e:
+                # The client went away without closing the connection
+                print(e, file=sys.stderr)
 
-                '''
-                Create application on the appropriate access point
-                
-                NOTE:
-                    This is currently a proof-of-concept implementation
-                    so we are simply selecting the first node (AP) in the list. 
-                    In the future need to add logic for managing multiple remote AP's
-                    and for intelligent placement of the applications.
-		    The list of AP's are to be listed in the config.
-
-                For now just using the only "remote" node listed in the config
-                '''
-                ip = list(self.swarm.nodes.keys())[0] # grab first ip in list
-                (resp, service_id) = self.swarm.create_service(ip, request)
-
-                if resp is False:
-                    response["resp-code"] = -1
-                    response["failure-msg"] = "Failed to start application"
-                    sock.sendall(json.dumps(response).encode())
+            sel.unregister(sock)
+            if data.channel.close():
+                self.close_channel(data.channel, data.addr)
+
+    '''
+	Function:	close_channel
+
+	Description:	Close a client connection of the selector
+			servers once it has no request left to answer.
+    '''
+    def close_channel(self, channel, addr):
+        print("closing connection to ", addr)
+        self.subscribers.unsubscribe(channel)
+        channel.sock.close()
+
+    '''
+	Function:	serve_connection
+
+	Description:	Receive from a client connection of the
+			selector servers and start answering the
+			requests it completed on the executor, as the
+			asyncio server does. Requests pipelined on a
+			framed connection run concurrently and their
+			responses, tagged with the request id, are
+			written back as they complete; legacy
+			connections are answered in order. Return
+			False once the client is done sending.
+    '''
+    def serve_connection(self, sock, data, default_op):
+        recv_data = sock.recv(4096)
+        if not recv_data:
+            return False
+
+        # Receive and decode requests
+        try:
+            with PARSE_SECONDS.time():
+                requests = data.decoder.feed(recv_data)
+        except protocol.FrameError as e:
+            print(e, file=sys.stderr)
+            PARSE_ERRORS.inc()
+            data.channel.send({"resp-code": -1, "failure-msg": str(e)})
+            return False
+
+        channel = data.channel
+        with channel.lock:
+            channel.pending += len(requests)
+            if not data.decoder.framed:
+                channel.backlog.extend(requests)
+                if channel.busy or not channel.backlog:
+                    return True
+                channel.busy = True
+        if data.decoder.framed:
+            for request in requests:
+                self.executor.submit(self.answer, channel, request, data.addr, default_op)
+        else:
+            self.executor.submit(self.answer_backlog, channel, data.addr, default_op)
+        return True
+
+    '''
+	Function:	answer
+
+	Description:	Dispatch a request received by the selector
+			servers and write its response back. Run on
+			self.executor.
+    '''
+    def answer(self, channel, request, addr, default_op):
+        # Only framed clients can tell pushed messages from responses
+        response = self.dispatch(request, addr, default_op, channel if channel.decoder.framed else None)
+        channel.send(response)
+        if channel.finish():
+            self.close_channel(channel, addr)
+
+    '''
+	Function:	answer_backlog
+
+	Description:	Answer the requests of a legacy connection in
+			the order they were received, until none is
+			left. Run on self.executor.
+    '''
+    def answer_backlog(self, channel, addr, default_op):
+        while True:
+            with channel.lock:
+                if not channel.backlog:
+                    channel.busy = False
                     return
+                request = channel.backlog.popleft()
+            self.answer(channel, request, addr, default_op)
+
+    '''
+	Function:	dispatch
+
+	Description:	Run the handler for the operation named by
+			the request and return its response. The
+			request id, if any, is copied to the response.
+			A handler that raises is answered with an
+			error response. If the request came on a
+			channel, the channel is subscribed to the
+			services it deployed or sent heartbeats for.
+    '''
+    def dispatch(self, request, addr, default_op, channel=None):
+        if request is None:
+            return {"resp-code": -1, "failure-msg": "Invalid request"}
+
+        op = request.get("op", default_op)
+        if not isinstance(op, str) or op not in self.handlers:
+            response = {"resp-code": -1, "failure-msg": "Unknown op: {}".format(op)}
+            REQUESTS.inc("unknown", str(-1))
+        else:
+            with REQUEST_SECONDS.time(op):
+                try:
+                    response = self.handlers[op](request, addr)
+                    if channel is not None:
+                        self.update_subscriptions(op, request, response, channel)
+                except Exception as e:
+                    # A malformed request or a bug must cost the client
+                    # its request, not the server its thread
+                    print("Error: {} request failed:".format(op), file=sys.stderr)
+                    traceback.print_exc()
+                    response = {"resp-code": -1, "failure-msg": "Internal error: {}".format(e)}
+            REQUESTS.inc(op, str(response.get("resp-code")))
+
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    '''
+	Function:	update_subscriptions
+
+	Description:	Subscribe channel to the services a request
+			deployed or renewed the lease of, and
+			unsubscribe it from those it shut down, so the
+			rebalancer can tell the client when it moves
+			them. Shared services are never moved.
+    '''
+    def update_subscriptions(self, op, request, response, channel):
+        results = response.get("results", []) if op.startswith("batch_") else [response]
+        if op in ("deploy", "batch_deploy"):
+            for result in results:
+                if result.get("resp-code") == 0 and not result.get("shared"):
+                    self.subscribers.subscribe(result["service_id"], channel)
+        elif op in ("shutdown", "batch_shutdown"):
+            items = request.get("services", []) if op == "batch_shutdown" else [request]
+            for (item, result) in zip(items, results):
+                if result.get("resp-code") == 0:
+                    service_id = item if isinstance(item, str) else item.get("service_id")
+                    self.subscribers.unsubscribe(channel, service_id)
+        elif op == "heartbeat":
+            for service_id in heartbeat_ids(request) or []:
+                if self.swarm.services.get(service_id) is not None:
+                    self.subscribers.subscribe(service_id, channel)
+
+    '''
+	Function:	handle_request
+
+	Description:	Validate a deploy request, start the application
+			on the appropriate access point and return the
+			response dictionary. Used by both the selector
+			and the asyncio servers.
+    '''
+    def handle_request(self, request, addr):
+        '''
+        Request Format:
+        {
+        	"image": <image-name>,
+		"application_port": <port-exposed-in-container>,
+        	"protocol": <tcp-or-udp>,
+		"wait_ready": <optional, true to reply once the application is serving>,
+		"lease_ttl": <optional, seconds the application lives without a heartbeat>,
+		"shared": <optional, true to share a running instance with other clients>,
+		"max_wait": <optional, seconds to wait for the access point to take the deploy>,
+		"resources": <optional, cpu, memory, cpu_limit and memory_limit of the application>
+        }
+
+        Response Format:
+        {
+        	"resp-code": <0 on success, -1 on failure>,
+		"service_id": <service id of running application>
+    		"ip": <ip of device running application>,
+		"port": <port for communication>,
+		"warm": <true if claimed from the warm pool>,
+		"shared": <true if the instance may be shared with other clients>,
+		"clients": <number of clients of a shared instance>,
+		"image_cached": <true if the image was already on the access point>,
+		"timings": <milliseconds spent in each phase of the deploy>,
+		"time_to_ready": <milliseconds until the application was serving, if waited for>,
+		"lease_ttl": <seconds the application lives without a heartbeat, if leased>,
+		"lease_id": <id of the lease the client renews with heartbeats, if leased>,
+		"queued": <true if the deploy waited for the access point>,
+		"retry_after": <seconds after which to retry a deploy the access point could not take>,
+		"resources": <CPU and memory reserved for and limits of the application, if any>,
+        	"failure-msg": <failure message>
+        }
+        '''
+        response = {}
+        start = time.perf_counter()
+        timings = {}
+        # Check for invalid request
+        if "image" not in request or \
+           "application_port" not in request or \
+           "protocol" not in request or \
+           not isinstance(request["image"], str):
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid request"
+            return response
 
-                service_info = self.swarm.get_service_info(service_id)
-                port = service_info["Spec"]["EndpointSpec"]["Ports"][0]["PublishedPort"]
+        try:
+            resources = self.swarm.capacity.resources_for(request)
+        except ValueError as e:
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid resources: {}".format(e)
+            return response
+        if resources:
+            response["resources"] = resources
+        try:
+            lease_ttl = self.leases.lease_ttl(request)
+        except ValueError as e:
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid lease_ttl: {}".format(e)
+            return response
+
+        # Create application on the access point chosen by the placer,
+        # preferring access points with a shared instance it can join,
+        # then access points with a warm instance of it or, failing
+        # that, access points that already hold its image
+        # Shared and warm instances run with their image's resources,
+        # requests asking for their own get a new service
+        custom = bool(request.get("resources"))
+        share = self.sharing.should_share(request) and not custom
+        prefer = (share and self.sharing.preferred_nodes(request)) or \
+                 self.pool.preferred_nodes(request) or \
+                 self.image_cache.preferred_nodes(request)
+        ip = self.placer.place(request, addr, prefer=prefer)
+        timings["place"] = time.perf_counter() - start
+        if ip is None:
+            response["resp-code"] = -1
+            response["failure-msg"] = "No access point can run the application"
+            return response
+
+        labels = self.leases.labels(lease_ttl)
+        if share:
+            attached = self.sharing.attach(ip, request)
+            if attached is not None:
+                (service_id, port, clients) = attached
+                if self.readiness.should_wait(request):
+                    (ready, reason) = self.wait_claimed(service_id, timings)
+                    if not ready:
+                        # Leave the instance to its other clients
+                        if self.sharing.detach(service_id) == 0:
+                            self.remove_shared(ip, service_id)
+                        response["resp-code"] = -1
+                        response["failure-msg"] = "Application did not become ready: {}".format(reason)
+                        return response
+                self.grant_lease(service_id, lease_ttl, True, response)
                 response["resp-code"] = 0
                 response["service_id"] = service_id
                 response["ip"] = ip
                 response["port"] = port
-                sock.sendall(json.dumps(response).encode())
-        
-            else:
-                print("closing connection to ", data.addr)
-                sel.unregister(sock)
-                sock.close()
-        
+                response["warm"] = False
+                response["shared"] = True
+                response["clients"] = clients
+                response["image_cached"] = True
+                self.image_cache.record_deploy(ip, request["image"], True)
+                response["timings"] = self.record_timings(timings, start)
+                if "ready" in timings:
+                    response["time_to_ready"] = response["timings"]["total"]
+                return response
+            labels = self.sharing.shared_labels(labels)
+
+        claimed = self.pool.claim(ip, request, labels=labels) if not custom else None
+        if claimed is not None:
+            (service_id, port) = claimed
+            if self.readiness.should_wait(request):
+                (ready, reason) = self.wait_claimed(service_id, timings)
+                if not ready:
+                    self.swarm.remove_service(ip, service_id)
+                    response["resp-code"] = -1
+                    response["failure-msg"] = "Application did not become ready: {}".format(reason)
+                    return response
+            self.grant_lease(service_id, lease_ttl, share, response)
+            if share:
+                self.sharing.add(ip, request, service_id, self.leases.labels(lease_ttl))
+                response["clients"] = 1
+            response["resp-code"] = 0
+            response["service_id"] = service_id
+            response["ip"] = ip
+            response["port"] = port
+            response["warm"] = True
+            response["shared"] = share
+            response["image_cached"] = True
+            self.image_cache.record_deploy(ip, request["image"], True)
+            response["timings"] = self.record_timings(timings, start)
+            if "ready" in timings:
+                response["time_to_ready"] = response["timings"]["total"]
+            return response
+
+        # Wait for the access point to have room for one more starting
+        # service, or tell the client when to retry
+        (admitted, seconds) = self.admission.admit(ip, request.get("max_wait"))
+        if not admitted:
+            response["resp-code"] = -1
+            response["failure-msg"] = "Access point {} is busy".format(ip)
+            response["retry_after"] = seconds
+            return response
+        if seconds > 0:
+            timings["queue"] = seconds
+            response["queued"] = True
+
+        admitted_at = time.perf_counter()
+        image_cached = self.image_cache.holds(ip, request["image"])
+        try:
+            (resp, record) = self.swarm.create_service(ip, request, labels=labels, timings=timings)
+
+            if resp is False:
+                response["resp-code"] = -1
+                response["failure-msg"] = "Failed to start application"
+                return response
+
+            if self.readiness.should_wait(request):
+                ready_start = time.perf_counter()
+                (ready, reason) = self.readiness.wait_ready(record)
+                timings["ready"] = time.perf_counter() - ready_start
+                if not ready:
+                    self.swarm.remove_service(ip, record.service_id)
+                    response["resp-code"] = -1
+                    response["failure-msg"] = "Application did not become ready: {}".format(reason)
+                    return response
+        finally:
+            self.admission.release(ip, time.perf_counter() - admitted_at)
+
+        self.image_cache.record_deploy(ip, request["image"], image_cached)
+        self.grant_lease(record.service_id, lease_ttl, share, response)
+        if share:
+            self.sharing.add(ip, request, record.service_id, self.leases.labels(lease_ttl))
+            response["clients"] = 1
+        response["resp-code"] = 0
+        response["service_id"] = record.service_id
+        response["ip"] = ip
+        response["port"] = record.port
+        response["warm"] = False
+        response["shared"] = share
+        response["image_cached"] = image_cached
+        response["timings"] = self.record_timings(timings, start)
+        if "ready" in timings:
+            response["time_to_ready"] = response["timings"]["total"]
+        return response
+
+    '''
+	Function:	wait_claimed
+
+	Description:	Wait until a warm or shared service handed to a
+			deploy request is ready. Warm services join the
+			pool once ready, but those adopted after a
+			restart and shared instances started without
+			waiting may not be. Return (ready, reason) as
+			ReadinessChecker.wait_ready.
+    '''
+    def wait_claimed(self, service_id, timings):
+        record = self.swarm.services.get(service_id)
+        if record is None:
+            return (False, "service {} is gone".format(service_id))
+        ready_start = time.perf_counter()
+        (ready, reason) = self.readiness.wait_ready(record)
+        timings["ready"] = time.perf_counter() - ready_start
+        return (ready, reason)
+
+    '''
+	Function:	record_timings
+
+	Description:	Add the seconds spent in each phase of a deploy
+			started at start to the deploy timings, and
+			return them in milliseconds for the response.
+    '''
+    def record_timings(self, timings, start):
+        timings = dict(timings, total=time.perf_counter() - start)
+        with self.timings_lock:
+            for phase, seconds in timings.items():
+                DEPLOY_PHASE_SECONDS.observe(seconds, phase)
+                timing = self.deploy_timings.setdefault(phase, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+        return {phase: round(seconds * 1000, 3) for phase, seconds in timings.items()}
+
     def start_shutdown_server(self):
         self.threads[shutdown_server_str] = threading.Thread(target=self.shutdown_server, daemon=True)
         self.threads[shutdown_server_str].start()
 
     def shutdown_server(self):
         HOST = ""
-        PORT = 60002
+        PORT = SHUTDOWN_PORT
         sel = selectors.DefaultSelector()
 
         # Create, bind, and listen on socket
@@ -154,7 +748,7 @@ class Manager:
         print("listening on", (HOST, PORT))
         self.sockets[shutdown_server_str].setblocking(False)
 
-        # Select self.socks[shutdown_server] for I/O event monitoring 
+        # Select self.socks[shutdown_server] for I/O event monitoring
         sel.register(self.sockets[shutdown_server_str], selectors.EVENT_READ, data=None)
 
         while True:
@@ -166,69 +760,447 @@ class Manager:
                 if key.data is None:
                     self.accept_connection(key.fileobj, sel)
                 else:
-                    self.mutex.acquire()
                     self.process_shutdown(key, mask, sel)
-                    self.mutex.release()
 
     def process_shutdown(self, key, mask, sel):
-        sock = key.fileobj
-        data = key.data
+        self.process_connection(key, mask, sel, "shutdown")
 
-        if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(1024)
-            if recv_data:
-                # Receive and decode request
-                print("Received" , repr(recv_data), "from", data.addr)
-                raw_data = recv_data.decode()
-                request = json.loads(raw_data)
-
-                '''
-                Request Format:
-                {
-                	"service_id": <service id of running application>,
-            		"ip": <ip of device running application>,
-			"port": <port for communication>
-                }
-
-                Response Format:
-                {
-                	"resp-code": <0 on success, -1 on failure>,
-                	"failure-msg": <failure message>
-                }
-                '''
-                
-                response = {}
-                # Check for invalid request
-                if request["ip"] not in self.swarm.services:
-                    response["resp-code"] = -1
-                    response["failure-msg"] = "Invalid shutdown request: ip doesn't exist"
-                    sock.sendall(json.dumps(response).encode())
-                    return
+    '''
+	Function:	grant_lease
 
-                if request["service_id"] not in self.swarm.services[request["ip"]]:
-                    response["resp-code"] = -1
-                    response["failure-msg"] = "Invalid shutdown request: service_id doesn't exist"
-                    sock.sendall(json.dumps(response).encode())
-                    return
-                
-                # Shutdown application
-                ip = request["ip"]
-                service_id = request["service_id"]
-                port = request["port"]
-                
-                resp = self.swarm.remove_service(ip, service_id)
-
-                if resp is False:
-                    response["resp-code"] = -1
-                    response["failure-msg"] = "Failed to shutdown application"
-                    sock.sendall(json.dumps(response).encode())
-                    return
+	Description:	Grant the lease of a deployed application and
+			add it to response. Each client of a shared
+			instance gets a lease of its own.
+    '''
+    def grant_lease(self, service_id, lease_ttl, shared, response):
+        if not lease_ttl:
+            return
+        if shared:
+            response["lease_id"] = self.leases.attach(service_id, lease_ttl)
+        else:
+            self.leases.grant(service_id, lease_ttl)
+            response["lease_id"] = service_id
+        response["lease_ttl"] = lease_ttl
 
-                # Send response
-                response["resp-code"] = 0
-                sock.sendall(json.dumps(response).encode())
-        
-            else:
-                print("closing connection to ", data.addr)
-                sel.unregister(sock)
-                sock.close()
+    '''
+	Function:	remove_shared
+
+	Description:	Remove the shared instance service_id its last
+			client detached from. If it cannot be removed,
+			that client stays attached.
+    '''
+    def remove_shared(self, server_ip, service_id):
+        resp = self.swarm.remove_service(server_ip, service_id)
+        if resp is False:
+            self.sharing.restore(service_id)
+        else:
+            self.sharing.removed(service_id)
+        return resp
+
+    '''
+	Function:	handle_shutdown
+
+	Description:	Validate a shutdown request, remove the
+			application and return the response dictionary.
+			Used by both the selector and the asyncio servers.
+    '''
+    def handle_shutdown(self, request, addr):
+        '''
+        Request Format:
+        {
+        	"service_id": <service id of running application>,
+    		"ip": <ip of device running application>,
+		"port": <port for communication>,
+		"lease_id": <lease id of the client, needed for a leased shared instance>
+        }
+
+        Response Format:
+        {
+        	"resp-code": <0 on success, -1 on failure>,
+		"clients": <clients left on a shared instance, which keeps running>,
+        	"failure-msg": <failure message>
+        }
+        '''
+
+        response = {}
+        # Check for invalid request
+        if "ip" not in request or "service_id" not in request:
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid shutdown request"
+            return response
+
+        if not self.swarm.services.has_node(request["ip"]):
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid shutdown request: ip doesn't exist"
+            return response
+
+        if not self.swarm.has_service(request["ip"], request["service_id"]):
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid shutdown request: service_id doesn't exist"
+            return response
+
+        # Shutdown application
+        ip = request["ip"]
+        service_id = request["service_id"]
+
+        # Detaching a leased client of a shared instance ends its own
+        # lease, which the reaper would otherwise detach it again for
+        lease_id = request.get("lease_id", service_id)
+        if "lease_id" not in request and self.sharing.is_shared(service_id) and \
+           self.leases.attachment_count(service_id) >= self.sharing.client_count(service_id):
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid shutdown request: lease_id required for a shared instance"
+            return response
+        if lease_id != service_id and self.leases.service_of(lease_id) != service_id:
+            response["resp-code"] = -1
+            response["failure-msg"] = "Invalid shutdown request: no lease {} for service_id".format(lease_id)
+            return response
+
+        # A shared instance is only removed once its last client is gone
+        clients = self.sharing.detach(service_id)
+        if clients:
+            self.leases.release(lease_id)
+            response["resp-code"] = 0
+            response["clients"] = clients
+            return response
+
+        if clients is None and (self.sharing.is_closing(service_id) or
+                                self.swarm.services.get(service_id) is None):
+            # Its last client detached and it is being, or has just
+            # been, removed
+            self.leases.release(lease_id)
+            response["resp-code"] = 0
+            return response
+
+        if clients == 0:
+            resp = self.remove_shared(ip, service_id)
+        else:
+            resp = self.swarm.remove_service(ip, service_id)
+
+        if resp is False:
+            response["resp-code"] = -1
+            response["failure-msg"] = "Failed to shutdown application"
+            return response
+
+        self.leases.release(lease_id)
+        # Send response
+        response["resp-code"] = 0
+        return response
+
+    '''
+	Function:	handle_heartbeat
+
+	Description:	Renew the leases named in a heartbeat request,
+			by the lease_id of their deploy response.
+    '''
+    def handle_heartbeat(self, request, addr):
+        '''
+        Request Format:
+        {
+        	"op": "heartbeat",
+        	"service_id": <lease id of running application>
+        	or "service_ids": [<lease id>, ...]
+        }
+
+        Response Format:
+        {
+        	"resp-code": <0 if every lease was renewed, -1 otherwise>,
+        	"lease_ttl": <seconds until the next heartbeat is due>,
+        	"failure-msg": <failure message>
+        }
+        '''
+        service_ids = heartbeat_ids(request)
+        if service_ids is None:
+            return {"resp-code": -1, "failure-msg": "Invalid heartbeat request"}
+
+        ttls = [self.leases.renew(service_id) for service_id in service_ids]
+        unknown = [service_id for service_id, ttl in zip(service_ids, ttls) if ttl is None]
+        response = {"resp-code": 0}
+        renewed = [ttl for ttl in ttls if ttl is not None]
+        if renewed:
+            response["lease_ttl"] = min(renewed)
+        if unknown:
+            response["resp-code"] = -1
+            response["failure-msg"] = "No lease for {}".format(", ".join(map(str, unknown)))
+        return response
+
+    '''
+	Function:	handle_batch_deploy
+
+	Description:	Deploy several applications, each possibly
+			several times, concurrently. Return the
+			response of every deploy, in request order.
+    '''
+    def handle_batch_deploy(self, request, addr):
+        '''
+        Request Format:
+        {
+        	"op": "batch_deploy",
+        	"requests": [
+        		{
+        			"image": <image-name>,
+        			"application_port": <port-exposed-in-container>,
+        			"protocol": <tcp-or-udp>,
+        			"count": <positive number of instances, default 1>
+        		}, ...
+        	]
+        }
+
+        Response Format:
+        {
+        	"resp-code": <0 if every deploy succeeded, -1 otherwise>,
+        	"results": [<deploy response>, ...],
+        	"failed": <number of failed deploys>,
+        	"failure-msg": <failure message>
+        }
+        '''
+        try:
+            counts = [(item, item.get("count", 1)) for item in request["requests"]]
+        except (KeyError, TypeError, AttributeError):
+            return {"resp-code": -1, "failure-msg": "Invalid batch deploy request"}
+        # Check the size before expanding the counts, a huge count
+        # must not take the manager's memory
+        for (_, count) in counts:
+            if isinstance(count, bool) or not isinstance(count, int) or count <= 0:
+                return {"resp-code": -1,
+                        "failure-msg": "Invalid batch deploy request: count must be a positive integer"}
+        total = sum(count for (_, count) in counts)
+        if total > MAX_BATCH_SIZE:
+            return {"resp-code": -1,
+                    "failure-msg": "Batch too large: at most {} items".format(MAX_BATCH_SIZE)}
+        items = []
+        for (item, count) in counts:
+            items.extend([item] * count)
+        return self.run_batch(self.handle_request, items, addr)
+
+    '''
+	Function:	handle_batch_shutdown
+
+	Description:	Remove several applications concurrently.
+			Return the response of every shutdown, in
+			request order.
+    '''
+    def handle_batch_shutdown(self, request, addr):
+        '''
+        Request Format:
+        {
+        	"op": "batch_shutdown",
+        	"services": [
+        		{
+        			"service_id": <service id of running application>,
+        			"ip": <ip of device running application>
+        		}
+        		or <service id of running application>, ...
+        	]
+        }
+
+        Response Format:
+        {
+        	"resp-code": <0 if every shutdown succeeded, -1 otherwise>,
+        	"results": [<shutdown response>, ...],
+        	"failed": <number of failed shutdowns>,
+        	"failure-msg": <failure message>
+        }
+        '''
+        items = []
+        try:
+            for item in request["services"]:
+                if isinstance(item, str):
+                    item = {"service_id": item, "ip": self.swarm.get_service_node(item)}
+                items.append(dict(item))
+        except (KeyError, TypeError, ValueError):
+            return {"resp-code": -1, "failure-msg": "Invalid batch shutdown request"}
+        return self.run_batch(self.handle_shutdown, items, addr)
+
+    '''
+	Function:	run_batch
+
+	Description:	Run handler on every item of a batch at once
+			and gather the responses.
+    '''
+    def run_batch(self, handler, items, addr):
+        if len(items) > MAX_BATCH_SIZE:
+            return {"resp-code": -1,
+                    "failure-msg": "Batch too large: at most {} items".format(MAX_BATCH_SIZE)}
+        futures = [self.batch_executor.submit(handler, item, addr) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(e, file=sys.stderr)
+                results.append({"resp-code": -1, "failure-msg": "Internal error"})
+        failed = sum(1 for result in results if result.get("resp-code") != 0)
+        response = {"resp-code": 0 if failed == 0 else -1, "results": results, "failed": failed}
+        if failed:
+            response["failure-msg"] = "{} of {} items failed".format(failed, len(results))
+        return response
+
+    '''
+	Function:	handle_telemetry
+
+	Description:	Return the load history of an access point
+			and of a service, or the latest load of every
+			access point and service.
+    '''
+    def handle_telemetry(self, request, addr):
+        '''
+        Request Format:
+        {
+        	"op": "telemetry",
+        	"ip": <optional, ip of the access point>,
+        	"service_id": <optional, service id of running application>,
+        	"since": <optional, only samples taken after this time>
+        }
+
+        Response Format:
+        {
+        	"resp-code": <0 on success, -1 on failure>,
+        	"nodes": <history or latest sample per access point>,
+        	"services": <history or latest sample per service>,
+        	"failure-msg": <failure message>
+        }
+        '''
+        if not self.telemetry.enabled:
+            return {"resp-code": -1, "failure-msg": "Telemetry is disabled"}
+        since = request.get("since")
+        if since is not None and not isinstance(since, (int, float)):
+            return {"resp-code": -1, "failure-msg": "Invalid telemetry request"}
+        response = self.telemetry.query(request.get("ip"), request.get("service_id"), since)
+        response["resp-code"] = 0
+        return response
+
+    '''
+	Function:	handle_stats
+
+	Description:	Return manager statistics.
+    '''
+    def handle_stats(self, request, addr):
+        with self.timings_lock:
+            deploys = {phase: {"count": count,
+                               "avg_ms": total / count * 1000,
+                               "max_ms": longest * 1000}
+                       for phase, (count, total, longest) in self.deploy_timings.items()}
+        return {"resp-code": 0,
+                "deploys": deploys,
+                "admission": self.admission.get_stats(),
+                "leases": self.leases.get_stats(),
+                "rebalancer": self.rebalancer.get_stats(),
+                "breakers": self.swarm.resilience.get_stats(),
+                "capacity": self.swarm.capacity.get_stats(list(self.swarm.nodes.keys())),
+                "connections": self.swarm.clients.get_stats(),
+                "draining": sorted(self.swarm.draining),
+                "pool": self.pool.get_stats(),
+                "sharing": self.sharing.get_stats(),
+                "images": self.image_cache.get_stats()}
+
+    '''
+	Function:	start_async_server
+
+	Description:	Serve both the request and the shutdown port
+			from a single asyncio event loop running on its
+			own thread. As with the selector servers, each
+			request is run on self.executor so many deploys
+			and teardowns can be in flight at once.
+    '''
+    def start_async_server(self):
+        self.threads[async_server_str] = threading.Thread(target=self.async_server, daemon=True)
+        self.threads[async_server_str].start()
+
+    def async_server(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve_async())
+        except asyncio.CancelledError:
+            pass
+
+    async def serve_async(self):
+        HOST = ""
+        servers = ((REQUEST_PORT, "deploy"),
+                   (SHUTDOWN_PORT, "shutdown"))
+
+        for port, default_op in servers:
+            server = await asyncio.start_server(
+                lambda reader, writer, default_op=default_op: self.handle_connection(reader, writer, default_op),
+                HOST, port)
+            self.async_servers.append(server)
+            print("listening on", (HOST, port))
+
+        await asyncio.gather(*(server.serve_forever() for server in self.async_servers))
+
+    '''
+	Function:	handle_connection
+
+	Description:	Serve one client connection on the asyncio
+			server. Each request is dispatched on the
+			executor as soon as it has been received, so
+			requests pipelined on a framed connection run
+			concurrently and their responses are written
+			back, tagged with the request id, as they
+			complete. Legacy connections are answered in
+			order since their responses carry no id.
+    '''
+    async def handle_connection(self, reader, writer, default_op):
+        start = time.perf_counter()
+        addr = writer.get_extra_info("peername")
+        print("accepted connection from ", addr)
+        CONNECTIONS.inc(default_op)
+        decoder = protocol.FrameDecoder()
+        channel = StreamChannel(writer, decoder, self.loop)
+        pending = set()
+        ACCEPT_SECONDS.observe(time.perf_counter() - start, default_op)
+        try:
+            while True:
+                recv_data = await reader.read(4096)
+                if not recv_data:
+                    break
+                try:
+                    with PARSE_SECONDS.time():
+                        requests = decoder.feed(recv_data)
+                except protocol.FrameError as e:
+                    print(e, file=sys.stderr)
+                    PARSE_ERRORS.inc()
+                    writer.write(decoder.encode({"resp-code": -1, "failure-msg": str(e)}))
+                    break
+
+                for request in requests:
+                    task = self.loop.create_task(self.respond(writer, decoder, request, addr, default_op,
+                                                              channel if decoder.framed else None))
+                    if decoder.framed:
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                    else:
+                        await task
+            # Finish requests still in flight before closing, the
+            # client may have shut down its side after sending
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            await writer.drain()
+        except ConnectionError as e:
+            print(e, file=sys.stderr)
+        finally:
+            print("closing connection to ", addr)
+            self.subscribers.unsubscribe(channel)
+            writer.close()
+
+    async def respond(self, writer, decoder, request, addr, default_op, channel=None):
+        response = await self.loop.run_in_executor(self.executor, self.dispatch,
+                                                   request, addr, default_op, channel)
+        if not writer.is_closing():
+            writer.write(decoder.encode(response))
+            await writer.drain()
+
+'''
+	Function:	heartbeat_ids
+
+	Description:	Return the service ids a heartbeat request
+			names, or None if it is malformed.
+'''
+def heartbeat_ids(request):
+    service_ids = request.get("service_ids")
+    if service_ids is None and "service_id" in request:
+        service_ids = [request["service_id"]]
+    if not isinstance(service_ids, list) or not service_ids:
+        return None
+    return service_ids
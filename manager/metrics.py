@@ -0,0 +1,328 @@
+import sys
+import time
+import bisect
+import threading
+import http.server
+
+'''
+	Counters and latency histograms of the manager.
+
+	The manager and the swarm object record what they do in the
+	metrics of REGISTRY: requests accepted, parsed and answered,
+	the phases of a deploy and every call to the Docker API of
+	the manager node and the access points. A MetricsServer
+	serves them over HTTP in the Prometheus text format, so a
+	Prometheus server can scrape them and show where deploy
+	latency goes.
+'''
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+'''
+	Class: Counter
+
+	Member Variables:
+		name:
+			Name of the metric
+		help:
+			Description of the metric
+		label_names:
+			Names of the labels of the metric
+		values:
+			Dictionary mapping tuple of label values to the
+			count
+'''
+class Counter:
+
+    kind = "counter"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ["{}{} {}".format(self.name, format_labels(self.label_names, labels), format_value(value))
+                for labels, value in values]
+
+'''
+	Class: Histogram
+
+	Member Variables:
+		name:
+			Name of the metric
+		help:
+			Description of the metric
+		label_names:
+			Names of the labels of the metric
+		buckets:
+			Upper bounds of the buckets, in increasing order
+		values:
+			Dictionary mapping tuple of label values to
+			[bucket counts, sum, count]; a value is counted
+			in the first bucket it fits in only, rendering
+			makes the counts cumulative
+'''
+class Histogram:
+
+    kind = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    '''
+	Function:	time
+
+	Description:	Return a context manager observing the seconds
+			spent in its block.
+    '''
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def get(self, *label_values):
+        with self.lock:
+            entry = self.values.get(label_values)
+            return (entry[2], entry[1]) if entry else (0, 0.0)
+
+    def render(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self.values.items())
+        lines = []
+        label_names = self.label_names + ("le",)
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(label_names, labels + (format_value(bound),)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.label_names, labels),
+                                              format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.label_names, labels), count))
+        return lines
+
+class Timer:
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+'''
+	Class: Registry
+
+	Member Variables:
+		metrics:
+			Dictionary mapping name to metric, in the order
+			they were registered
+'''
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    '''
+	Function:	register
+
+	Description:	Return the metric registered under the name of
+			metric, registering metric if there is none.
+    '''
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    '''
+	Function:	render
+
+	Description:	Return every metric in the Prometheus text
+			exposition format.
+    '''
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, label_names=()):
+    return REGISTRY.counter(name, help, label_names)
+
+def histogram(name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, label_names, buckets)
+
+DOCKER_CALLS = counter("edgeap_docker_api_calls_total",
+                       "Docker API calls by method and node", ("method", "node"))
+DOCKER_ERRORS = counter("edgeap_docker_api_errors_total",
+                        "Docker API calls that raised, by method and node", ("method", "node"))
+DOCKER_SECONDS = histogram("edgeap_docker_api_seconds",
+                           "Duration of Docker API calls by method and node", ("method", "node"))
+
+'''
+	Class: InstrumentedClient
+
+	Member Variables:
+		client:
+			Docker API client whose calls are measured
+		node:
+			Label of the client's node in the metrics, its IP
+			or "manager"
+'''
+class InstrumentedClient:
+
+    def __init__(self, client, node):
+        self.client = client
+        self.node = node
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        node = self.node
+
+        def call(*args, **kwargs):
+            DOCKER_CALLS.inc(name, node)
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            except Exception:
+                DOCKER_ERRORS.inc(name, node)
+                raise
+            finally:
+                DOCKER_SECONDS.observe(time.perf_counter() - start, name, node)
+        return call
+
+'''
+	Function:	instrument
+
+	Description:	Return client wrapped so that its calls are
+			measured, or client itself if it is None or
+			already wrapped.
+'''
+def instrument(client, node):
+    if client is None or isinstance(client, InstrumentedClient):
+        return client
+    return InstrumentedClient(client, node)
+
+'''
+	Class: MetricsServer
+
+	Member Variables:
+		registry:
+			Registry whose metrics are served
+		enabled:
+			If False, the default, metrics are only kept
+		address:
+			Address the HTTP server listens on
+		port:
+			Port the HTTP server listens on
+'''
+class MetricsServer:
+
+    def __init__(self, registry=REGISTRY, enabled=False, address="127.0.0.1", port=9100):
+        self.registry = registry
+        self.enabled = enabled
+        self.address = address
+        self.port = port
+        self.server = None
+
+    '''
+	Function:	start
+
+	Description:	Serve the metrics on http://address:port/metrics
+			from a background thread. A port that can not
+			be bound is reported and metrics are only kept.
+    '''
+    def start(self):
+        if not self.enabled:
+            return
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = http.server.ThreadingHTTPServer((self.address, self.port), Handler)
+        except OSError as e:
+            print("Error: could not serve metrics on {}:{}: {}".format(self.address, self.port, e),
+                  file=sys.stderr)
+            return
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print("serving metrics on", (self.address, self.port))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)) + "}"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
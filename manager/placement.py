@@ -0,0 +1,406 @@
+import sys
+import ipaddress
+import threading
+import concurrent.futures
+import swarm as swarm_module
+
+'''
+	Placement of applications on access points.
+
+	A Placer keeps a recent load sample for every node of the
+	swarm and asks its strategy to pick the node a new service
+	is deployed on. Load samples are refreshed in the
+	background so that placing a request never waits on the
+	remote Docker APIs.
+
+	Strategies:
+		least-loaded:
+			Node with the lowest CPU/memory utilization
+		bin-pack:
+			Most utilized node that still has room, so
+			that the other nodes stay free
+		spread:
+			Node running the fewest services
+		proximity:
+			Node serving the subnet the requesting client
+			is on, then its configured neighbours, then the
+			node the fallback strategy picks
+'''
+
+'''
+	Class: NodeLoad
+
+	Member Variables:
+		ip:
+			IP address of the node
+		services:
+			Number of services running on the node,
+			including deploys that are still in flight
+		free_ports:
+			Number of host ports still available
+		cpu:
+			Fraction of the node's CPUs in use
+		memory:
+			Fraction of the node's memory in use
+		cost:
+			Estimated utilization one more service adds
+'''
+class NodeLoad:
+
+    __slots__ = ("ip", "services", "free_ports", "cpu", "memory", "cost")
+
+    def __init__(self, ip, services=0, free_ports=1, cpu=0.0, memory=0.0, cost=0.0):
+        self.ip = ip
+        self.services = services
+        self.free_ports = free_ports
+        self.cpu = cpu
+        self.memory = memory
+        self.cost = cost
+
+    def utilization(self):
+        return max(self.cpu, self.memory)
+
+    def __repr__(self):
+        return "NodeLoad({}, services={}, cpu={:.2f}, memory={:.2f})".format(
+            self.ip, self.services, self.cpu, self.memory)
+
+class LeastLoaded:
+    def choose(self, loads, client_ip=None):
+        return min(loads, key=lambda load: (load.utilization(), load.services))
+
+class BinPack:
+    def choose(self, loads, client_ip=None):
+        return max(loads, key=lambda load: (load.utilization(), load.services))
+
+class Spread:
+    def choose(self, loads, client_ip=None):
+        return min(loads, key=lambda load: (load.services, load.utilization()))
+
+'''
+	Class: Proximity
+
+	Member Variables:
+		subnets:
+			List of (network, node IP) tuples, most
+			specific network first
+		neighbours:
+			Dictionary mapping node IP to the list of
+			nodes to try, nearest first, when it can not
+			take the service
+		fallback:
+			Strategy used when the client is on none of
+			the subnets or none of its nearby nodes can
+			take the service
+'''
+class Proximity:
+
+    def __init__(self, subnets, neighbours, fallback):
+        self.subnets = sorted(subnets, key=lambda subnet: subnet[0].prefixlen, reverse=True)
+        self.neighbours = neighbours
+        self.fallback = fallback
+
+    '''
+	Function:	home_node
+
+	Description:	Return the IP of the node serving the subnet
+			client_ip is on, or None.
+    '''
+    def home_node(self, client_ip):
+        try:
+            address = ipaddress.ip_address(client_ip)
+        except ValueError:
+            return None
+        for network, ip in self.subnets:
+            if address.version == network.version and address in network:
+                return ip
+        return None
+
+    def choose(self, loads, client_ip=None):
+        home = self.home_node(client_ip) if client_ip is not None else None
+        if home is not None:
+            by_ip = {load.ip: load for load in loads}
+            for ip in [home] + self.neighbours.get(home, []):
+                if ip in by_ip:
+                    return by_ip[ip]
+        return self.fallback.choose(loads, client_ip)
+
+STRATEGIES = {
+    "least-loaded": LeastLoaded,
+    "bin-pack": BinPack,
+    "spread": Spread,
+}
+
+'''
+	Class: Placer
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services are placed on
+		strategy:
+			Strategy object choosing among the nodes that
+			can take another service
+		load_interval:
+			Seconds between two refreshes of the load
+			samples
+		max_utilization:
+			A node is not considered if the new service
+			would take its CPU or memory utilization over
+			this fraction
+		max_services:
+			Nodes running this many services are not
+			considered (None for no limit)
+		service_cost:
+			Utilization assumed for a service until the
+			fleet runs services to estimate it from
+		subnets:
+			Dictionary mapping IP of managed nodes to the
+			list of client subnets they serve (proximity
+			strategy only)
+		neighbours:
+			Dictionary mapping IP of managed nodes to the
+			list of nodes nearest to them (proximity
+			strategy only)
+		fallback:
+			Strategy the proximity strategy falls back to
+		samples:
+			Dictionary mapping IP of managed nodes to their
+			last load sample (dictionary from
+			DockerSwarm.get_node_load)
+		pending:
+			Dictionary mapping IP of managed nodes to the
+			[services, cpu, memory] placed on it since its
+			last load sample
+		image_costs:
+			Dictionary mapping image name to the average
+			(cpu, memory) utilization of one of its
+			containers across the fleet
+		fleet_cost:
+			Average (cpu, memory) utilization of one
+			container across the fleet
+'''
+class Placer:
+
+    def __init__(self, swarm, strategy="least-loaded", load_interval=10,
+                 max_utilization=0.9, max_services=None, service_cost=0.1,
+                 subnets=None, neighbours=None, fallback="least-loaded"):
+        if fallback not in STRATEGIES:
+            raise ValueError("unknown placement strategy {}".format(fallback))
+        self.swarm = swarm
+        self.strategy_name = strategy
+        if strategy == "proximity":
+            networks = []
+            for ip, node_subnets in (subnets or {}).items():
+                for subnet in node_subnets:
+                    networks.append((ipaddress.ip_network(subnet, strict=False), ip))
+            self.strategy = Proximity(networks, neighbours or {}, STRATEGIES[fallback]())
+        elif strategy in STRATEGIES:
+            self.strategy = STRATEGIES[strategy]()
+        else:
+            raise ValueError("unknown placement strategy {}".format(strategy))
+        self.load_interval = load_interval
+        self.max_utilization = max_utilization
+        self.max_services = max_services
+        self.service_cost = service_cost
+        self.samples = {}
+        self.pending = {}
+        self.image_costs = {}
+        self.fleet_cost = (service_cost, service_cost)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    '''
+	Function:	start
+
+	Description:	Start refreshing the load samples in the
+			background every load_interval seconds.
+    '''
+    def start(self):
+        self.thread = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def refresh_loop(self):
+        while not self.stop_event.is_set():
+            self.refresh()
+            self.stop_event.wait(self.load_interval)
+
+    '''
+	Function:	refresh
+
+	Description:	Sample the load of every node concurrently
+			and update the cost estimates. Nodes that can
+			not be queried keep their previous sample.
+    '''
+    def refresh(self):
+        ips = list(self.swarm.nodes.keys())
+        if not ips:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ips), 16)) as pool:
+            samples = dict(zip(ips, pool.map(self.swarm.get_node_load, ips)))
+        self.update(samples)
+
+    '''
+	Function:	update
+
+	Description:	Replace the load samples of the nodes in
+			samples, a dictionary mapping node IP to a load
+			sample or None, and update the cost estimates.
+			Called by refresh, or by the telemetry collector
+			when it samples the nodes instead.
+    '''
+    def update(self, samples):
+        with self.lock:
+            for ip, sample in samples.items():
+                if sample is None:
+                    print("Error: could not sample load of {}".format(ip), file=sys.stderr)
+                    continue
+                self.samples[ip] = sample
+                self.pending[ip] = [0, 0.0, 0.0]
+
+            totals = {}
+            for sample in self.samples.values():
+                for image, (cpu, memory, count) in sample.get("images", {}).items():
+                    total = totals.setdefault(image, [0.0, 0.0, 0])
+                    total[0] += cpu
+                    total[1] += memory
+                    total[2] += count
+            self.image_costs = {image: (cpu / count, memory / count)
+                                for image, (cpu, memory, count) in totals.items() if count}
+            count = sum(total[2] for total in totals.values())
+            if count > 0:
+                self.fleet_cost = (sum(total[0] for total in totals.values()) / count,
+                                   sum(total[1] for total in totals.values()) / count)
+
+    '''
+	Function:	cost
+
+	Description:	Return the estimated (cpu, memory) utilization
+			of one container of image.
+    '''
+    def cost(self, image):
+        if image is None:
+            return self.fleet_cost
+        return self.image_costs.get(swarm_module.image_name(image), self.fleet_cost)
+
+    '''
+	Function:	node_loads
+
+	Description:	Return a NodeLoad for every managed node, with
+			cost set to the estimated utilization of one
+			more container of image. The service and port
+			counts come straight from the swarm object; CPU
+			and memory come from the last sample plus the
+			estimated cost of the services placed since.
+    '''
+    def node_loads(self, image=None):
+        loads = []
+        cost = max(self.cost(image))
+        with self.lock:
+            for ip in list(self.swarm.nodes.keys()):
+                sample = self.samples.get(ip, {})
+                (pending, pending_cpu, pending_memory) = self.pending.get(ip, (0, 0.0, 0.0))
+                services = self.swarm.services.count(ip)
+                loads.append(NodeLoad(ip,
+                                      services=max(services, sample.get("services", 0) + pending),
+                                      free_ports=self.swarm.free_ports(ip),
+                                      cpu=sample.get("cpu", 0.0) + pending_cpu,
+                                      memory=sample.get("memory", 0.0) + pending_memory,
+                                      cost=cost))
+        return loads
+
+    '''
+	Function:	feasible
+
+	Description:	Return True if the node is up, answers Docker
+			API calls, is not being drained and can take
+			another service without going over
+			max_utilization.
+    '''
+    def feasible(self, load):
+        if not self.swarm.is_node_ready(load.ip):
+            return False
+        if self.swarm.is_node_draining(load.ip):
+            return False
+        if not self.swarm.is_node_available(load.ip):
+            return False
+        if load.free_ports <= 0:
+            return False
+        if load.utilization() + load.cost > self.max_utilization:
+            return False
+        if self.max_services is not None and load.services >= self.max_services:
+            return False
+        return True
+
+    '''
+	Function:	place
+
+	Description:	Return the IP of the node the requested
+			application should be deployed on, or None if
+			no node can take it. Nodes without the CPU and
+			memory the application reserves left are
+			skipped. If any of the nodes in prefer can take
+			it, the choice is limited to those, except with
+			the proximity strategy where being near the
+			client comes first. Nodes in exclude are never
+			chosen. Unless reserve is False, the node is
+			counted as running the application until its
+			next load sample.
+    '''
+    def place(self, request, addr=None, prefer=None, exclude=None, reserve=True):
+        image = request.get("image")
+        try:
+            resources = self.swarm.capacity.resources_for(request)
+        except ValueError:
+            return None
+        candidates = [load for load in self.node_loads(image)
+                      if (not exclude or load.ip not in exclude)
+                      and self.feasible(load) and self.swarm.capacity.fits(load.ip, resources)]
+        if not candidates:
+            return None
+        if prefer and not isinstance(self.strategy, Proximity):
+            preferred = [load for load in candidates if load.ip in prefer]
+            if preferred:
+                candidates = preferred
+        client_ip = addr[0] if addr else None
+        ip = self.strategy.choose(candidates, client_ip).ip
+        if reserve:
+            self.reserve(ip, image)
+        return ip
+
+    '''
+	Function:	reserve
+
+	Description:	Count one more container of image on the node
+			with IP server_ip until its next load sample.
+    '''
+    def reserve(self, server_ip, image):
+        (cpu, memory) = self.cost(image)
+        with self.lock:
+            pending = self.pending.setdefault(server_ip, [0, 0.0, 0.0])
+            pending[0] += 1
+            pending[1] += cpu
+            pending[2] += memory
+
+'''
+	Function:	create_placer
+
+	Description:	Create a Placer from the "placement" section
+			of the configuration and the "subnets" of each
+			remote. Exit on error.
+'''
+def create_placer(swarm, config):
+    options = dict(config.get("placement", {}))
+    subnets = {}
+    for ip, remote in config.get("remotes", {}).items():
+        if "subnets" in remote:
+            subnets[ip] = remote["subnets"]
+    options.setdefault("subnets", subnets)
+    try:
+        return Placer(swarm, **options)
+    except (TypeError, ValueError) as e:
+        print(e, file=sys.stderr)
+        print("Error: invalid placement configuration", file=sys.stderr)
+        sys.exit(-1)
@@ -0,0 +1,280 @@
+import sys
+import time
+import threading
+import collections
+import concurrent.futures
+import swarm as swarm_module
+
+'''
+	Warm pool of pre-started services.
+
+	For every configured (image, application port, protocol)
+	the pool keeps a number of services running, unassigned,
+	on each access point. A deploy request for one of them
+	claims a warm service instead of waiting for a new one to
+	be scheduled, created and started, and the pool starts a
+	replacement in the background.
+
+	Warm services carry the label POOL_LABEL=WARM so that a
+	restarted manager adopts them back into the pool. The
+	label is removed once a service has been claimed.
+'''
+
+POOL_LABEL = "edgeap.pool"
+WARM = "warm"
+
+'''
+	Class: WarmPool
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services run on
+		readiness:
+			ReadinessChecker a warm service must pass
+			before it is added to the pool, or None
+		pools:
+			List of pool configurations, dictionaries with
+			image, application_port, protocol, size and an
+			optional list of nodes (default all nodes)
+		warm:
+			Dictionary mapping pool key (image,
+			application_port, protocol, node IP) to a deque
+			of (service_id, port) of unassigned services
+		refilling:
+			Dictionary mapping pool key to the number of
+			services being started for it
+		stats:
+			Counters of claims served from the pool (hits),
+			claims that found it empty (misses), warm
+			services dropped as they could not be relabelled
+			and of the time taken to start warm services
+'''
+class WarmPool:
+
+    def __init__(self, swarm, readiness=None, pools=None, refill_workers=4):
+        self.swarm = swarm
+        self.readiness = readiness
+        self.pools = pools or []
+        self.warm = collections.defaultdict(collections.deque)
+        self.refilling = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=refill_workers,
+                                                              thread_name_prefix="edgeap-pool")
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "relabel_failures": 0,
+            "refills": 0,
+            "refill_failures": 0,
+            "refill_seconds_total": 0.0,
+            "refill_seconds_max": 0.0,
+        }
+
+    '''
+	Function:	start
+
+	Description:	Adopt warm services left by a previous run of
+			the manager, then fill every pool in the
+			background.
+    '''
+    def start(self):
+        if not self.pools:
+            return
+        self.adopt()
+        self.fill()
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+
+    '''
+	Function:	keys
+
+	Description:	Return the pool key of every configured pool
+			on every node it applies to, except the nodes
+			being drained.
+    '''
+    def keys(self):
+        keys = []
+        for pool in self.pools:
+            for ip in pool.get("nodes") or list(self.swarm.nodes.keys()):
+                if not self.swarm.is_node_draining(ip):
+                    keys.append(pool_key(pool, ip))
+        return keys
+
+    def size(self, key):
+        for pool in self.pools:
+            if pool_key(pool, key[3]) == key:
+                return pool.get("size", 1)
+        return 0
+
+    '''
+	Function:	adopt
+
+	Description:	Add services labelled as warm to the pool
+			they belong to.
+    '''
+    def adopt(self):
+        services = self.swarm.get_services()
+        if services is None:
+            return
+        keys = set(self.keys())
+        for service in services:
+            if service["Spec"].get("Labels", {}).get(POOL_LABEL) != WARM:
+                continue
+            record = self.swarm.services.get(service["ID"])
+            if record is None:
+                continue
+            key = (record.image, record.application_port, record.protocol, record.ip)
+            if key in keys:
+                with self.lock:
+                    self.warm[key].append((record.service_id, record.port))
+
+    '''
+	Function:	preferred_nodes
+
+	Description:	Return the set of node IPs holding a warm
+			service matching request.
+    '''
+    def preferred_nodes(self, request):
+        try:
+            key = pool_key(request, None)
+        except (TypeError, ValueError):
+            return set()
+        with self.lock:
+            return {k[3] for k, services in self.warm.items() if k[:3] == key[:3] and services}
+
+    '''
+	Function:	claim
+
+	Description:	Take a warm service matching request on the
+			node with IP server_ip. Return its
+			(service_id, port), or None if there is none.
+			The service's warm label is replaced by labels
+			before it is handed out, so that a restarted
+			manager does not adopt it back; a service that
+			can not be relabelled is removed instead. The
+			pool is refilled in the background.
+    '''
+    def claim(self, server_ip, request, labels=None):
+        try:
+            key = pool_key(request, server_ip)
+        except (TypeError, ValueError):
+            return None
+        with self.lock:
+            if self.warm.get(key):
+                (service_id, port) = self.warm[key].popleft()
+                self.stats["hits"] += 1
+            else:
+                service_id = None
+                if self.size(key) > 0:
+                    self.stats["misses"] += 1
+
+        if service_id is None:
+            return None
+        self.schedule_refill(key)
+        if not self.swarm.set_service_labels(service_id, labels or {}):
+            print("Error: could not relabel warm service {}, removing it".format(service_id), file=sys.stderr)
+            with self.lock:
+                self.stats["relabel_failures"] += 1
+            self.executor.submit(self.swarm.remove_service, server_ip, service_id)
+            return None
+        return (service_id, port)
+
+    '''
+	Function:	fill
+
+	Description:	Start the missing warm services of every pool,
+			e.g. on nodes added to the config.
+    '''
+    def fill(self):
+        for key in self.keys():
+            self.schedule_refill(key)
+
+    '''
+	Function:	discard
+
+	Description:	Remove the warm services on the node with IP
+			server_ip, so that the node can be drained.
+    '''
+    def discard(self, server_ip):
+        with self.lock:
+            services = []
+            for key in [key for key in self.warm if key[3] == server_ip]:
+                services.extend(self.warm.pop(key))
+        for (service_id, _) in services:
+            self.executor.submit(self.swarm.remove_service, server_ip, service_id)
+        return len(services)
+
+    def schedule_refill(self, key):
+        with self.lock:
+            missing = self.size(key) - len(self.warm[key]) - self.refilling[key]
+            self.refilling[key] += max(missing, 0)
+        for _ in range(missing):
+            self.executor.submit(self.refill, key)
+
+    '''
+	Function:	refill
+
+	Description:	Start one warm service for the pool key and
+			add it to the pool once it is ready, so that
+			claiming it needs no wait.
+    '''
+    def refill(self, key):
+        (image, application_port, protocol, ip) = key
+        request = {"image": image, "application_port": application_port, "protocol": protocol}
+        start = time.monotonic()
+        try:
+            (resp, record) = self.swarm.create_service(ip, request, labels={POOL_LABEL: WARM})
+        except Exception as e:
+            print(e, file=sys.stderr)
+            record = None
+        if record is not None and self.readiness is not None:
+            (ready, reason) = self.readiness.wait_ready(record)
+            if not ready:
+                print("Error: warm service {} did not become ready: {}".format(record.service_id, reason),
+                      file=sys.stderr)
+                self.swarm.remove_service(ip, record.service_id)
+                record = None
+        elapsed = time.monotonic() - start
+
+        if record is not None and self.swarm.is_node_draining(ip):
+            # The node was removed from the config while starting it
+            self.swarm.remove_service(ip, record.service_id)
+            record = None
+        with self.lock:
+            self.refilling[key] -= 1
+            if record is None:
+                self.stats["refill_failures"] += 1
+                print("Error: could not start warm service for {}".format(key), file=sys.stderr)
+                return
+            self.warm[key].append((record.service_id, record.port))
+            self.stats["refills"] += 1
+            self.stats["refill_seconds_total"] += elapsed
+            self.stats["refill_seconds_max"] = max(self.stats["refill_seconds_max"], elapsed)
+
+    '''
+	Function:	get_stats
+
+	Description:	Return the pool counters and the number of
+			warm services per pool.
+    '''
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["warm"] = {"{}/{}/{}@{}".format(*key): len(services)
+                             for key, services in self.warm.items()}
+        if stats["refills"]:
+            stats["refill_seconds_avg"] = stats["refill_seconds_total"] / stats["refills"]
+        return stats
+
+'''
+	Function:	pool_key
+
+	Description:	Return the pool key of a pool configuration or
+			deploy request on the node with IP server_ip.
+'''
+def pool_key(request, server_ip):
+    return (swarm_module.image_name(request["image"]),
+            int(request["application_port"]),
+            str(request["protocol"]).lower(),
+            server_ip)
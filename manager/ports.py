@@ -0,0 +1,169 @@
+import array
+import threading
+
+'''
+	Allocation of the host ports services are published on.
+
+	Each node has a PortAllocator over a range of ports. A
+	bitmap records which ports are in use and a ring buffer
+	holds free ports in the order they became free, so both
+	allocating and releasing a port take constant time however
+	full the node is, and a released port is handed out again
+	only after every other free port.
+'''
+
+# Default range of host ports handed out to services, a subset
+# of the ephemeral port range of Linux hosts
+PORT_RANGE_START = 50000
+PORT_RANGE_END = 60000
+
+'''
+	Class: PortAllocator
+
+	Member Variables:
+		start:
+			First port of the range
+		end:
+			Last port of the range (included)
+		used:
+			Bitmap of the ports in use, one byte per port
+			of the range
+		queue:
+			Ring buffer of free ports (offsets from start),
+			oldest first. Ports marked used by mark_used
+			stay queued and are skipped when reached.
+		queued:
+			Bitmap of the ports in the queue, so that no
+			port is queued twice
+		reserved:
+			Set of ports never handed out nor released,
+			e.g. ports used by the host
+'''
+class PortAllocator:
+
+    def __init__(self, start=PORT_RANGE_START, end=PORT_RANGE_END, reserved=()):
+        if not 0 < start <= end <= 65535:
+            raise ValueError("invalid port range {}-{}".format(start, end))
+        self.start = start
+        self.end = end
+        self.size = end - start + 1
+        self.used = bytearray(self.size)
+        self.queued = bytearray(b"\x01" * self.size)
+        self.queue = array.array("H", range(self.size))
+        self.head = 0
+        self.length = self.size
+        self.num_used = 0
+        self.reserved = set()
+        self.lock = threading.RLock()
+        for port in reserved:
+            self.reserve(port)
+
+    '''
+	Function:	allocate
+
+	Description:	Return a free port and mark it used, or None
+			if every port of the range is in use.
+    '''
+    def allocate(self):
+        with self.lock:
+            while self.length:
+                offset = self.queue[self.head]
+                self.head = (self.head + 1) % self.size
+                self.length -= 1
+                self.queued[offset] = 0
+                if not self.used[offset]:
+                    self.used[offset] = 1
+                    self.num_used += 1
+                    return self.start + offset
+            return None
+
+    '''
+	Function:	mark_used
+
+	Description:	Mark port as used, e.g. for a service found
+			when restoring the swarm. Return False if the
+			port is outside of the range or already used.
+    '''
+    def mark_used(self, port):
+        with self.lock:
+            offset = port - self.start
+            if not 0 <= offset < self.size or self.used[offset]:
+                return False
+            self.used[offset] = 1
+            self.num_used += 1
+            return True
+
+    '''
+	Function:	release
+
+	Description:	Make a used port free again. Releasing a free,
+			reserved or out of range port has no effect.
+    '''
+    def release(self, port):
+        with self.lock:
+            offset = port - self.start
+            if not 0 <= offset < self.size or not self.used[offset] or port in self.reserved:
+                return
+            self.used[offset] = 0
+            self.num_used -= 1
+            if not self.queued[offset]:
+                self.queue[(self.head + self.length) % self.size] = offset
+                self.length += 1
+                self.queued[offset] = 1
+
+    '''
+	Function:	reserve
+
+	Description:	Keep port from ever being handed out.
+    '''
+    def reserve(self, port):
+        with self.lock:
+            self.mark_used(port)
+            if self.start <= port <= self.end:
+                self.reserved.add(port)
+
+    def free_count(self):
+        return self.size - self.num_used
+
+    def __contains__(self, port):
+        offset = port - self.start
+        return 0 <= offset < self.size and bool(self.used[offset])
+
+    def __len__(self):
+        return self.num_used
+
+'''
+	Function:	create_allocator
+
+	Description:	Return a PortAllocator for the "ports" section
+			of the configuration file, a dictionary with an
+			optional range [first, last] and an optional
+			list of reserved ports. Raise ValueError if the
+			section is malformed.
+'''
+def create_allocator(config):
+    try:
+        (start, end) = config.get("range", (PORT_RANGE_START, PORT_RANGE_END))
+    except (TypeError, ValueError):
+        raise ValueError("port range must be a list [first, last]")
+    return PortAllocator(int(start), int(end), parse_ports(config.get("reserved")))
+
+'''
+	Function:	parse_ports
+
+	Description:	Return the list of ports in a list of ports
+			and "first-last" ranges, e.g. [8080, "9000-9010"].
+			Raise ValueError on malformed entries.
+'''
+def parse_ports(entries):
+    ports = []
+    for entry in entries or []:
+        if isinstance(entry, int):
+            ports.append(entry)
+            continue
+        (first, sep, last) = str(entry).partition("-")
+        if sep:
+            ports.extend(range(int(first), int(last) + 1))
+        else:
+            ports.append(int(first))
+    return ports
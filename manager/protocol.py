@@ -0,0 +1,287 @@
+import sys
+import json
+import socket
+import struct
+import itertools
+
+'''
+	Control protocol between clients and the management server.
+
+	Every message is a JSON object sent as a frame: a 4 byte
+	big-endian length followed by that many bytes of UTF-8
+	encoded JSON. A connection may carry any number of frames
+	in both directions, so a client can keep one connection
+	open and pipeline several operations on it.
+
+	Requests may carry an "id" which is copied into the
+	matching response, and an "op" naming the operation
+	("deploy", "shutdown", ...). Responses to pipelined
+	requests may arrive out of order; use the id to match
+	them up.
+
+	The manager may also push messages of its own, without an
+	id, on framed connections. {"op": "migrate", "service_id",
+	"new_service_id", "ip", "port"} tells a client that its
+	service was moved to another access point: it should use
+	the new service id, IP and port from then on, as the old
+	service is removed shortly after.
+
+	For backwards compatibility a connection whose first byte
+	is '{' is treated as a legacy connection: requests are bare
+	JSON objects written back to back, and responses are sent
+	back the same way.
+'''
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+# Legacy requests are small objects sent in one write, a longer
+# incomplete one is not waited for
+MAX_LEGACY_SIZE = 64 << 10
+# Bytes a UTF-8 character may have left to arrive in the next read
+MAX_SPLIT_CHAR = 3
+
+class FrameError(Exception):
+    pass
+
+'''
+	Function:	encode_frame
+
+	Description:	Return the frame carrying message.
+'''
+def encode_frame(message):
+    body = json.dumps(message).encode()
+    return HEADER.pack(len(body)) + body
+
+'''
+	Class: FrameDecoder
+
+	Member Variables:
+		buffer:
+			Bytes received on the connection that do
+			not yet make up a complete message
+		framed:
+			True for length-prefixed connections, False
+			for legacy connections and None until the
+			first byte has been received
+'''
+class FrameDecoder:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.framed = None
+        self.json_decoder = json.JSONDecoder()
+
+    '''
+	Function:	feed
+
+	Description:	Append data received on the connection and
+			return the list of messages it completed.
+			A message that is not a valid JSON object is
+			returned as None so the caller can reply
+			with an error. Raise FrameError if the stream
+			can not be recovered.
+    '''
+    def feed(self, data):
+        self.buffer += data
+        if self.framed is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return []
+            self.framed = not stripped.startswith(b"{")
+
+        if self.framed:
+            return self.decode_frames()
+        return self.decode_legacy()
+
+    def decode_frames(self):
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError("frame of {} bytes exceeds limit of {}".format(length, MAX_FRAME_SIZE))
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(decode_message(bytes(self.buffer[HEADER.size:end])))
+            del self.buffer[:end]
+        return messages
+
+    def decode_legacy(self):
+        messages = []
+        while True:
+            text = self.buffer.lstrip()
+            if not text:
+                self.buffer = bytearray()
+                break
+            if not text.startswith(b"{"):
+                # Trailing bytes that can not begin a request
+                messages.append(None)
+                self.buffer = bytearray()
+                break
+            try:
+                decoded = text.decode()
+            except UnicodeDecodeError as e:
+                if len(text) - e.start > MAX_SPLIT_CHAR:
+                    messages.append(None)
+                    self.buffer = bytearray()
+                    break
+                # A multi-byte character may have been split
+                # across reads, wait for the rest of it
+                self.check_legacy_size(text)
+                break
+            try:
+                (message, end) = self.json_decoder.raw_decode(decoded)
+            except ValueError:
+                # Either the object is not complete yet or it is
+                # malformed. Legacy clients send one whole object
+                # per write, so one that looks finished is invalid.
+                if not text.rstrip().endswith(b"}"):
+                    self.check_legacy_size(text)
+                    break
+                messages.append(None)
+                self.buffer = bytearray()
+                break
+            messages.append(message if isinstance(message, dict) else None)
+            self.buffer = bytearray(decoded[end:].encode())
+        return messages
+
+    '''
+	Function:	check_legacy_size
+
+	Description:	Raise FrameError if the incomplete legacy
+			request text is too long to be waited for. The
+			rest of it can not be told apart from the next
+			request, so the connection is answered and
+			closed.
+    '''
+    def check_legacy_size(self, text):
+        if len(text) > MAX_LEGACY_SIZE:
+            self.buffer = bytearray()
+            raise FrameError("Invalid request")
+
+    '''
+	Function:	encode
+
+	Description:	Encode a response for this connection, using
+			the same framing the client used.
+    '''
+    def encode(self, message):
+        if self.framed is False:
+            return json.dumps(message).encode()
+        return encode_frame(message)
+
+'''
+	Function:	decode_message
+
+	Description:	Decode the body of a frame. Return the message
+			dictionary, or None if it is not a JSON object.
+'''
+def decode_message(body):
+    try:
+        message = json.loads(body.decode())
+    except (UnicodeDecodeError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return None
+    if not isinstance(message, dict):
+        return None
+    return message
+
+'''
+	Class: Connection
+
+	Client side of the control protocol. Keeps one persistent
+	connection to the management server and matches responses
+	to requests by id, so several requests can be in flight.
+
+	Member Variables:
+		sock:
+			Connected socket
+		decoder:
+			FrameDecoder for responses
+		pending:
+			Responses received but not yet collected,
+			keyed by request id
+'''
+class Connection:
+
+    def __init__(self, ip, port, timeout=None):
+        self.sock = socket.create_connection((ip, port), timeout=timeout)
+        self.decoder = FrameDecoder()
+        self.decoder.framed = True
+        self.pending = {}
+        self.pushed = []
+        self.ids = itertools.count(1)
+
+    def close(self):
+        self.sock.close()
+
+    '''
+	Function:	send
+
+	Description:	Send a request without waiting for the
+			response. An id is assigned if the request
+			has none. Return the request id.
+    '''
+    def send(self, request):
+        if "id" not in request:
+            request = dict(request, id=next(self.ids))
+        self.sock.sendall(encode_frame(request))
+        return request["id"]
+
+    '''
+	Function:	recv
+
+	Description:	Block until the next message arrives and
+			return it. Return None if the server closed
+			the connection.
+    '''
+    def recv(self):
+        messages = []
+        while not messages:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            messages = self.decoder.feed(data)
+        # Keep any extra messages for later calls
+        for message in messages[1:]:
+            self.store(message)
+        return messages[0]
+
+    def store(self, message):
+        # Messages pushed by the manager carry an op but no id
+        if "id" not in message and "op" in message:
+            self.pushed.append(message)
+        else:
+            self.pending[message.get("id")] = message
+
+    '''
+	Function:	wait
+
+	Description:	Block until the response to request_id
+			arrives and return it.
+    '''
+    def wait(self, request_id):
+        while request_id not in self.pending:
+            message = self.recv()
+            if message is None:
+                raise ConnectionError("connection closed by manager")
+            self.store(message)
+        return self.pending.pop(request_id)
+
+    '''
+	Function:	take_pushed
+
+	Description:	Return the messages pushed by the manager,
+			e.g. "migrate", received so far.
+    '''
+    def take_pushed(self):
+        (pushed, self.pushed) = (self.pushed, [])
+        return pushed
+
+    '''
+	Function:	request
+
+	Description:	Send a request and return its response.
+    '''
+    def request(self, request):
+        return self.wait(self.send(request))
@@ -0,0 +1,90 @@
+import time
+import socket
+
+'''
+	Readiness of newly created services.
+
+	A swarm service exists as soon as it is created, but its
+	task still has to be scheduled, its image pulled and its
+	container started before anything listens on its port. A
+	ReadinessChecker polls the task state of a service until it
+	is running and then, for TCP services, connects to the
+	published port until the application accepts connections.
+'''
+
+# Task states from which a task never reaches "running"
+FAILED_STATES = {"failed", "rejected", "shutdown", "complete", "orphaned", "remove"}
+
+'''
+	Class: ReadinessChecker
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services run on
+		wait:
+			If True, deploys wait for readiness unless the
+			request sets wait_ready to false
+		timeout:
+			Seconds a service may take to become ready
+		poll_interval:
+			Seconds between two polls of the task state or
+			two connection attempts
+		probe:
+			If True, a TCP service is only ready once its
+			published port accepts connections
+'''
+class ReadinessChecker:
+
+    def __init__(self, swarm, wait=False, timeout=30, poll_interval=0.2, probe=True):
+        self.swarm = swarm
+        self.wait = wait
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.probe = probe
+
+    '''
+	Function:	should_wait
+
+	Description:	Return True if the deploy request should be
+			answered only once the application is ready.
+    '''
+    def should_wait(self, request):
+        return bool(request.get("wait_ready", self.wait))
+
+    '''
+	Function:	wait_ready
+
+	Description:	Wait until the service of a ServiceRecord is
+			ready. Return (True, None) once it is, or
+			(False, reason) if its task failed or the
+			timeout expired.
+    '''
+    def wait_ready(self, record, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            tasks = self.swarm.get_service_tasks(record.service_id) or []
+            states = [task.get("Status", {}).get("State") for task in tasks]
+            if "running" in states:
+                break
+            if states and all(state in FAILED_STATES for state in states):
+                errors = [task["Status"].get("Err") for task in tasks if task["Status"].get("Err")]
+                return (False, "task {}: {}".format(states[-1], "; ".join(errors) or "no error reported"))
+            state = states[-1] if states else "not scheduled"
+            if time.monotonic() >= deadline:
+                return (False, "not running after {}s (task {})".format(timeout, state))
+            time.sleep(self.poll_interval)
+
+        if not self.probe or str(record.protocol).lower() != "tcp":
+            return (True, None)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return (False, "port {} not accepting connections after {}s".format(record.port, timeout))
+            try:
+                with socket.create_connection((record.ip, record.port), timeout=min(remaining, 1.0)):
+                    return (True, None)
+            except OSError:
+                time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
@@ -0,0 +1,416 @@
+import sys
+import time
+import threading
+import collections
+import metrics
+
+'''
+	Rebalancing of services between access points.
+
+	A service stays on the access point it was placed on, so an
+	access point can end up running hot while others idle, e.g.
+	once the applications on it got busier. The Rebalancer finds
+	access points whose average CPU or memory use over the last
+	window, as sampled by the telemetry collector, is over
+	hot_threshold, and moves services off them one at a time:
+
+		1. start a replacement on the node the placer picks,
+		   if it stays under hot_threshold with the service;
+		2. wait until the replacement is ready;
+		3. push its service id, IP and port to the client over
+		   the client's control connection, and move the lease;
+		4. remove the old service.
+
+	Only services whose client is connected can be moved: a
+	client learns of the move from a "migrate" message on the
+	connection it deployed or sent heartbeats on. Shared
+	services are not moved.
+'''
+
+MIGRATIONS = metrics.counter("edgeap_migrations_total",
+                             "Service migrations by result", ("result",))
+MIGRATION_SECONDS = metrics.histogram("edgeap_migration_seconds",
+                                      "Time spent in each phase of a service migration", ("phase",))
+
+'''
+	Class: Subscribers
+
+	Member Variables:
+		channels:
+			Dictionary mapping service id to the set of
+			control connections of its clients. A channel
+			has a send(message) method returning False if
+			the message could not be sent.
+		services:
+			Dictionary mapping channel to the set of service
+			ids it is subscribed to
+'''
+class Subscribers:
+
+    def __init__(self):
+        self.channels = collections.defaultdict(set)
+        self.services = collections.defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, service_id, channel):
+        with self.lock:
+            self.channels[service_id].add(channel)
+            self.services[channel].add(service_id)
+
+    '''
+	Function:	unsubscribe
+
+	Description:	Unsubscribe channel from service_id, or from
+			every service if service_id is None, e.g. once
+			the connection closed.
+    '''
+    def unsubscribe(self, channel, service_id=None):
+        with self.lock:
+            service_ids = self.services.get(channel, set())
+            for id in ([service_id] if service_id is not None else list(service_ids)):
+                service_ids.discard(id)
+                subscribed = self.channels.get(id)
+                if subscribed is not None:
+                    subscribed.discard(channel)
+                    if not subscribed:
+                        del self.channels[id]
+            if not service_ids:
+                self.services.pop(channel, None)
+
+    def has(self, service_id):
+        with self.lock:
+            return bool(self.channels.get(service_id))
+
+    '''
+	Function:	move
+
+	Description:	Subscribe the channels of old_id to new_id
+			instead.
+    '''
+    def move(self, old_id, new_id):
+        with self.lock:
+            channels = self.channels.pop(old_id, set())
+            for channel in channels:
+                self.services[channel].discard(old_id)
+                self.services[channel].add(new_id)
+            if channels:
+                self.channels[new_id] |= channels
+
+    '''
+	Function:	notify
+
+	Description:	Send message to every client of service_id.
+			Return the number of clients it was sent to.
+    '''
+    def notify(self, service_id, message):
+        with self.lock:
+            channels = list(self.channels.get(service_id, ()))
+        return sum(1 for channel in channels if channel.send(message))
+
+    def count(self):
+        with self.lock:
+            return len(self.channels)
+
+'''
+	Class: Rebalancer
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services run on
+		placer:
+			Placer choosing the node a service moves to
+		telemetry:
+			TelemetryCollector the node and service loads
+			are read from
+		readiness:
+			ReadinessChecker waiting for replacements
+		subscribers:
+			Subscribers of the services, told of moves
+		leases:
+			LeaseTable whose leases move with the services,
+			or None
+		sharing:
+			SharedInstances whose services are not moved,
+			or None
+		enabled:
+			If False, nothing is moved
+		interval:
+			Seconds between two rebalancing rounds
+		hot_threshold:
+			Average CPU or memory use (a fraction of the
+			node) over which a node is hot
+		window:
+			Seconds of samples averaged
+		max_migrations:
+			Number of services moved per round at most
+		cooldown:
+			Seconds a node is left alone after a service
+			was moved off it, for its samples to catch up
+		grace:
+			Seconds between telling the client and removing
+			the old service, for the client to switch
+		moved:
+			Dictionary mapping node IP to the time a service
+			was last moved off it
+		orphans:
+			Dictionary mapping id of a moved service that
+			could not be removed to the IP of its node; its
+			removal is retried every round
+		stats:
+			Counters of the migrations by result
+'''
+class Rebalancer:
+
+    def __init__(self, swarm, placer, telemetry, readiness, subscribers, leases=None, sharing=None,
+                 enabled=False, interval=30, hot_threshold=0.8, window=60, max_migrations=1,
+                 cooldown=120, grace=2):
+        self.swarm = swarm
+        self.placer = placer
+        self.telemetry = telemetry
+        self.readiness = readiness
+        self.subscribers = subscribers
+        self.leases = leases
+        self.sharing = sharing
+        self.enabled = enabled
+        self.interval = interval
+        self.hot_threshold = hot_threshold
+        self.window = window
+        self.max_migrations = max_migrations
+        self.cooldown = cooldown
+        self.grace = grace
+        self.moved = {}
+        self.orphans = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = collections.Counter()
+
+    def start(self):
+        if not self.enabled:
+            return
+        if not self.telemetry.enabled:
+            print("Error: rebalancing needs telemetry, not rebalancing", file=sys.stderr)
+            return
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.rebalance()
+
+    '''
+	Function:	load
+
+	Description:	Return the average CPU or memory use of the
+			node with IP server_ip over the window, whichever
+			is higher, or None if it has no samples.
+    '''
+    def load(self, server_ip):
+        cpu = self.telemetry.node_mean(server_ip, "cpu", self.window)
+        memory = self.telemetry.node_mean(server_ip, "memory", self.window)
+        if cpu is None or memory is None:
+            return None
+        return max(cpu, memory)
+
+    def service_load(self, service_id):
+        cpu = self.telemetry.service_mean(service_id, "cpu", self.window) or 0.0
+        memory = self.telemetry.service_mean(service_id, "memory", self.window) or 0.0
+        return max(cpu, memory)
+
+    '''
+	Function:	hot_nodes
+
+	Description:	Return the IPs of the nodes over hot_threshold
+			that are not cooling down, hottest first.
+    '''
+    def hot_nodes(self):
+        now = time.monotonic()
+        loads = {}
+        for ip in list(self.swarm.nodes.keys()):
+            with self.lock:
+                if now - self.moved.get(ip, -self.cooldown) < self.cooldown:
+                    continue
+            load = self.load(ip)
+            if load is not None and load > self.hot_threshold:
+                loads[ip] = load
+        return sorted(loads, key=loads.get, reverse=True)
+
+    '''
+	Function:	candidates
+
+	Description:	Return the records of the services on the node
+			with IP server_ip that can be moved, busiest
+			first.
+    '''
+    def candidates(self, server_ip):
+        records = []
+        for record in self.swarm.services.node_services(server_ip):
+            if not self.subscribers.has(record.service_id):
+                continue
+            if self.sharing is not None and record.service_id in self.sharing.clients:
+                continue
+            records.append(record)
+        return sorted(records, key=lambda record: self.service_load(record.service_id), reverse=True)
+
+    '''
+	Function:	rebalance
+
+	Description:	Move up to max_migrations services off the hot
+			nodes. Return the list of (old service id, new
+			ServiceRecord) moved.
+    '''
+    def rebalance(self):
+        self.remove_orphans()
+        moved = []
+        for ip in self.hot_nodes():
+            for record in self.candidates(ip):
+                if len(moved) >= self.max_migrations:
+                    return moved
+                target = self.choose_target(record)
+                if target is None:
+                    continue
+                new_record = self.migrate(record, target)
+                if new_record is not None:
+                    moved.append((record.service_id, new_record))
+                    with self.lock:
+                        self.moved[ip] = time.monotonic()
+                    # Take the node's next samples before moving more off it
+                    break
+        return moved
+
+    '''
+	Function:	choose_target
+
+	Description:	Return the IP of the node the service of record
+			should move to, or None if no node can take it
+			without going over hot_threshold itself. The
+			node is only reserved once the service moved.
+    '''
+    def choose_target(self, record):
+        request = migration_request(record)
+        target = self.placer.place(request, exclude={record.ip}, reserve=False)
+        if target is None:
+            return None
+        load = self.load(target) or 0.0
+        if load + self.service_load(record.service_id) > self.hot_threshold:
+            return None
+        return target
+
+    '''
+	Function:	migrate
+
+	Description:	Move the service of record to the node with IP
+			target_ip. Return the ServiceRecord of the
+			replacement, or None if the service stays where
+			it is.
+    '''
+    def migrate(self, record, target_ip):
+        start = time.perf_counter()
+        ttl = self.leases.ttl_of(record.service_id) if self.leases is not None else None
+        labels = self.leases.labels(ttl) if self.leases is not None else None
+
+        with MIGRATION_SECONDS.time("create"):
+            (resp, new_record) = self.swarm.create_service(target_ip, migration_request(record), labels=labels)
+        if resp is False:
+            return self.fail(record, "create_failed")
+
+        with MIGRATION_SECONDS.time("ready"):
+            (ready, reason) = self.readiness.wait_ready(new_record)
+        if not ready:
+            print("Error: replacement of {} did not become ready: {}".format(record.service_id, reason),
+                  file=sys.stderr)
+            self.swarm.remove_service(target_ip, new_record.service_id)
+            return self.fail(record, "not_ready")
+        if self.swarm.services.get(record.service_id) is None:
+            # Shut down by its client in the meantime
+            self.swarm.remove_service(target_ip, new_record.service_id)
+            return self.fail(record, "gone")
+
+        # The client heartbeats for the new service once told of it
+        if ttl:
+            self.leases.transfer(record.service_id, new_record.service_id)
+        message = {"op": "migrate", "service_id": record.service_id,
+                   "new_service_id": new_record.service_id,
+                   "ip": new_record.ip, "port": new_record.port}
+        with MIGRATION_SECONDS.time("notify"):
+            delivered = self.subscribers.notify(record.service_id, message)
+        if not delivered:
+            if ttl:
+                self.leases.transfer(new_record.service_id, record.service_id)
+            self.swarm.remove_service(target_ip, new_record.service_id)
+            return self.fail(record, "client_gone")
+        self.subscribers.move(record.service_id, new_record.service_id)
+        self.placer.reserve(target_ip, record.image)
+
+        self.stop_event.wait(self.grace)
+        with MIGRATION_SECONDS.time("remove"):
+            removed = self.swarm.remove_service(record.ip, record.service_id)
+        if not removed:
+            print("Error: could not remove {} after moving it, retrying next round".format(record.service_id),
+                  file=sys.stderr)
+            with self.lock:
+                self.orphans[record.service_id] = record.ip
+        MIGRATION_SECONDS.observe(time.perf_counter() - start, "total")
+        result = "migrated" if removed else "old_not_removed"
+        MIGRATIONS.inc(result)
+        with self.lock:
+            self.stats[result] += 1
+        print("Moved service {} from {} to {} as {} in {:.2f}s".format(
+            record.service_id, record.ip, target_ip, new_record.service_id, time.perf_counter() - start))
+        return new_record
+
+    '''
+	Function:	remove_orphans
+
+	Description:	Retry removing the moved services that could
+			not be removed.
+    '''
+    def remove_orphans(self):
+        with self.lock:
+            orphans = list(self.orphans.items())
+        for (service_id, ip) in orphans:
+            if self.swarm.services.get(service_id) is not None and \
+               not self.swarm.remove_service(ip, service_id):
+                continue
+            with self.lock:
+                del self.orphans[service_id]
+                self.stats["orphans_removed"] += 1
+
+    def fail(self, record, result):
+        MIGRATIONS.inc(result)
+        with self.lock:
+            self.stats[result] += 1
+        print("Error: could not move service {} off {}: {}".format(record.service_id, record.ip, result),
+              file=sys.stderr)
+        return None
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["orphans"] = len(self.orphans)
+        stats["subscribed"] = self.subscribers.count()
+        return stats
+
+'''
+	Function:	migration_request
+
+	Description:	Return the deploy request starting a service
+			like the one of record, with its reservations
+			and limits.
+'''
+def migration_request(record):
+    request = {"image": record.image, "application_port": record.application_port,
+               "protocol": record.protocol}
+    resources = {}
+    if record.cpu:
+        resources["cpu"] = record.cpu
+    if record.memory:
+        resources["memory"] = record.memory
+    if record.cpu_limit:
+        resources["cpu_limit"] = record.cpu_limit
+    if record.memory_limit:
+        resources["memory_limit"] = record.memory_limit
+    if resources:
+        request["resources"] = resources
+    return request
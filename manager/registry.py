@@ -0,0 +1,260 @@
+import time
+import threading
+
+'''
+	In-memory registries of swarm state, so that lookups on the
+	request path are dictionary accesses instead of manager API
+	calls.
+'''
+
+'''
+	Class: NodeRegistry
+
+	Member Variables:
+		list_nodes:
+			Function returning the list of swarm nodes (as
+			from APIClient.nodes), or None on failure
+		by_id:
+			Dictionary mapping swarm node id to node
+			dictionary
+		by_ip:
+			Dictionary mapping node IP address to swarm
+			node id
+		min_refresh_interval:
+			Minimum number of seconds between two refreshes
+			triggered by a lookup miss
+'''
+class NodeRegistry:
+
+    def __init__(self, list_nodes, min_refresh_interval=1.0):
+        self.list_nodes = list_nodes
+        self.by_id = {}
+        self.by_ip = {}
+        self.min_refresh_interval = min_refresh_interval
+        self.last_refresh = None
+        self.lock = threading.RLock()
+
+    '''
+	Function:	refresh
+
+	Description:	Rebuild the registry from one listing of the
+			swarm nodes. Return False if the nodes could not
+			be listed.
+    '''
+    def refresh(self):
+        nodes = self.list_nodes()
+        if nodes is None:
+            return False
+        with self.lock:
+            self.by_id = {}
+            self.by_ip = {}
+            for node in nodes:
+                self.add(node)
+            self.last_refresh = time.monotonic()
+        return True
+
+    '''
+	Function:	add
+
+	Description:	Add or update a node. When several nodes have
+			the same address, e.g. after an access point left
+			and joined the swarm again, the address maps to
+			a ready one.
+    '''
+    def add(self, node):
+        with self.lock:
+            node_id = node["ID"]
+            ip = node.get("Status", {}).get("Addr")
+            self.by_id[node_id] = node
+            if ip is None:
+                return
+            current = self.by_id.get(self.by_ip.get(ip))
+            if current is None or current["ID"] == node_id or not is_ready(current):
+                self.by_ip[ip] = node_id
+
+    def remove(self, node_id):
+        with self.lock:
+            node = self.by_id.pop(node_id, None)
+            if node is None:
+                return
+            ip = node.get("Status", {}).get("Addr")
+            if self.by_ip.get(ip) == node_id:
+                del self.by_ip[ip]
+                # Fall back to another node with the same address
+                for other in self.by_id.values():
+                    if other.get("Status", {}).get("Addr") == ip:
+                        self.add(other)
+
+    '''
+	Function:	invalidate
+
+	Description:	Force the next lookup to refresh the registry,
+			e.g. after a node joined the swarm.
+    '''
+    def invalidate(self):
+        with self.lock:
+            self.last_refresh = None
+
+    '''
+	Function:	get
+
+	Description:	Return the node with the IP address server_ip
+			or the swarm node id node_id, or None. On a miss
+			the registry is refreshed, at most once every
+			min_refresh_interval seconds, and the lookup
+			retried.
+    '''
+    def get(self, server_ip=None, node_id=None):
+        node = self.lookup(server_ip, node_id)
+        if node is not None:
+            return node
+        with self.lock:
+            stale = (self.last_refresh is None or
+                     time.monotonic() - self.last_refresh >= self.min_refresh_interval)
+        if stale and self.refresh():
+            return self.lookup(server_ip, node_id)
+        return None
+
+    def lookup(self, server_ip=None, node_id=None):
+        with self.lock:
+            if node_id is not None:
+                return self.by_id.get(node_id)
+            return self.by_id.get(self.by_ip.get(server_ip))
+
+    def nodes(self):
+        with self.lock:
+            return list(self.by_id.values())
+
+def is_ready(node):
+    return node.get("Status", {}).get("State") == "ready"
+
+'''
+	Class: ServiceRecord
+
+	Member Variables:
+		service_id:
+			Swarm service id
+		ip:
+			IP address of the node running the service
+		port:
+			Host port the service is published on
+		image:
+			Image the service runs
+		application_port:
+			Port exposed in the container
+		protocol:
+			Protocol of the published port (tcp or udp)
+		created_at:
+			Time the service was created (seconds since
+			the epoch)
+		cpu:
+			Cores reserved for the service
+		memory:
+			Bytes of memory reserved for the service
+		cpu_limit:
+			Cores the service is capped at, 0 if none
+		memory_limit:
+			Bytes of memory the service is capped at, 0 if
+			none
+'''
+class ServiceRecord:
+
+    __slots__ = ("service_id", "ip", "port", "image", "application_port", "protocol", "created_at",
+                 "cpu", "memory", "cpu_limit", "memory_limit")
+
+    def __init__(self, service_id, ip, port, image=None, application_port=None,
+                 protocol=None, created_at=None, cpu=0.0, memory=0, cpu_limit=0.0, memory_limit=0):
+        self.service_id = service_id
+        self.ip = ip
+        self.port = port
+        self.image = image
+        self.application_port = application_port
+        self.protocol = protocol
+        self.created_at = time.time() if created_at is None else created_at
+        self.cpu = cpu
+        self.memory = memory
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "ServiceRecord({}, {}:{}, {})".format(self.service_id, self.ip, self.port, self.image)
+
+'''
+	Class: ServiceRegistry
+
+	Member Variables:
+		by_id:
+			Dictionary mapping service id to ServiceRecord
+		by_node:
+			Dictionary mapping node IP address to a
+			dictionary mapping service id to ServiceRecord,
+			for the services running on that node
+'''
+class ServiceRegistry:
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_node = {}
+        self.lock = threading.RLock()
+
+    '''
+	Function:	add
+
+	Description:	Add a record. If the service is already
+			registered the existing record is kept and
+			returned; otherwise the new record is returned.
+    '''
+    def add(self, record):
+        with self.lock:
+            existing = self.by_id.get(record.service_id)
+            if existing is not None:
+                return existing
+            self.by_id[record.service_id] = record
+            self.by_node.setdefault(record.ip, {})[record.service_id] = record
+            return record
+
+    '''
+	Function:	remove
+
+	Description:	Remove a service. Return its record, or None
+			if it was not registered.
+    '''
+    def remove(self, service_id):
+        with self.lock:
+            record = self.by_id.pop(service_id, None)
+            if record is not None:
+                self.by_node[record.ip].pop(service_id, None)
+            return record
+
+    def get(self, service_id):
+        return self.by_id.get(service_id)
+
+    '''
+	Function:	has_node
+
+	Description:	Return True if services have been registered
+			on the node with IP server_ip.
+    '''
+    def has_node(self, server_ip):
+        return server_ip in self.by_node
+
+    def count(self, server_ip):
+        return len(self.by_node.get(server_ip, ()))
+
+    def node_services(self, server_ip):
+        with self.lock:
+            return list(self.by_node.get(server_ip, {}).values())
+
+    def ids(self, server_ip):
+        with self.lock:
+            return list(self.by_node.get(server_ip, {}).keys())
+
+    def records(self):
+        with self.lock:
+            return list(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
@@ -0,0 +1,268 @@
+import time
+import random
+import threading
+import docker
+import metrics
+
+'''
+	Resilience of the Docker API calls to the access points.
+
+	An access point that lost power or its uplink makes every
+	call to it block until the connection times out. Calls go
+	through a ResilientClient instead, which retries calls that
+	only read state after a jittered, exponentially growing
+	delay, within a deadline, and keeps a circuit breaker per
+	node: after several failures in a row the node's calls fail
+	right away for a while, and placement skips the node, until
+	a trial call succeeds again.
+
+	Connection errors and server errors that remain after the
+	retries are raised as NodeUnavailable, an APIError, so the
+	callers handle them like any other failed Docker call.
+'''
+
+# Calls that only read state and can be repeated safely
+IDEMPOTENT_METHODS = {
+    "info", "version", "df", "images", "containers", "stats",
+    "inspect_container", "inspect_image", "inspect_node", "inspect_service",
+    "inspect_swarm", "nodes", "services", "tasks",
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+RETRIES = metrics.counter("edgeap_docker_api_retries_total",
+                          "Docker API calls retried after a transient failure", ("method", "node"))
+REJECTED = metrics.counter("edgeap_docker_api_rejected_total",
+                           "Docker API calls failed fast by an open circuit breaker", ("method", "node"))
+TRANSITIONS = metrics.counter("edgeap_circuit_breaker_transitions_total",
+                              "Circuit breaker state changes by node and new state", ("node", "state"))
+
+class NodeUnavailable(docker.errors.APIError):
+    pass
+
+class CircuitOpen(NodeUnavailable):
+    pass
+
+'''
+	Class: CircuitBreaker
+
+	Member Variables:
+		node:
+			Label of the node whose calls go through the
+			breaker
+		failure_threshold:
+			Number of failures in a row that open the
+			breaker
+		reset_timeout:
+			Seconds the breaker stays open before letting a
+			trial call through
+		state:
+			CLOSED (calls go through), OPEN (calls fail fast)
+			or HALF_OPEN (one trial call is in flight)
+		failures:
+			Number of failures in a row
+		opened_at:
+			Time the breaker last opened
+'''
+class CircuitBreaker:
+
+    def __init__(self, node, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.node = node
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    '''
+	Function:	allow
+
+	Description:	Return True if a call may go through. Once
+			reset_timeout has passed, an open breaker lets
+			one trial call through.
+    '''
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.set_state(HALF_OPEN)
+                return True
+            return False
+
+    def available(self):
+        with self.lock:
+            return self.state == CLOSED or \
+                (self.state == OPEN and self.clock() - self.opened_at >= self.reset_timeout)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.set_state(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+               (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = self.clock()
+                self.set_state(OPEN)
+
+    def set_state(self, state):
+        self.state = state
+        TRANSITIONS.inc(self.node, state)
+
+'''
+	Class: ResiliencePolicy
+
+	Member Variables:
+		retries:
+			Number of times an idempotent call is retried
+		backoff:
+			Upper bound in seconds of the delay before the
+			first retry; it doubles with every retry
+		max_backoff:
+			Upper bound in seconds of any delay
+		deadline:
+			Seconds after the first attempt of a call past
+			which it is not retried
+		failure_threshold:
+			Failures in a row that open a node's breaker
+		reset_timeout:
+			Seconds a node's breaker stays open
+		breakers:
+			Dictionary mapping node label to its
+			CircuitBreaker
+'''
+class ResiliencePolicy:
+
+    def __init__(self, retries=2, backoff=0.1, max_backoff=2.0, deadline=10,
+                 failure_threshold=5, reset_timeout=30):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, node):
+        with self.lock:
+            if node not in self.breakers:
+                self.breakers[node] = CircuitBreaker(node, self.failure_threshold, self.reset_timeout)
+            return self.breakers[node]
+
+    '''
+	Function:	wrap
+
+	Description:	Return client wrapped in a ResilientClient for
+			node, with a circuit breaker if breaker is True.
+			Return client itself if it is None or wrapped
+			already.
+    '''
+    def wrap(self, client, node, breaker=True):
+        if client is None or isinstance(client, ResilientClient):
+            return client
+        return ResilientClient(client, node, self, self.breaker(node) if breaker else None)
+
+    '''
+	Function:	available
+
+	Description:	Return False if the breaker of node is open,
+			i.e. calls to it would fail fast.
+    '''
+    def available(self, node):
+        with self.lock:
+            breaker = self.breakers.get(node)
+        return breaker is None or breaker.available()
+
+    def delay(self, attempt):
+        # Full jitter: spread the retries of concurrent callers
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get_stats(self):
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return {breaker.node: {"state": breaker.state, "failures": breaker.failures}
+                for breaker in breakers}
+
+'''
+	Class: ResilientClient
+
+	Member Variables:
+		client:
+			Docker API client whose calls are protected
+		node:
+			Label of the client's node, its IP or "manager"
+		policy:
+			ResiliencePolicy with the retry settings
+		breaker:
+			CircuitBreaker of the node, or None
+'''
+class ResilientClient:
+
+    def __init__(self, client, node, policy, breaker=None):
+        self.client = client
+        self.node = node
+        self.policy = policy
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        retries = self.policy.retries if name in IDEMPOTENT_METHODS else 0
+
+        def call(*args, **kwargs):
+            return self.call(name, attribute, retries, args, kwargs)
+        return call
+
+    def call(self, name, func, retries, args, kwargs):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                REJECTED.inc(name, self.node)
+                raise CircuitOpen("{} is unavailable, not calling {}".format(self.node, name))
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not transient(e):
+                    # The node answered, it is up
+                    if self.breaker is not None:
+                        self.breaker.record_success()
+                    raise
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                delay = self.policy.delay(attempt)
+                if attempt >= retries or time.monotonic() - start + delay > self.policy.deadline:
+                    if isinstance(e, docker.errors.APIError):
+                        raise
+                    raise NodeUnavailable("{} failed on {}: {}".format(name, self.node, e)) from e
+                attempt += 1
+                RETRIES.inc(name, self.node)
+                time.sleep(delay)
+                continue
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return result
+
+'''
+	Function:	transient
+
+	Description:	Return True if an exception raised by a Docker
+			API call means the node could not serve it:
+			a connection error or timeout, or a server error.
+'''
+def transient(e):
+    if isinstance(e, docker.errors.APIError):
+        is_server_error = getattr(e, "is_server_error", None)
+        return bool(is_server_error and is_server_error())
+    # The connection errors and timeouts of requests are OSErrors
+    return isinstance(e, OSError)
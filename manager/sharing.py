@@ -0,0 +1,321 @@
+import sys
+import threading
+import collections
+import concurrent.futures
+import pool as pool_module
+import swarm as swarm_module
+
+'''
+	Shared service instances.
+
+	Stateless applications such as the face recognition
+	server can serve several clients from one container. When
+	sharing is enabled, a deploy request identical to one
+	already served on the chosen access point (same image,
+	application port and protocol) is attached to the running
+	service, up to max_clients clients per service, instead of
+	starting a new one. A shutdown request detaches its client
+	and the service is only removed once its last client has
+	detached. Clients with a lease hold one lease per
+	attachment, and a client whose lease expires is detached
+	the same way.
+
+	Shared services carry the label SHARED_LABEL=<clients> so
+	that a restarted manager knows how many clients still use
+	them.
+'''
+
+SHARED_LABEL = "edgeap.shared"
+
+'''
+	Class: SharedInstances
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the services run on
+		enabled:
+			If True, deploys are shared unless the request
+			sets shared to false
+		max_clients:
+			Number of clients one service serves at most
+		images:
+			List of images that may be shared, or None for
+			every image
+		instances:
+			Dictionary mapping pool key (image,
+			application_port, protocol, node IP) to the list
+			of service ids of the shared services
+		clients:
+			Dictionary mapping service id to its number of
+			clients
+		labels:
+			Dictionary mapping service id to the labels it
+			was created with, kept when its client count
+			label is updated
+		closing:
+			Set of service ids whose last client detached,
+			being removed; they take no new clients
+		stats:
+			Counters of clients attached to a running service,
+			of shared services started, of clients detached
+			and of shared services removed
+'''
+class SharedInstances:
+
+    def __init__(self, swarm, enabled=False, max_clients=4, images=None):
+        self.swarm = swarm
+        self.enabled = enabled
+        self.max_clients = max_clients
+        self.images = {swarm_module.image_name(image) for image in images} if images else None
+        self.instances = collections.defaultdict(list)
+        self.clients = {}
+        self.keys = {}
+        self.labels = {}
+        self.closing = set()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+                                                              thread_name_prefix="edgeap-sharing")
+        self.stats = {
+            "attached": 0,
+            "started": 0,
+            "detached": 0,
+            "removed": 0,
+        }
+
+    '''
+	Function:	start
+
+	Description:	Adopt the shared services left by a previous
+			run of the manager, with the client count of
+			their label.
+    '''
+    def start(self):
+        services = self.swarm.get_services()
+        for service in services or []:
+            labels = dict(service.get("Spec", {}).get("Labels", {}))
+            clients = labels.pop(SHARED_LABEL, None)
+            record = self.swarm.services.get(service["ID"])
+            if clients is None or record is None:
+                continue
+            try:
+                clients = int(clients)
+            except ValueError:
+                print("Error: service {} has an invalid client count {}".format(service["ID"], clients),
+                      file=sys.stderr)
+                continue
+            key = (record.image, record.application_port, record.protocol, record.ip)
+            with self.lock:
+                self.add_instance(key, record.service_id, clients, labels)
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+
+    '''
+	Function:	should_share
+
+	Description:	Return True if the deploy request may be
+			served by a shared service.
+    '''
+    def should_share(self, request):
+        if not request.get("shared", self.enabled):
+            return False
+        return self.images is None or \
+            swarm_module.image_name(request["image"]) in self.images
+
+    '''
+	Function:	preferred_nodes
+
+	Description:	Return the set of node IPs running a shared
+			service matching request that can take another
+			client.
+    '''
+    def preferred_nodes(self, request):
+        try:
+            key = pool_module.pool_key(request, None)
+        except (TypeError, ValueError):
+            return set()
+        with self.lock:
+            return {k[3] for k, service_ids in self.instances.items()
+                    if k[:3] == key[:3] and
+                    any(self.clients[service_id] < self.max_clients and service_id not in self.closing
+                        for service_id in service_ids)}
+
+    '''
+	Function:	attach
+
+	Description:	Attach a client to the shared service matching
+			request on the node with IP server_ip that has
+			the fewest clients. Return its (service_id, port,
+			clients), or None if every such service is full.
+    '''
+    def attach(self, server_ip, request):
+        try:
+            key = pool_module.pool_key(request, server_ip)
+        except (TypeError, ValueError):
+            return None
+        with self.lock:
+            best = None
+            for service_id in list(self.instances.get(key, [])):
+                record = self.swarm.services.get(service_id)
+                if record is None:
+                    # Removed outside of a shutdown request, e.g. by the lease reaper
+                    self.remove_instance(service_id)
+                    continue
+                if service_id in self.closing:
+                    continue
+                if self.clients[service_id] < self.max_clients and \
+                   (best is None or self.clients[service_id] < self.clients[best[0]]):
+                    best = (service_id, record.port)
+            if best is None:
+                return None
+            (service_id, port) = best
+            self.clients[service_id] += 1
+            self.stats["attached"] += 1
+            clients = self.clients[service_id]
+        self.save_clients(service_id)
+        return (service_id, port, clients)
+
+    '''
+	Function:	shared_labels
+
+	Description:	Return labels extended with the label of a new
+			shared service with one client.
+    '''
+    def shared_labels(self, labels):
+        return dict(labels or {}, **{SHARED_LABEL: "1"})
+
+    '''
+	Function:	add
+
+	Description:	Register a service started for request on the
+			node with IP server_ip as shared, with one client.
+    '''
+    def add(self, server_ip, request, service_id, labels=None):
+        key = pool_module.pool_key(request, server_ip)
+        with self.lock:
+            self.add_instance(key, service_id, 1, labels or {})
+            self.stats["started"] += 1
+
+    def add_instance(self, key, service_id, clients, labels):
+        self.instances[key].append(service_id)
+        self.clients[service_id] = clients
+        self.keys[service_id] = key
+        self.labels[service_id] = labels
+
+    def remove_instance(self, service_id):
+        self.closing.discard(service_id)
+        key = self.keys.pop(service_id)
+        self.instances[key].remove(service_id)
+        if not self.instances[key]:
+            del self.instances[key]
+        del self.clients[service_id]
+        del self.labels[service_id]
+
+    '''
+	Function:	detach
+
+	Description:	Detach a client from the service service_id.
+			Return the number of clients left, or None if
+			it is not shared. If it was the last client, 0
+			is returned and the service takes no new clients;
+			the caller removes it and calls removed, or
+			restore if it could not be removed.
+    '''
+    def detach(self, service_id):
+        with self.lock:
+            if service_id not in self.clients or service_id in self.closing:
+                return None
+            self.stats["detached"] += 1
+            if self.clients[service_id] <= 1:
+                self.closing.add(service_id)
+                return 0
+            self.clients[service_id] -= 1
+            clients = self.clients[service_id]
+        self.save_clients(service_id)
+        return clients
+
+    def removed(self, service_id):
+        with self.lock:
+            self.closing.discard(service_id)
+            if service_id in self.clients:
+                self.remove_instance(service_id)
+                self.stats["removed"] += 1
+
+    '''
+	Function:	restore
+
+	Description:	Keep the last client of a service that detach
+			left to be removed, as removing it failed.
+    '''
+    def restore(self, service_id):
+        with self.lock:
+            if service_id in self.closing:
+                self.closing.discard(service_id)
+                self.stats["detached"] -= 1
+
+    '''
+	Function:	reconcile
+
+	Description:	Set the number of clients of the service
+			service_id, e.g. to the clients that renewed
+			their lease after the manager restarted. Return
+			it as detach does.
+    '''
+    def reconcile(self, service_id, clients):
+        with self.lock:
+            if service_id not in self.clients or service_id in self.closing:
+                return None
+            if clients <= 0:
+                self.closing.add(service_id)
+                return 0
+            self.clients[service_id] = clients
+        self.save_clients(service_id)
+        return clients
+
+    def is_shared(self, service_id):
+        with self.lock:
+            return service_id in self.clients
+
+    def is_closing(self, service_id):
+        with self.lock:
+            return service_id in self.closing
+
+    def client_count(self, service_id):
+        with self.lock:
+            return self.clients.get(service_id, 0)
+
+    '''
+	Function:	save_clients
+
+	Description:	Write the client count of a shared service to
+			its label in the background. Several changes in
+			a row are written once.
+    '''
+    def save_clients(self, service_id):
+        with self.lock:
+            if service_id in self.pending:
+                return
+            self.pending.add(service_id)
+        self.executor.submit(self.write_clients, service_id)
+
+    def write_clients(self, service_id):
+        with self.lock:
+            self.pending.discard(service_id)
+            if service_id not in self.clients:
+                return
+            labels = dict(self.labels[service_id], **{SHARED_LABEL: str(self.clients[service_id])})
+        self.swarm.set_service_labels(service_id, labels)
+
+    '''
+	Function:	get_stats
+
+	Description:	Return the sharing counters and the number of
+			shared services and of the clients they serve.
+    '''
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["instances"] = len(self.clients)
+            stats["clients"] = sum(self.clients.values())
+        return stats
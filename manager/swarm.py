@@ -2,7 +2,34 @@ import sys
 import os
 import docker
 import json
-import random
+import time
+import calendar
+import threading
+import concurrent.futures
+import registry
+import ports
+import journal
+import metrics
+import resilience
+import async_docker
+import fleet
+import capacity
+
+# Label of the containers run by swarm services
+SERVICE_ID_LABEL = "com.docker.swarm.service.id"
+
+# Number of access points operated on at once when joining,
+# restoring or shutting down the swarm, and seconds one Docker
+# API call to an access point may take
+DEFAULT_NODE_WORKERS = 16
+DEFAULT_NODE_TIMEOUT = 30
+# Containers of one access point whose stats are read at once; the
+# daemon takes a second or two to sample each, and docker.APIClient
+# keeps up to 10 connections to it
+STATS_WORKERS = 8
+
+CREATE_STEP_SECONDS = metrics.histogram("edgeap_create_service_step_seconds",
+                                        "Duration of the steps of creating a service", ("step",))
 
 class DockerSwarm:
 
@@ -21,34 +48,160 @@ class DockerSwarm:
 		nodes:
     			Dictionary mapping IP of managed nodes to
 			their docker connection object
+		remotes:
+			Dictionary mapping IP of the managed nodes read
+			from the config to their (port, tls_config)
+		clients:
+			ClientPool of the connections to the nodes read
+			from the config, opened on first use and closed
+			once idle
+		draining:
+			Set of IPs of nodes removed from the config that
+			still run services; they take no new services
+			and leave the swarm once the last one is gone
 		services:
-			Dictionary mapping IP of managed nodes to
-			list of services (dictionaries)
+			ServiceRegistry of the services placed by this
+			manager, indexed by service id and by node
 		ports:
 			Dictionary mapping IP of managed nodes to
-			list of ports used by services on that node
+			the PortAllocator of that node
+		port_config:
+			The "ports" section of the configuration, the
+			range of ports handed out and reserved ports
+		node_workers:
+			Number of access points joined, restored or
+			shut down at once
+		node_timeout:
+			Seconds an operation on one access point may
+			take before it is reported as failed
 		join_token:
 			Token used by worker nodes to join the swarm
+		node_registry:
+			Index of the swarm nodes by IP and by node id,
+			so node lookups do not list every node
+		journal:
+			Journal the tracked services are saved to, or
+			None if the config has no journal section
+		reconciled:
+			Event set once the state restored from the
+			journal has been checked against the swarm
+		resilience:
+			ResiliencePolicy the Docker API calls go
+			through, with a circuit breaker per node
+		capacity:
+			CapacityLedger of the CPU and memory reserved
+			by the services on each node
+		lock:
+			Guards the services and ports dictionaries so
+			concurrent deploys and teardowns can run
+			their Docker API calls outside of it
     '''
-    def __init__(self, config_file):
+    def __init__(self, config_file, manager_ip=None, managed_nodes=None, manager_conn=None,
+                 port_config=None, journal_path=None, resilience_config=None):
         self.config_file = config_file
-        (manager_ip, managed_nodes) = read_config(config_file)
+        # Connections may be passed in instead of read from
+        # the config, e.g. to run against a fake Docker client
+        config = load_config(config_file) if config_file is not None else {}
+        self.remotes = {}
+        if managed_nodes is None:
+            (manager_ip, self.remotes) = read_config(config_file)
+            managed_nodes = {}
+        self.docker_config = config.get("docker")
+        if manager_conn is None:
+            manager_conn = create_connection(remote=False, docker_config=self.docker_config)
         self.manager_ip = manager_ip
+        (self.node_workers, self.node_timeout) = lifecycle_settings(config)
+        # Every Docker API call is counted and timed, retried if it
+        # only reads state, and fails fast while its node is down
+        if resilience_config is None:
+            resilience_config = config.get("resilience", {})
+        self.resilience = resilience.ResiliencePolicy(**resilience_config)
         self.nodes = managed_nodes
-        self.manager_conn = create_connection(remote=False)
-        self.services = {}
+        for ip in list(self.nodes):
+            self.nodes[ip] = self.wrap_client(self.nodes[ip], ip)
+        self.clients = fleet.ClientPool(**config.get("connections", {}))
+        for ip, settings in self.remotes.items():
+            self.nodes[ip] = self.connect(ip, settings)
+        self.clients.start()
+        self.draining = set()
+        self.leaving = set()
+        self.manager_conn = self.resilience.wrap(metrics.instrument(manager_conn, "manager"),
+                                                 "manager", breaker=False)
+        if port_config is None:
+            port_config = config.get("ports")
+        self.port_config = port_config or {}
+        journal_config = config.get("journal", {})
+        if journal_path is None:
+            journal_path = journal_config.get("path")
+        self.journal = None
+        self.reconciled = threading.Event()
+        try:
+            ports.create_allocator(self.port_config)
+        except (ValueError, TypeError, AttributeError) as e:
+            print(e, file=sys.stderr)
+            print("Error: invalid ports section in config file", file=sys.stderr)
+            sys.exit(-1)
+        self.services = registry.ServiceRegistry()
         self.ports = {}
+        self.lock = threading.RLock()
+        self.node_registry = registry.NodeRegistry(self.list_swarm_nodes)
+        self.capacity = capacity.CapacityLedger(self.services, self.node_registry.lookup, image_name,
+                                                **config.get("resources", {}))
         # Initiate a new swarm, get the join token, and make
         # remote managed nodes join the swarm.
         # If a swarm already exists, restore previous state
         resp = self.init_swarm()
         self.join_token = self.get_worker_join_token()
+        state_journal = None
+        if journal_path:
+            state_journal = journal.Journal(journal_path, journal_config.get("fsync", False))
+        if resp is False and state_journal is not None and self.load_state(state_journal):
+            # Serve from the saved state right away and check it
+            # against the swarm in the background
+            print("Swarm already exists. Restored previous state from {}".format(journal_path))
+            self.journal = state_journal
+            threading.Thread(target=self.reconcile, daemon=True).start()
+            return
         if resp is False:
             print("Swarm already exists. Restoring previous state")
             self.restore_old_swarm()
         else:
-            for ip, conn in self.nodes.items():
-                self.join_swarm(conn, ip)
+            self.join_nodes(list(self.nodes.keys()))
+        self.for_each_node(self.seed_host_ports, list(self.nodes.keys()), "seeding host ports")
+        self.journal = state_journal
+        if self.journal is not None:
+            # Whatever was saved is superseded by the state read
+            # from the swarm
+            self.save_snapshot()
+        self.reconciled.set()
+
+    '''
+	Function:	wrap_client
+
+	Description:	Return the connection object client of the node
+			with IP server_ip wrapped so that its calls are
+			measured and go through the node's circuit
+			breaker.
+    '''
+    def wrap_client(self, client, server_ip):
+        return self.resilience.wrap(metrics.instrument(client, server_ip), server_ip)
+
+    '''
+	Function:	connect
+
+	Description:	Return the connection object of a node read
+			from the config, with its (port, tls_config) in
+			settings. The connection is opened by its first
+			call.
+    '''
+    def connect(self, server_ip, settings):
+        return self.wrap_client(self.clients.add(server_ip, self.connection_factory(server_ip, settings)),
+                                server_ip)
+
+    def connection_factory(self, server_ip, settings):
+        (port, tls_config) = settings
+        return lambda: create_connection(True, server_ip, port, tls_config, self.node_timeout,
+                                         self.docker_config)
 
     '''
 	Function: 	init_swarm
@@ -77,29 +230,178 @@ class DockerSwarm:
 			Save the join token.
     '''
     def restore_old_swarm(self):
-        swarm_nodes = self.list_swarm_nodes(filters={"role":"worker"})
+        self.node_registry.refresh()
         ips_in_swarm = []
-        for node in swarm_nodes:
-            ips_in_swarm.append(node["Status"]["Addr"])
+        for node in self.node_registry.nodes():
+            if node["Spec"]["Role"] == "worker":
+                ips_in_swarm.append(node["Status"]["Addr"])
 
         # Only join swarm if not currently in the swarm
-        for ip, conn in self.nodes.items():
-            if ip not in ips_in_swarm:
-                self.join_swarm(conn, ip)
+        self.join_nodes([ip for ip in self.nodes.keys() if ip not in ips_in_swarm])
 
         # Update services and ports
+        self.reconcile_services()
+
+    '''
+	Function:	reconcile_services
+
+	Description:	Bring the tracked services in line with one
+			listing of the swarm's services: track those
+			missing and stop tracking those gone. Services
+			tracked after the listing started are kept.
+    '''
+    def reconcile_services(self):
+        since = time.time()
         services = self.get_services()
+        if services is None:
+            return False
+        listed = set()
         for service in services:
-            service_id = service["ID"]
-            proxy_port = service["Endpoint"]["Spec"]["Ports"][0]["PublishedPort"]
-            node_id = service["Spec"]["TaskTemplate"]["Placement"]["Constraints"][0]
-            node_id = node_id[9:] # Hack: strip off "node.id=="
-            server_ip = self.get_swarm_node(node_id=node_id)["Status"]["Addr"]
-            if server_ip not in self.services:
-                self.services[server_ip] = []
-                self.ports[server_ip] = []
-            self.services[server_ip].append(service_id)
-            self.ports[server_ip].append(proxy_port)
+            listed.add(service["ID"])
+            if self.services.get(service["ID"]) is not None:
+                continue
+            record = self.parse_service(service)
+            if record is not None:
+                self.track_service(record)
+        for record in self.services.records():
+            if record.service_id not in listed and record.created_at < since:
+                self.untrack_service(record.service_id)
+        return True
+
+    '''
+	Function:	reconcile
+
+	Description:	Check the state restored from the journal
+			against the swarm: join the nodes missing from
+			it, update the tracked services and reserve the
+			ports used by the hosts.
+    '''
+    def reconcile(self):
+        start = time.monotonic()
+        self.restore_old_swarm()
+        self.for_each_node(self.seed_host_ports, list(self.nodes.keys()), "seeding host ports")
+        self.reconciled.set()
+        print("Reconciled restored state with the swarm in {:.2f}s".format(time.monotonic() - start))
+
+    '''
+	Function:	load_state
+
+	Description:	Load the tracked services and the node map
+			from a journal. Return False if it holds no
+			saved state.
+    '''
+    def load_state(self, state_journal):
+        (state, entries) = state_journal.load()
+        if state is None and not entries:
+            return False
+        state = state or {}
+        for node in state.get("nodes", []):
+            self.node_registry.add(node)
+        for service in state.get("services", []):
+            self.track_service(registry.ServiceRecord(**service))
+        for entry in entries:
+            if entry.get("op") == "track":
+                self.track_service(registry.ServiceRecord(**entry["service"]))
+            elif entry.get("op") == "untrack":
+                self.untrack_service(entry["service_id"])
+        return True
+
+    '''
+	Function:	save_snapshot
+
+	Description:	Write the tracked services and the node map
+			to the journal's snapshot file.
+    '''
+    def save_snapshot(self):
+        with self.lock:
+            state = {
+                "services": [record.to_dict() for record in self.services.records()],
+                "nodes": self.node_registry.nodes(),
+            }
+            seq = self.journal.rotate()
+        return self.journal.write_snapshot(state, seq)
+
+    '''
+	Function:	parse_service
+
+	Description:	Return a ServiceRecord for a service
+			dictionary, as returned by get_services or
+			get_service_info, or None if the service was
+			not placed by this manager.
+    '''
+    def parse_service(self, service):
+        try:
+            port = service["Spec"]["EndpointSpec"]["Ports"][0]
+            constraints = service["Spec"]["TaskTemplate"]["Placement"]["Constraints"]
+            image = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+        except (KeyError, IndexError, TypeError):
+            print("Error: service {} has no port or placement".format(service.get("ID")), file=sys.stderr)
+            return None
+
+        node_id = None
+        for constraint in constraints or []:
+            (key, sep, value) = constraint.replace(" ", "").partition("==")
+            if sep and key == "node.id":
+                node_id = value
+        swarm_node = self.get_swarm_node(node_id=node_id) if node_id else None
+        if swarm_node is None:
+            print("Error: service {} is placed on unknown node {}".format(service.get("ID"), node_id), file=sys.stderr)
+            return None
+        (cpu, memory) = capacity.reservations(service)
+        (cpu_limit, memory_limit) = capacity.limits(service)
+        return registry.ServiceRecord(service["ID"], swarm_node["Status"]["Addr"],
+                                      port.get("PublishedPort"), image_name(image),
+                                      port.get("TargetPort"), port.get("Protocol"),
+                                      parse_timestamp(service.get("CreatedAt")), cpu, memory,
+                                      cpu_limit, memory_limit)
+
+    '''
+	Function:	track_service
+
+	Description:	Record a ServiceRecord and the port it
+			publishes. Tracking a service twice has no
+			effect. Return the tracked record.
+    '''
+    def track_service(self, record):
+        with self.lock:
+            tracked = self.services.add(record)
+            if tracked is record:
+                if record.port is not None:
+                    self.port_allocator(record.ip).mark_used(record.port)
+                if self.journal is not None:
+                    self.journal.append({"op": "track", "service": record.to_dict()})
+        return tracked
+
+    '''
+	Function:	untrack_service
+
+	Description:	Stop tracking service_id and release its port.
+			Untracking a service twice has no effect. Return
+			the record of the service, or None if it was not
+			tracked.
+    '''
+    def untrack_service(self, service_id):
+        with self.lock:
+            record = self.services.remove(service_id)
+            if record is not None:
+                if record.port is not None:
+                    self.port_allocator(record.ip).release(record.port)
+                if self.journal is not None:
+                    self.journal.append({"op": "untrack", "service_id": service_id})
+        if record is not None and record.ip in self.draining:
+            threading.Thread(target=self.drain_node, args=(record.ip,), daemon=True).start()
+        return record
+
+    '''
+	Function:	get_service_port
+
+	Description:	Return the port a tracked service publishes,
+			or None.
+    '''
+    def get_service_port(self, service_id):
+        record = self.services.get(service_id)
+        return record.port if record else None
+
     '''
 	Function: 	inspect_swarm
 
@@ -142,13 +444,44 @@ class DockerSwarm:
 
         if resp is not True:
             print("Error: Swarm join request unsuccessful", file=sys.stderr)
-        elif server_ip not in self.nodes:
+            return resp
+        # The node is new to the swarm, index it on next lookup
+        self.node_registry.invalidate()
+        if server_ip not in self.nodes:
             # Add remote server to nodes dictionary
             self.nodes[server_ip] = {}
             self.nodes[server_ip]["client_conn"] = client
             #self.nodes[server_ip]["swarm_info"] = self.get_swarm_node(server_ip)
         return resp
 
+    '''
+	Function:	join_nodes
+
+	Description:	Make the managed nodes with the IPs in
+			server_ips join the swarm, several at a time.
+			Return the list of IPs that failed to join.
+    '''
+    def join_nodes(self, server_ips):
+        results = self.for_each_node(lambda ip: self.join_swarm(self.nodes[ip], ip),
+                                     server_ips, "joining the swarm")
+        failed = [ip for ip in server_ips if results.get(ip) is not True]
+        if failed:
+            print("Error: {} of {} nodes failed to join the swarm: {}".format(
+                len(failed), len(server_ips), ", ".join(failed)), file=sys.stderr)
+        return failed
+
+    '''
+	Function:	for_each_node
+
+	Description:	Call func(ip) for every IP in server_ips,
+			node_workers at a time, so that a slow or
+			unreachable access point does not hold up the
+			others. Return a dictionary mapping IP to the
+			result; failures are reported and map to None.
+    '''
+    def for_each_node(self, func, server_ips, what="operation"):
+        return run_parallel(func, server_ips, self.node_workers, self.node_timeout, what)
+
     '''
     	Function: 	leave_swarm
 
@@ -177,11 +510,13 @@ class DockerSwarm:
         try:
             swarm_node_id = self.get_swarm_node(server_ip)["ID"]
             resp = self.manager_conn.remove_node(swarm_node_id, force=True)
-        except (docker.errors.APIError, docker.errors.NotFound) as e:
+        except (docker.errors.APIError, docker.errors.NotFound, TypeError) as e:
             print(e, file = sys.stderr)
 
         if resp is not True:
             print("Error: Removing node failed", file=sys.stderr)
+        else:
+            self.node_registry.remove(swarm_node_id)
         return resp
 
     '''
@@ -192,13 +527,93 @@ class DockerSwarm:
     '''
     def shutdown_swarm(self):
         # Remove all remote nodes from swarm
-        for ip, conn in self.nodes.items():
-            self.leave_swarm(conn)
-            self.remove_node(ip)
+        def shutdown_node(ip):
+            self.leave_swarm(self.nodes[ip])
+            return self.remove_node(ip)
+        self.for_each_node(shutdown_node, list(self.nodes.keys()), "leaving the swarm")
 
         # Remove Manager
         self.leave_swarm(self.manager_conn, force=True)
     
+    '''
+	Function:	reload_config
+
+	Description:	Read the remotes of the config file again and
+			bring the managed nodes in line with them: join
+			the nodes added, drain the nodes removed and
+			reconnect to the nodes whose port or
+			certificates changed. Running services are left
+			alone. Return the (added, removed) lists of
+			IPs, or None if the config can not be read, in
+			which case the current one is kept.
+    '''
+    def reload_config(self):
+        if self.config_file is None:
+            print("Error: no config file to reload", file=sys.stderr)
+            return None
+        try:
+            with open(self.config_file, "r") as f:
+                (_, remotes) = parse_config(json.load(f))
+        except Exception as e:
+            print(e, file=sys.stderr)
+            print("Error: could not reload config file {}, keeping the current one".format(
+                self.config_file), file=sys.stderr)
+            return None
+
+        with self.lock:
+            added = [ip for ip in remotes if ip not in self.nodes]
+            removed = [ip for ip in self.remotes if ip not in remotes and ip not in self.draining]
+            for ip in remotes:
+                if ip in self.draining and ip not in self.leaving:
+                    # Listed again before it was drained
+                    self.draining.discard(ip)
+                if ip in self.remotes and \
+                   connection_settings(remotes[ip]) != connection_settings(self.remotes[ip]):
+                    client = self.clients.get(ip)
+                    if client is not None:
+                        client.reconfigure(self.connection_factory(ip, remotes[ip]))
+            for ip in added:
+                self.nodes[ip] = self.connect(ip, remotes[ip])
+            self.draining.update(removed)
+            self.remotes = remotes
+
+        if added:
+            self.join_nodes(added)
+            self.for_each_node(self.seed_host_ports, added, "seeding host ports")
+        for ip in removed:
+            self.drain_node(ip)
+        print("Reloaded config: {} nodes added, {} draining".format(len(added), len(self.draining)))
+        return (added, removed)
+
+    '''
+	Function:	drain_node
+
+	Description:	Make the draining node with IP server_ip leave
+			the swarm and stop managing it, once no tracked
+			service runs on it. Return True if it was
+			removed.
+    '''
+    def drain_node(self, server_ip):
+        with self.lock:
+            if server_ip not in self.draining or server_ip in self.leaving or \
+               self.services.count(server_ip) > 0:
+                return False
+            self.leaving.add(server_ip)
+            client = self.nodes.get(server_ip)
+        try:
+            if client is not None:
+                self.leave_swarm(client)
+            self.remove_node(server_ip)
+        finally:
+            with self.lock:
+                self.leaving.discard(server_ip)
+                self.draining.discard(server_ip)
+                self.nodes.pop(server_ip, None)
+                self.ports.pop(server_ip, None)
+            self.clients.remove(server_ip)
+        print("Drained node {} and removed it from the swarm".format(server_ip))
+        return True
+
     '''
     	Function: 	list_swarm_nodes
 
@@ -218,12 +633,17 @@ class DockerSwarm:
 
 	Description:	Return information on a specific swarm 
 			node specified by either is IP address
-			or swarm node id.
+			or swarm node id. Lookups without filters
+			are answered from the node registry.
     '''
     def get_swarm_node(self, server_ip=None, node_id=None, filters=None):
         if server_ip == None and node_id == None:
             return None
+        if filters is None:
+            return self.node_registry.get(server_ip=server_ip, node_id=node_id)
         nodes = self.list_swarm_nodes(filters=filters)
+        if nodes is None:
+            return None
         for node in nodes:
             if (node_id is not None and node["ID"]==node_id):
                 return node
@@ -238,53 +658,107 @@ class DockerSwarm:
 			placed on the specific worker node specified by
 			'server_ip'. Port mapping is also configured
 			mapping a port on the host to a port on the 
-			container.
+			container. Return (True, ServiceRecord) on
+			success, (False, None) on failure. If timings is
+			a dictionary, the seconds spent allocating the
+			port, looking up the node and creating the
+			service are added to it. The service reserves
+			and is limited to the CPU and memory of
+			capacity.resources_for(request); it is not
+			created if the node has too little of them left.
     '''
-    def create_service(self, server_ip, request):
+    def create_service(self, server_ip, request, labels=None, timings=None):
+        if timings is None:
+            timings = {}
 
-        # Specify access to container via port mapping
-        proxy_port = self.generate_port_num(server_ip)
-        container_port = request["application_port"]
-        protocol = request["protocol"]
-        publish_mode = 'host'
-        port_config_tuple = (container_port, protocol,publish_mode)
-        port_config_dict = {proxy_port: port_config_tuple}
-        endpoint_spec = docker.types.EndpointSpec(ports=port_config_dict)
+        # Set the service's reservations aside on the node, so that
+        # concurrent deploys can not over-commit it between them
+        try:
+            resources = self.capacity.resources_for(request)
+        except ValueError as e:
+            print("Error: invalid resources: {}".format(e), file=sys.stderr)
+            return (False, None)
+        if not self.capacity.reserve(server_ip, resources):
+            print("Error: node {} does not have the requested CPU and memory left".format(server_ip),
+                  file=sys.stderr)
+            return (False, None)
+        try:
+            return self.start_service(server_ip, request, resources, labels, timings)
+        finally:
+            self.capacity.release(server_ip, resources)
 
-        #proxy_port = None
-        #endpoint_spec = None
-        
-        # Specify image to run and options
-        container_spec = docker.types.ContainerSpec(image=request["image"],
-        					     tty=True)
+    def start_service(self, server_ip, request, resources, labels, timings):
+        # Specify access to container via port mapping.
+        # The port is reserved up front so that concurrent
+        # deploys on the same node never pick the same one.
+        start = time.perf_counter()
+        proxy_port = self.reserve_port(server_ip)
+        timings["port"] = time.perf_counter() - start
+        CREATE_STEP_SECONDS.observe(timings["port"], "port")
+        if proxy_port is None:
+            print("Error: no free port on node {}".format(server_ip), file=sys.stderr)
+            return (False, None)
+        # The port is given back whatever makes the service fail to start
+        created = False
+        try:
+            container_port = request["application_port"]
+            protocol = request["protocol"]
+            publish_mode = 'host'
+            port_config_tuple = (container_port, protocol,publish_mode)
+            port_config_dict = {proxy_port: port_config_tuple}
+            endpoint_spec = docker.types.EndpointSpec(ports=port_config_dict)
 
-        # Specify where to place the container
-        swarm_node_id = self.get_swarm_node(server_ip)["ID"]
-        placement = docker.types.Placement(constraints=["node.id=={}".format(swarm_node_id)])
+            #proxy_port = None
+            #endpoint_spec = None
+        
+            # Specify image to run and options
+            container_spec = docker.types.ContainerSpec(image=request["image"],
+            					     tty=True)
 
-        # Complete service configuration
-        task_template = docker.types.TaskTemplate(container_spec=container_spec,
-        				          resources=None,
-        				          placement=placement)
+            # Specify where to place the container
+            start = time.perf_counter()
+            swarm_node = self.get_swarm_node(server_ip)
+            timings["node"] = time.perf_counter() - start
+            CREATE_STEP_SECONDS.observe(timings["node"], "node")
+            if swarm_node is None:
+                print("Error: node {} is not part of the swarm".format(server_ip), file=sys.stderr)
+                return (False, None)
+            swarm_node_id = swarm_node["ID"]
+            placement = docker.types.Placement(constraints=["node.id=={}".format(swarm_node_id)])
 
-        # Create the service
-        try:
-            service_key = self.manager_conn.create_service(task_template=task_template,
-                                                endpoint_spec=endpoint_spec)
-        except docker.errors.APIError as e:
-            print(e, file=sys.stderr)
-            return(False, None)
+            # Complete service configuration
+            task_template = docker.types.TaskTemplate(container_spec=container_spec,
+            				          resources=capacity.to_docker(resources),
+            				          placement=placement)
 
-        if server_ip not in self.services:
-            self.services[server_ip] = []
-            self.ports[server_ip] = []
+            # Create the service
+            start = time.perf_counter()
+            try:
+                service_key = self.manager_conn.create_service(task_template=task_template,
+                                                    endpoint_spec=endpoint_spec,
+                                                    labels=labels)
+            except docker.errors.APIError as e:
+                print(e, file=sys.stderr)
+                return(False, None)
+            finally:
+                timings["create"] = time.perf_counter() - start
+                CREATE_STEP_SECONDS.observe(timings["create"], "create")
 
-        #service_info = self.get_service_info(service_key["ID"])
+            created = True
 
-        self.services[server_ip].append(service_key["ID"])
-        if proxy_port is not None:
-            self.ports[server_ip].append(proxy_port)
-        return (True, service_key["ID"])
+            # Everything the response needs is known already, so the
+            # service is not inspected after creating it
+            record = self.track_service(registry.ServiceRecord(service_key["ID"], server_ip, proxy_port,
+                                                               image_name(request["image"]),
+                                                               container_port, protocol,
+                                                               cpu=resources.get("cpu", 0.0),
+                                                               memory=resources.get("memory", 0),
+                                                               cpu_limit=resources.get("cpu_limit", 0.0),
+                                                               memory_limit=resources.get("memory_limit", 0)))
+            return (True, record)
+        finally:
+            if not created:
+                self.release_port(server_ip, proxy_port)
 
     '''
     	Function:	remove_service
@@ -292,10 +766,11 @@ class DockerSwarm:
 	Description:	Remove a service specified by service_id.
 			Remove the service and related ports from 
 			being tracked by the services and ports
-			data structures.
+			data structures. The port is known from the
+			service's record, so the service is not
+			inspected first.
     '''
     def remove_service(self, server_ip, service_id):
-        service_info = self.get_service_info(service_id)
         resp = False
         try:
             resp = self.manager_conn.remove_service(service_id)
@@ -306,24 +781,94 @@ class DockerSwarm:
             print("Error: Removing service was unsuccessful", file=sys.stderr)
             return False
         else:
-            # delete service from service dictionary
-            try:
-                self.services[server_ip].remove(service_id)
-            except (KeyError, ValueError) as e:
-                print(e, file=sys.stderr)
-                print("Error while removing service id from swarm object")
-            print(self.services[server_ip])
-
-            # delete port from ports dictionary
-            try:
-                port = service_info["Spec"]["EndpointSpec"]["Ports"][0]["PublishedPort"]
-                self.ports[server_ip].remove(port)
-            except ValueError as e:
-                print(e, file=sys.stderr)
-                print("Error while removing port number from swarm object", file=sys.stderr)
-                
+            # delete service and port from the services and ports
+            # dictionaries; the events watcher may have done so already
+            self.untrack_service(service_id)
             return True
 
+    '''
+	Function:	set_service_labels
+
+	Description:	Replace the labels of a service. The service's
+			tasks are left running. Return True on success,
+			False on failure.
+    '''
+    def set_service_labels(self, service_id, labels):
+        service_info = self.get_service_info(service_id)
+        if service_info is None:
+            return False
+        try:
+            self.manager_conn.update_service(service_id, service_info["Version"]["Index"],
+                                             labels=labels, fetch_current_spec=True)
+        except docker.errors.APIError as e:
+            print(e, file=sys.stderr)
+            return False
+        return True
+
+    '''
+	Function:	get_service_node
+
+	Description:	Return the IP of the node a tracked service
+			runs on, or None.
+    '''
+    def get_service_node(self, service_id):
+        record = self.services.get(service_id)
+        return record.ip if record else None
+
+    '''
+	Function:	inspect_node
+
+	Description:	Return a dictionary containing information
+			about a swarm node, or None.
+    '''
+    def inspect_node(self, node_id):
+        try:
+            return self.manager_conn.inspect_node(node_id)
+        except docker.errors.APIError as e:
+            print(e, file=sys.stderr)
+            return None
+
+    '''
+	Function:	is_node_ready
+
+	Description:	Return False if the swarm reports the node
+			with IP server_ip as not ready (e.g. down).
+			Nodes not known yet are assumed to be ready.
+    '''
+    def is_node_ready(self, server_ip):
+        node = self.node_registry.lookup(server_ip=server_ip)
+        return node is None or registry.is_ready(node)
+
+    '''
+	Function:	is_node_available
+
+	Description:	Return False if calls to the node with IP
+			server_ip fail fast because its circuit breaker
+			is open.
+    '''
+    def is_node_available(self, server_ip):
+        return self.resilience.available(server_ip)
+
+    '''
+	Function:	is_node_draining
+
+	Description:	Return True if the node with IP server_ip was
+			removed from the config and takes no new
+			services.
+    '''
+    def is_node_draining(self, server_ip):
+        return server_ip in self.draining
+
+    '''
+	Function:	has_service
+
+	Description:	Return True if service_id is tracked as
+			running on the node with IP server_ip.
+    '''
+    def has_service(self, server_ip, service_id):
+        record = self.services.get(service_id)
+        return record is not None and record.ip == server_ip
+
     '''
 	Function:	get_services
 
@@ -358,21 +903,143 @@ class DockerSwarm:
         return resp
 
     '''
-	Function:	generate_port_num
+	Function:	get_service_tasks
+
+	Description:	Return the list of tasks of a service, with
+			their state under Status.State, or None.
+    '''
+    def get_service_tasks(self, service_id):
+        try:
+            return self.manager_conn.tasks(filters={"service": service_id})
+        except docker.errors.APIError as e:
+            print(e, file=sys.stderr)
+            return None
+
+    '''
+	Function:	port_allocator
+
+	Description:	Return the PortAllocator of the node with IP
+			server_ip, creating it on first use.
+    '''
+    def port_allocator(self, server_ip):
+        with self.lock:
+            allocator = self.ports.get(server_ip)
+            if allocator is None:
+                allocator = ports.create_allocator(self.port_config)
+                self.ports[server_ip] = allocator
+            return allocator
 
-	Description:	Generate a random port number in the range
-			50000-60000, which is a subset of the ephemeral port
-			range for Linux machines.
     '''
-    def generate_port_num(self, server_ip):
-        port = random.randint(50000,60000)
+	Function:	seed_host_ports
 
-        if (server_ip not in self.ports):
-            return port
+	Description:	Reserve the ports published by containers on
+			the node with IP server_ip that are not run by
+			swarm services, so they are never handed out.
+    '''
+    def seed_host_ports(self, server_ip):
+        containers = get_containers(self.nodes[server_ip])
+        if containers is None:
+            return
+        allocator = self.port_allocator(server_ip)
+        for container in containers:
+            if SERVICE_ID_LABEL in (container.get("Labels") or {}):
+                continue
+            for port in container.get("Ports") or []:
+                if port.get("PublicPort"):
+                    allocator.reserve(port["PublicPort"])
+
+    '''
+	Function:	reserve_port
+
+	Description:	Allocate a port number for server_ip, so that
+			two requests handled at the same time can never
+			be handed the same port. Return None if every
+			port is in use.
+    '''
+    def reserve_port(self, server_ip):
+        return self.port_allocator(server_ip).allocate()
+
+    '''
+	Function:	release_port
+
+	Description:	Return a port reserved by reserve_port, e.g.
+			when creating the service failed.
+    '''
+    def release_port(self, server_ip, port):
+        self.port_allocator(server_ip).release(port)
+
+    def free_ports(self, server_ip):
+        return self.port_allocator(server_ip).free_count()
+
+    '''
+	Function:	get_node_load
+
+	Description:	Return a dictionary describing the load on the
+			node with IP server_ip: the number of services
+			and free ports tracked by the swarm object, and
+			the CPU and memory used by its containers as a
+			fraction of the node's capacity, in total, per
+			image and per container, and the bytes its
+			containers received and sent so far, measured
+			with the node's remote connection. The stats of
+			the containers are read in parallel. Return None
+			if the node can not be queried.
+    '''
+    def get_node_load(self, server_ip):
+        num_services = self.services.count(server_ip)
+        free_ports = self.free_ports(server_ip)
+
+        client = self.nodes[server_ip]
+        info = get_info(client)
+        containers = get_containers(client)
+        if info is None or containers is None:
+            return None
+        ncpu = max(info.get("NCPU", 1), 1)
+        mem_total = max(info.get("MemTotal", 1), 1)
+
+        cpu = 0.0
+        memory = 0.0
+        rx_bytes = 0
+        tx_bytes = 0
+        images = {}
+        per_container = {}
+        samples = run_parallel(lambda container_id: get_stats(client, container_id),
+                               [container["Id"] for container in containers],
+                               STATS_WORKERS, self.node_timeout, "reading container stats")
+        for container in containers:
+            stats = samples.get(container["Id"])
+            if stats is None:
+                continue
+            container_cpu = cpu_cores(stats) / ncpu
+            container_memory = stats.get("memory_stats", {}).get("usage", 0) / mem_total
+            (container_rx, container_tx) = network_bytes(stats)
+            cpu += container_cpu
+            memory += container_memory
+            rx_bytes += container_rx
+            tx_bytes += container_tx
+            per_container[container["Id"]] = {
+                "service_id": (container.get("Labels") or {}).get(SERVICE_ID_LABEL),
+                "cpu": container_cpu,
+                "memory": container_memory,
+                "rx_bytes": container_rx,
+                "tx_bytes": container_tx,
+            }
+            # Keep (cpu, memory, number of containers) per image
+            usage = images.setdefault(image_name(container.get("Image", "")), [0.0, 0.0, 0])
+            usage[0] += container_cpu
+            usage[1] += container_memory
+            usage[2] += 1
 
-        while(port in self.ports[server_ip]):
-            port = random.randint(50000,60000)
-        return port
+        return {
+            "services": num_services,
+            "free_ports": free_ports,
+            "cpu": cpu,
+            "memory": memory,
+            "rx_bytes": rx_bytes,
+            "tx_bytes": tx_bytes,
+            "images": images,
+            "containers": per_container,
+        }
 
 # ------------------------ Helper Functions ------------------------#
 
@@ -382,74 +1049,188 @@ class DockerSwarm:
 	Description:	Read and parse configuration file.
 			Return a tuple (string,dictionary)
 			containing the manager node IP address
-			and a dictionary for all the managed
-			nodes (key: IP, value: swarm connection object).
+			and a dictionary mapping the IP of each
+			managed node to its (port, tls_config).
+			No connection is opened yet. Exit on error.
 '''
 def read_config(config_file):
 
+    config = load_config(config_file)
+    try:
+        return parse_config(config)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        print("Error: error while parsing config file", file=sys.stderr)
+        sys.exit(-1)
+
+'''
+	Function:	parse_config
+
+	Description:	Return the (manager_ip, remotes) of a config
+			dictionary, as read_config does. Raise an
+			exception if they are malformed.
+'''
+def parse_config(config):
+    # Get manager_ip
+    manager_ip = config["manager_ip"]
+    remotes = {}
+    # Find configuration for remote managed nodes
+    # Extract necessary info like ip, port, and tlsconfig
+    for ip, d in config.get("remotes", {}).items():
+        port = d["port"]
+        tls_config = None
+        if d["tlsverify"] == True:
+            certs_path = d["certs_path"]
+            ca_cert = d["tlscacert"]
+            client_cert = d["tlscert"]
+            client_key = d["tlskey"]
+            tls_config = docker.tls.TLSConfig(
+                verify=True,
+                ca_cert=os.path.join(certs_path,ca_cert),
+                client_cert=(os.path.join(certs_path,client_cert),
+                             os.path.join(certs_path,client_key)),
+            )
+        remotes[ip] = (port, tls_config)
+    return (manager_ip, remotes)
+
+'''
+	Function:	connection_settings
+
+	Description:	Return what a node's connection depends on,
+			from its (port, tls_config), to compare two
+			configs of the node.
+'''
+def connection_settings(settings):
+    (port, tls_config) = settings
+    if tls_config is None:
+        return (str(port), None)
+    return (str(port), tls_config.ca_cert, tls_config.cert, tls_config.verify)
+
+'''
+	Function:	lifecycle_settings
+
+	Description:	Return the (workers, timeout) set in the
+			optional "lifecycle" section of the config.
+'''
+def lifecycle_settings(config):
+    lifecycle = config.get("lifecycle", {})
+    return (lifecycle.get("workers", DEFAULT_NODE_WORKERS),
+            lifecycle.get("timeout", DEFAULT_NODE_TIMEOUT))
+
+'''
+	Function:	run_parallel
+
+	Description:	Call func(item) for every item, with at most
+			workers calls running at a time. Return a
+			dictionary mapping each item to the result of
+			its call. Calls that raise, or are still running
+			once every call had timeout seconds to run, are
+			reported and map to None.
+'''
+def run_parallel(func, items, workers=DEFAULT_NODE_WORKERS, timeout=DEFAULT_NODE_TIMEOUT,
+                 what="operation"):
+    items = list(items)
+    if not items:
+        return {}
+    workers = max(1, min(workers, len(items)))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                     thread_name_prefix="edgeap-node")
+    futures = {executor.submit(func, item): item for item in items}
+    # Every call gets timeout seconds, whichever batch it runs in
+    rounds = -(-len(items) // workers)
+    (done, not_done) = concurrent.futures.wait(futures, timeout=timeout * rounds)
+    # Hung calls are left to finish in the background
+    executor.shutdown(wait=False)
+
+    results = {}
+    for future, item in futures.items():
+        if future in not_done:
+            print("Error: {} timed out on {}".format(what, item), file=sys.stderr)
+            results[item] = None
+            continue
+        try:
+            results[item] = future.result()
+        except Exception as e:
+            print("Error: {} failed on {}: {}".format(what, item, e), file=sys.stderr)
+            results[item] = None
+    return results
+            
+'''
+	Function:	load_config
+
+	Description:	Return the configuration file as a dictionary.
+			Sections other than manager_ip and remotes
+			configure optional manager features.
+'''
+def load_config(config_file):
     if not os.path.isfile(config_file):
         print("Error: config file {} does not exist".format(config_file), file=sys.stderr)
         sys.exit(-1)
-    
-    with open(config_file, "r") as f:
-        config = json.load(f)
 
-    manager_ip = ""
-    managed_nodes = {}
     try:
-        # Get manager_ip
-        manager_ip = config["manager_ip"]
-        # Find configuration for remote managed nodes
-        # Extract necessary info like ip, port, and tlsconfig
-        if "remotes" in config:
-            for ip, d in config["remotes"].items():
-                port = d["port"]
-                if d["tlsverify"] == True:
-                    certs_path = d["certs_path"]
-                    ca_cert = d["tlscacert"]
-                    client_cert = d["tlscert"]
-                    client_key = d["tlskey"]
-                    tls_config = docker.tls.TLSConfig(
-                        verify=True,
-                        ca_cert=os.path.join(certs_path,ca_cert),
-                        client_cert=(os.path.join(certs_path,client_cert),
-                                     os.path.join(certs_path,client_key)),
-                    )
-                # Create Docker Swarm remote connection object
-                remote_conn = create_connection(True,ip,port,tls_config)
-                # Add IP and remote_conn to the dictionary
-                managed_nodes[ip] = remote_conn
-    except Exception as e:
+        with open(config_file, "r") as f:
+            return json.load(f)
+    except ValueError as e:
         print(e, file=sys.stderr)
         print("Error: error while parsing config file", file=sys.stderr)
         sys.exit(-1)
 
-    return (manager_ip, managed_nodes)
-            
 '''
 	Function:	create_connection
 
 	Description:	Create a new Docker Swarm connection object.
 			Remote connections must specify an ip and port.
+			docker_config, the optional "docker" section of
+			the config, selects the client: backend "sync"
+			(the default) is docker.APIClient, backend
+			"async" is async_docker.DockerClient, which
+			keeps up to max_connections keep-alive
+			connections to the daemon and makes its calls
+			from an event loop, with API version
+			api_version.
 '''
-def create_connection(remote=False,ip=None, port=None, tls_config=None):
+def create_connection(remote=False,ip=None, port=None, tls_config=None, timeout=None,
+                      docker_config=None):
+    docker_config = docker_config or {}
+    backend = docker_config.get("backend", "sync")
+    if backend not in ("sync", "async"):
+        print("Error: unknown docker backend {}".format(backend), file=sys.stderr)
+        sys.exit(-1)
     client = None
     if (remote == True):
         try:
-            client = docker.APIClient(base_url='tcp://{}:{}'.format(ip,port),
-                                      tls=tls_config
-            )
-        except docker.errors.DockerException as e:
+            if backend == "async":
+                client = async_docker.DockerClient('tcp://{}:{}'.format(ip,port),
+                                                   tls=tls_config,
+                                                   timeout=timeout or DEFAULT_NODE_TIMEOUT,
+                                                   **async_settings(docker_config))
+                # Fail like docker.APIClient, which asks for the
+                # daemon's version when it is created
+                client.version()
+            else:
+                client = docker.APIClient(base_url='tcp://{}:{}'.format(ip,port),
+                                          tls=tls_config,
+                                          timeout=timeout or DEFAULT_NODE_TIMEOUT
+                )
+        except (docker.errors.DockerException, OSError) as e:
             print(e, file=sys.stderr)
     else:
         try:
-            client = docker.APIClient(base_url='unix://var/run/docker.sock')
-        except docker.erros.DockerException as e:
+            if backend == "async":
+                client = async_docker.DockerClient('unix://var/run/docker.sock',
+                                                   **async_settings(docker_config))
+            else:
+                client = docker.APIClient(base_url='unix://var/run/docker.sock')
+        except docker.errors.DockerException as e:
             print(e, file=sys.stderr)
             sys.exit(-1)
 
     return client
 
+def async_settings(docker_config):
+    return {"max_connections": docker_config.get("max_connections", async_docker.DEFAULT_MAX_CONNECTIONS),
+            "version": docker_config.get("api_version", async_docker.DEFAULT_API_VERSION)}
+
 def get_version(client):
     try:
         return client.version()
@@ -463,9 +1244,103 @@ def get_images(client):
         print(e, file=sys.stderr)
         return None
         
+'''
+	Function:	pull_image
+
+	Description:	Pull image (a name normalized by image_name)
+			on the node behind client. Return the pull
+			output, or None on failure.
+'''
+def pull_image(client, image):
+    (repository, tag) = image.rsplit(":", 1)
+    try:
+        return client.pull(repository, tag=tag)
+    except docker.errors.APIError as e:
+        print(e, file=sys.stderr)
+        return None
+
 def get_containers(client):
     try:
         return client.containers()
     except docker.errors.APIError as e:
         print(e, file=sys.stderr)
         return None
+
+def get_info(client):
+    try:
+        return client.info()
+    except docker.errors.APIError as e:
+        print(e, file=sys.stderr)
+        return None
+
+def get_stats(client, container_id):
+    try:
+        return client.stats(container_id, stream=False)
+    except docker.errors.APIError as e:
+        print(e, file=sys.stderr)
+        return None
+
+'''
+	Function:	image_name
+
+	Description:	Normalize an image reference so that the name
+			used in a request and the one reported for a
+			running container compare equal, e.g. "ubuntu",
+			"ubuntu:latest" and "ubuntu:latest@sha256:..."
+			all become "ubuntu:latest".
+'''
+def image_name(image):
+    image = image.split("@", 1)[0]
+    if image.startswith("docker.io/"):
+        image = image[len("docker.io/"):]
+    if image.startswith("library/"):
+        image = image[len("library/"):]
+    # A ':' after the last '/' separates the tag, one before it
+    # belongs to a registry host:port
+    if ":" not in image.rsplit("/", 1)[-1]:
+        image += ":latest"
+    return image
+
+'''
+	Function:	parse_timestamp
+
+	Description:	Return the seconds since the epoch of a
+			timestamp as reported by the Docker API, e.g.
+			"2020-06-04T12:34:56.123456789Z", or None.
+'''
+def parse_timestamp(timestamp):
+    try:
+        return calendar.timegm(time.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+
+'''
+	Function:	network_bytes
+
+	Description:	Return the (received, sent) bytes of all the
+			network interfaces in a container stats sample.
+'''
+def network_bytes(stats):
+    networks = (stats.get("networks") or {}).values()
+    return (sum(network.get("rx_bytes", 0) for network in networks),
+            sum(network.get("tx_bytes", 0) for network in networks))
+
+'''
+	Function:	cpu_cores
+
+	Description:	Return the number of CPU cores a container
+			used between the two samples of a stats
+			response, as computed by `docker stats`.
+'''
+def cpu_cores(stats):
+    try:
+        cpu_stats = stats["cpu_stats"]
+        precpu_stats = stats["precpu_stats"]
+        cpu_delta = cpu_stats["cpu_usage"]["total_usage"] - precpu_stats["cpu_usage"]["total_usage"]
+        system_delta = cpu_stats["system_cpu_usage"] - precpu_stats["system_cpu_usage"]
+    except KeyError:
+        return 0.0
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    online_cpus = cpu_stats.get("online_cpus") or len(cpu_stats["cpu_usage"].get("percpu_usage") or [1])
+    return cpu_delta / system_delta * online_cpus
@@ -0,0 +1,272 @@
+import time
+import array
+import threading
+import swarm as swarm_module
+
+'''
+	Load history of the access points and their services.
+
+	A TelemetryCollector samples the CPU, memory and network use
+	of every container on every access point through the
+	remote connections of the swarm object, at a fixed interval.
+	The samples of each node and of each service are kept in
+	fixed-size ring buffers backed by arrays, so the history
+	takes the same memory however long the manager runs. Other
+	parts of the manager subscribe to the samples, e.g. the
+	placer, and clients query the history with the telemetry
+	operation.
+'''
+
+NODE_FIELDS = ("cpu", "memory", "services", "rx_rate", "tx_rate")
+SERVICE_FIELDS = ("cpu", "memory", "rx_rate", "tx_rate")
+
+'''
+	Class: RingBuffer
+
+	Member Variables:
+		size:
+			Number of samples kept
+		fields:
+			Names of the values of a sample
+		times:
+			Array of the timestamps of the samples
+		values:
+			Dictionary mapping field to the array of its
+			values
+		next:
+			Index the next sample is written to
+		length:
+			Number of samples written so far, at most size
+'''
+class RingBuffer:
+
+    def __init__(self, size, fields):
+        self.size = size
+        self.fields = fields
+        self.times = array.array("d", bytes(8 * size))
+        self.values = {field: array.array("d", bytes(8 * size)) for field in fields}
+        self.next = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, timestamp, sample):
+        self.times[self.next] = timestamp
+        for field in self.fields:
+            self.values[field][self.next] = sample.get(field, 0.0)
+        self.next = (self.next + 1) % self.size
+        self.length = min(self.length + 1, self.size)
+
+    def indices(self):
+        start = (self.next - self.length) % self.size
+        return [(start + i) % self.size for i in range(self.length)]
+
+    '''
+	Function:	series
+
+	Description:	Return the samples taken after since (all if
+			None), oldest first, as a dictionary mapping
+			"time" and every field to a list of values.
+    '''
+    def series(self, since=None):
+        indices = [i for i in self.indices() if since is None or self.times[i] > since]
+        series = {"time": [self.times[i] for i in indices]}
+        for field in self.fields:
+            series[field] = [self.values[field][i] for i in indices]
+        return series
+
+    def latest(self):
+        if self.length == 0:
+            return None
+        i = (self.next - 1) % self.size
+        sample = {field: self.values[field][i] for field in self.fields}
+        sample["time"] = self.times[i]
+        return sample
+
+    '''
+	Function:	mean
+
+	Description:	Return the mean of a field over the samples of
+			the last window seconds (all samples if None),
+			or None if there are none.
+    '''
+    def mean(self, field, window=None):
+        since = time.time() - window if window is not None else None
+        values = [self.values[field][i] for i in self.indices()
+                  if since is None or self.times[i] > since]
+        return sum(values) / len(values) if values else None
+
+'''
+	Class: TelemetryCollector
+
+	Member Variables:
+		swarm:
+			DockerSwarm object the nodes belong to
+		enabled:
+			If False, nothing is sampled and the placer
+			samples the nodes itself
+		interval:
+			Seconds between two samples
+		history:
+			Number of samples kept per node
+		service_history:
+			Number of samples kept per service
+		workers:
+			Number of nodes sampled at once
+		nodes:
+			Dictionary mapping IP of managed nodes to the
+			RingBuffer of their samples (NODE_FIELDS)
+		services:
+			Dictionary mapping service id to the RingBuffer
+			of its samples (SERVICE_FIELDS)
+		counters:
+			Dictionary mapping container id to the (time,
+			received bytes, sent bytes) of its last sample,
+			to turn byte counts into rates
+		listeners:
+			Functions called with every round of samples, a
+			dictionary mapping node IP to the sample from
+			DockerSwarm.get_node_load or None
+'''
+class TelemetryCollector:
+
+    def __init__(self, swarm, enabled=True, interval=10, history=360, service_history=60, workers=16):
+        self.swarm = swarm
+        self.enabled = enabled
+        self.interval = interval
+        self.history = history
+        self.service_history = service_history
+        self.workers = workers
+        self.nodes = {}
+        self.services = {}
+        self.counters = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        if not self.enabled:
+            return
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.collect()
+            self.stop_event.wait(self.interval)
+
+    '''
+	Function:	collect
+
+	Description:	Sample every node concurrently, record the
+			samples and pass them to the listeners. Nodes
+			that can not be queried are skipped.
+    '''
+    def collect(self):
+        ips = list(self.swarm.nodes.keys())
+        if not ips:
+            return
+        samples = swarm_module.run_parallel(self.swarm.get_node_load, ips, self.workers,
+                                            self.swarm.node_timeout, "load sample")
+        self.record(samples, time.time())
+        for listener in self.listeners:
+            listener(samples)
+
+    '''
+	Function:	record
+
+	Description:	Append the samples taken at timestamp to the
+			ring buffers of their nodes and services.
+    '''
+    def record(self, samples, timestamp):
+        with self.lock:
+            seen = set()
+            for ip, sample in samples.items():
+                if sample is None:
+                    continue
+                node = {"cpu": sample["cpu"], "memory": sample["memory"],
+                        "services": sample["services"], "rx_rate": 0.0, "tx_rate": 0.0}
+                services = {}
+                for container_id, container in sample.get("containers", {}).items():
+                    seen.add(container_id)
+                    (rx_rate, tx_rate) = self.rates(container_id, timestamp,
+                                                    container["rx_bytes"], container["tx_bytes"])
+                    node["rx_rate"] += rx_rate
+                    node["tx_rate"] += tx_rate
+                    if container["service_id"] is None:
+                        continue
+                    service = services.setdefault(container["service_id"], dict.fromkeys(SERVICE_FIELDS, 0.0))
+                    service["cpu"] += container["cpu"]
+                    service["memory"] += container["memory"]
+                    service["rx_rate"] += rx_rate
+                    service["tx_rate"] += tx_rate
+
+                if ip not in self.nodes:
+                    self.nodes[ip] = RingBuffer(self.history, NODE_FIELDS)
+                self.nodes[ip].append(timestamp, node)
+                for service_id, service in services.items():
+                    if service_id not in self.services:
+                        self.services[service_id] = RingBuffer(self.service_history, SERVICE_FIELDS)
+                    self.services[service_id].append(timestamp, service)
+
+            # Forget containers and services that are gone
+            for container_id in set(self.counters) - seen:
+                del self.counters[container_id]
+            for service_id in list(self.services):
+                if self.swarm.services.get(service_id) is None:
+                    del self.services[service_id]
+            for ip in list(self.nodes):
+                if ip not in self.swarm.nodes:
+                    del self.nodes[ip]
+
+    def rates(self, container_id, timestamp, rx_bytes, tx_bytes):
+        last = self.counters.get(container_id)
+        self.counters[container_id] = (timestamp, rx_bytes, tx_bytes)
+        if last is None or timestamp <= last[0]:
+            return (0.0, 0.0)
+        elapsed = timestamp - last[0]
+        return (max(rx_bytes - last[1], 0) / elapsed, max(tx_bytes - last[2], 0) / elapsed)
+
+    '''
+	Function:	query
+
+	Description:	Return the history of the node with IP
+			server_ip and of the service service_id, taken
+			after since, or the latest sample of every node
+			and service if neither is given.
+    '''
+    def query(self, server_ip=None, service_id=None, since=None):
+        result = {"nodes": {}, "services": {}}
+        with self.lock:
+            if server_ip is None and service_id is None:
+                result["nodes"] = {ip: buffer.latest() for ip, buffer in self.nodes.items()}
+                result["services"] = {id: buffer.latest() for id, buffer in self.services.items()}
+                return result
+            if server_ip in self.nodes:
+                result["nodes"][server_ip] = self.nodes[server_ip].series(since)
+            if service_id in self.services:
+                result["services"][service_id] = self.services[service_id].series(since)
+        return result
+
+    '''
+	Function:	node_mean
+
+	Description:	Return the mean of a field of the node with IP
+			server_ip over the last window seconds, or None
+			if there are no samples.
+    '''
+    def node_mean(self, server_ip, field, window=None):
+        with self.lock:
+            buffer = self.nodes.get(server_ip)
+            return buffer.mean(field, window) if buffer is not None else None
+
+    def service_mean(self, service_id, field, window=None):
+        with self.lock:
+            buffer = self.services.get(service_id)
+            return buffer.mean(field, window) if buffer is not None else None
@@ -0,0 +1,82 @@
+import time
+import threading
+import admission
+import fake_docker
+
+'''
+	Tests for admission control: deploys beyond an access point's
+	capacity wait in order for a slot, and are answered with a
+	time to retry once the queue is full or their wait is over.
+'''
+
+def setup(**kwargs):
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2, ncpu=3)
+    (ip, other) = list(managed_nodes)
+    return (admission.AdmissionController(swarm_obj, **kwargs), ip, other)
+
+'''
+	Function:	wait_in_queue
+
+	Description:	Start a deploy waiting for a slot on server_ip
+			on its own thread, and return the thread and the
+			list its result is appended to once admitted.
+'''
+def wait_in_queue(controller, server_ip, results, name, max_wait=None):
+    depth = controller.get_stats()["depth"]
+    thread = threading.Thread(target=lambda: results.append((name, controller.admit(server_ip, max_wait))))
+    thread.start()
+    while controller.get_stats()["depth"] == depth:
+        time.sleep(0.001)
+    return thread
+
+def test_capacity_is_cpu_count():
+    (controller, ip, other) = setup()
+    assert controller.capacity_of(ip) == 3
+    assert [controller.admit(ip)[0] for _ in range(3)] == [True, True, True]
+    # Other access points have slots of their own
+    assert controller.admit(other) == (True, 0.0)
+    assert controller.get_stats()["in_flight"] == {ip: 3, other: 1}
+
+def test_waiters_admitted_in_order():
+    (controller, ip, other) = setup(capacity=1)
+    assert controller.admit(ip) == (True, 0.0)
+    results = []
+    threads = [wait_in_queue(controller, ip, results, name) for name in ("first", "second")]
+    controller.release(ip, 0.1)
+    threads[0].join(5)
+    assert [name for (name, _) in results] == ["first"]
+    controller.release(ip, 0.1)
+    threads[1].join(5)
+    assert [name for (name, (admitted, _)) in results if admitted] == ["first", "second"]
+    controller.release(ip, 0.1)
+    stats = controller.get_stats()
+    assert stats["waited"] == 2 and stats["depth"] == 0 and stats["in_flight"] == {}
+
+def test_full_queue_rejected():
+    (controller, ip, other) = setup(capacity=1, queue_size=1)
+    controller.admit(ip)
+    results = []
+    thread = wait_in_queue(controller, ip, results, "waiting")
+    (admitted, retry_after) = controller.admit(ip)
+    assert admitted is False and retry_after >= 1
+    # A deploy that will not wait is rejected right away
+    assert controller.admit(other, max_wait=0)[0] is True
+    assert controller.admit(other, max_wait=0)[0] is False
+    controller.release(ip, 0.1)
+    thread.join(5)
+    assert results[0][1][0] is True
+    assert controller.get_stats()["rejected"] == 2
+
+def test_wait_expires():
+    (controller, ip, other) = setup(capacity=1, max_wait=0.1)
+    controller.admit(ip)
+    start = time.monotonic()
+    # Asking for a longer wait than configured does not extend it
+    (admitted, retry_after) = controller.admit(ip, max_wait=30)
+    assert admitted is False and retry_after >= 1
+    assert time.monotonic() - start < 5
+    stats = controller.get_stats()
+    assert stats["expired"] == 1 and stats["depth"] == 0
+    # The slot is not handed to the expired deploy
+    controller.release(ip, 0.1)
+    assert controller.admit(ip) == (True, 0.0)
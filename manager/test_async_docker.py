@@ -0,0 +1,225 @@
+import json
+import asyncio
+import urllib.parse
+import docker
+import async_docker
+
+'''
+	Tests for the asyncio Docker client against a fake daemon, an
+	HTTP server on a unix socket answering each request with the
+	response its route returns.
+'''
+
+'''
+	Class: FakeDaemon
+
+	Member Variables:
+		routes:
+			Dictionary mapping (method, path) to a function
+			taking the request and returning (status, body,
+			chunks): body is sent with a Content-Length, or
+			if it is None chunks is a list of (delay, bytes)
+			sent chunked. If it returns None, the connection
+			is closed with no response
+		requests:
+			List of the requests received, dictionaries of
+			method, path, query and decoded body
+		connections:
+			Number of connections accepted
+'''
+class FakeDaemon:
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.requests = []
+        self.connections = 0
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                (method, target, _) = line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    (name, _, value) = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                data = await reader.readexactly(int(headers.get("content-length", 0)))
+                url = urllib.parse.urlparse(target)
+                request = {"method": method, "path": url.path.split("/", 2)[2],
+                           "query": dict(urllib.parse.parse_qsl(url.query)),
+                           "body": json.loads(data) if data else None}
+                self.requests.append(request)
+                route = self.routes.get((method, "/" + request["path"]))
+                response = route(request) if route else (404, {"message": "no such route"}, None)
+                if response is None:
+                    return
+                await self.respond(writer, *response)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body, chunks):
+        head = "HTTP/1.1 {} {}\r\n".format(status, "OK" if status < 400 else "Error")
+        if body is not None:
+            data = json.dumps(body).encode()
+            writer.write((head + "Content-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                len(data))).encode() + data)
+            await writer.drain()
+            return
+        writer.write((head + "Transfer-Encoding: chunked\r\n\r\n").encode())
+        await writer.drain()
+        for (delay, chunk) in chunks:
+            await asyncio.sleep(delay)
+            writer.write("{:x}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+'''
+	Function:	run
+
+	Description:	Serve routes on a unix socket in directory and
+			return what test(client, daemon) returns.
+'''
+def run(directory, routes, test, timeout=5):
+    path = str(directory / "docker.sock")
+    daemon = FakeDaemon(routes)
+
+    async def main():
+        server = await asyncio.start_unix_server(daemon.serve, path)
+        client = async_docker.AsyncDockerClient("unix://" + path, timeout=timeout)
+        try:
+            return await test(client, daemon)
+        finally:
+            client.close()
+            server.close()
+    return asyncio.run(main())
+
+def test_errors_mapped(tmp_path):
+    routes = {("GET", "/services/gone"): lambda request: (404, {"message": "service gone not found"}, None),
+              ("GET", "/swarm"): lambda request: (503, {"message": "not a swarm manager"}, None)}
+
+    async def test(client, daemon):
+        errors = []
+        for call in (client.inspect_service("gone"), client.inspect_swarm()):
+            try:
+                await call
+            except docker.errors.APIError as e:
+                errors.append(e)
+        return errors
+
+    (not_found, unavailable) = run(tmp_path, routes, test)
+    assert isinstance(not_found, docker.errors.NotFound)
+    assert not_found.explanation == "service gone not found"
+    assert type(unavailable) is docker.errors.APIError and unavailable.status_code == 503
+
+def test_filters_encoded(tmp_path):
+    routes = {("GET", "/tasks"): lambda request: (200, [{"ID": "t1"}], None)}
+
+    async def test(client, daemon):
+        tasks = await client.tasks(filters={"service": "s1", "desired-state": ["running"]})
+        unfiltered = await client.tasks()
+        return (tasks, unfiltered, daemon.requests)
+
+    (tasks, unfiltered, requests) = run(tmp_path, routes, test)
+    assert tasks == [{"ID": "t1"}] and unfiltered == [{"ID": "t1"}]
+    assert json.loads(requests[0]["query"]["filters"]) == {"service": ["s1"], "desired-state": ["running"]}
+    assert "filters" not in requests[1]["query"]
+
+def test_create_service_body(tmp_path):
+    routes = {("POST", "/services/create"): lambda request: (201, {"ID": "s1"}, None)}
+    task_template = {"ContainerSpec": {"Image": "app"}}
+    endpoint_spec = {"Ports": [{"Protocol": "tcp", "TargetPort": 80, "PublishedPort": 50000}]}
+
+    async def test(client, daemon):
+        result = await client.create_service(task_template, name="app", labels={"edgeap.lease": "30"},
+                                             endpoint_spec=endpoint_spec)
+        return (result, daemon.requests[0]["body"])
+
+    (result, body) = run(tmp_path, routes, test)
+    assert result == {"ID": "s1"}
+    assert body == {"TaskTemplate": task_template, "Name": "app", "Labels": {"edgeap.lease": "30"},
+                    "EndpointSpec": endpoint_spec}
+
+def test_pull_outlives_timeout_while_progressing(tmp_path):
+    # Each progress line comes within the timeout, the whole pull does not
+    progress = [(0.1, json.dumps({"status": "Downloading", "id": str(i)}).encode() + b"\n") for i in range(6)]
+    routes = {("POST", "/images/create"): lambda request: (200, None, progress)}
+
+    async def test(client, daemon):
+        return (await client.pull("app"), daemon.requests[0]["query"])
+
+    (result, query) = run(tmp_path, routes, test, timeout=0.3)
+    assert query == {"fromImage": "app", "tag": "latest"}
+    assert [json.loads(line)["id"] for line in result.splitlines()] == [str(i) for i in range(6)]
+
+def test_stalled_pull_times_out(tmp_path):
+    routes = {("POST", "/images/create"): lambda request: (200, None, [(0, b"{}\n"), (1, b"{}\n")])}
+
+    async def test(client, daemon):
+        try:
+            await client.pull("app")
+        except TimeoutError:
+            return True
+        return False
+
+    assert run(tmp_path, routes, test, timeout=0.3)
+
+def test_events_streamed(tmp_path):
+    # Events may be far apart, the stream waits for them
+    events = [(0.4, b'{"Type": "service", "Action": "create"}\n{"Type": "node", '),
+              (0.1, b'"Action": "update"}\n')]
+    routes = {("GET", "/events"): lambda request: (200, None, events)}
+
+    async def test(client, daemon):
+        received = [event async for event in client.events(filters={"type": ["service", "node"]})]
+        return (received, daemon.requests[0]["query"])
+
+    (received, query) = run(tmp_path, routes, test, timeout=0.2)
+    assert received == [{"Type": "service", "Action": "create"}, {"Type": "node", "Action": "update"}]
+    assert json.loads(query["filters"]) == {"type": ["service", "node"]}
+
+def test_connections_reused(tmp_path):
+    routes = {("GET", "/version"): lambda request: (200, {"ApiVersion": "1.40"}, None)}
+
+    async def test(client, daemon):
+        for _ in range(3):
+            assert await client.version() == {"ApiVersion": "1.40"}
+        return (len(daemon.requests), daemon.connections)
+
+    assert run(tmp_path, routes, test) == (3, 1)
+
+def test_lost_connection_retried_for_reads_only(tmp_path):
+    dropped = []
+
+    def drop_once(request):
+        if dropped:
+            return (200, {"ApiVersion": "1.40"}, None)
+        dropped.append(request)
+        return None
+    routes = {("GET", "/version"): drop_once,
+              ("GET", "/info"): lambda request: (200, {}, None),
+              ("POST", "/services/create"): lambda request: None}
+
+    async def test(client, daemon):
+        await client.info()
+        # Read again on a new connection once the reused one is lost
+        assert await client.version() == {"ApiVersion": "1.40"}
+        try:
+            # The daemon may have created the service before it
+            # dropped the connection, it is not created again
+            await client.create_service({"ContainerSpec": {"Image": "app"}})
+        except ConnectionError:
+            pass
+        else:
+            assert False, "lost create_service did not fail"
+        return ([request["method"] for request in daemon.requests], daemon.connections)
+
+    assert run(tmp_path, routes, test) == (["GET", "GET", "GET", "POST"], 2)
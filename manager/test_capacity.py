@@ -0,0 +1,93 @@
+import swarm
+import capacity
+import fake_docker
+
+'''
+	Tests for CPU and memory reservations: resources are parsed
+	and completed with the image and global defaults, and
+	services that would over-commit an access point are refused
+	without leaking its ports.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+def setup(**kwargs):
+    # 4 cores and 1 GB per access point, half a core and 128 MB of headroom
+    resources = dict({"headroom": {"cpu": 0.5, "memory": "128m"}}, **kwargs)
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    swarm_obj.capacity = capacity.CapacityLedger(swarm_obj.services, swarm_obj.node_registry.lookup,
+                                                 swarm.image_name, **resources)
+    swarm_obj.node_registry.refresh()
+    return (swarm_obj, list(managed_nodes)[0])
+
+def invalid(spec):
+    try:
+        capacity.parse_resources(spec)
+    except ValueError:
+        return True
+    return False
+
+def test_parse_resources():
+    assert capacity.parse_resources({"cpu": "0.5", "memory": "128m", "cpu_limit": 1, "memory_limit": 1 << 28}) == \
+        {"cpu": 0.5, "memory": 128 << 20, "cpu_limit": 1.0, "memory_limit": 1 << 28}
+    assert capacity.parse_resources(None) == {}
+    for spec in ({"cpu": "nan"}, {"cpu": "inf"}, {"cpu_limit": float("inf")}, {"memory": float("nan")},
+                 {"memory": float("inf")}, {"cpu": -1}, {"memory": "lots"}, {"cpu": True},
+                 {"gpu": 1}, {"cpu": 2, "cpu_limit": 1}, ["cpu"]):
+        assert invalid(spec), spec
+
+def test_defaults_completed():
+    ledger = capacity.CapacityLedger(None, None, str, defaults={"cpu": 0.25, "memory": "64m"},
+                                     images={"app": {"memory": "256m", "memory_limit": "512m"}})
+    assert ledger.resources_for(REQUEST) == {"cpu": 0.25, "memory": 256 << 20, "memory_limit": 512 << 20}
+    assert ledger.resources_for(dict(REQUEST, resources={"cpu": 1})) == \
+        {"cpu": 1.0, "memory": 256 << 20, "memory_limit": 512 << 20}
+    assert ledger.resources_for({"image": "other"}) == {"cpu": 0.25, "memory": 64 << 20}
+    try:
+        ledger.resources_for(dict(REQUEST, resources={"memory": "1g"}))
+    except ValueError:
+        pass
+    else:
+        assert False, "memory over its limit accepted"
+
+def test_reserve_and_release():
+    (swarm_obj, ip) = setup()
+    ledger = swarm_obj.capacity
+    assert ledger.capacity(ip) == (3.5, (1 << 30) - (128 << 20))
+    assert ledger.fits(ip, {"cpu": 3.5})
+    assert ledger.reserve(ip, {"cpu": 3, "memory": 512 << 20})
+    assert not ledger.fits(ip, {"cpu": 1}) and not ledger.reserve(ip, {"cpu": 1})
+    assert ledger.fits(ip, {"cpu": 0.5}) and not ledger.fits(ip, {"memory": 512 << 20})
+    # Services reserving nothing fit anywhere
+    assert ledger.fits(ip, {}) and ledger.reserve(ip, {"memory_limit": 1 << 40})
+    ledger.release(ip, {"cpu": 3, "memory": 512 << 20})
+    assert ledger.pending == {}
+    assert ledger.fits(ip, {"cpu": 3.5})
+
+def test_over_commit_refused():
+    (swarm_obj, ip) = setup()
+    free_ports = swarm_obj.free_ports(ip)
+    request = dict(REQUEST, resources={"cpu": 2})
+    (resp, record) = swarm_obj.create_service(ip, request)
+    assert resp is True and record.cpu == 2.0
+    assert swarm_obj.create_service(ip, request) == (False, None)
+    assert swarm_obj.capacity.get_stats([ip])[ip]["cpu"] == 2.0
+    assert swarm_obj.free_ports(ip) == free_ports - 1
+    # The reservation is given back with the service
+    assert swarm_obj.remove_service(ip, record.service_id)
+    assert swarm_obj.create_service(ip, request)[0] is True
+
+def test_failed_start_releases_port():
+    (swarm_obj, ip) = setup()
+    free_ports = swarm_obj.free_ports(ip)
+    assert swarm_obj.create_service(ip, dict(REQUEST, resources={"cpu": "nan"})) == (False, None)
+
+    def fail(**kwargs):
+        raise RuntimeError("daemon went away")
+    swarm_obj.manager_conn.create_service = fail
+    try:
+        swarm_obj.create_service(ip, REQUEST)
+    except RuntimeError:
+        pass
+    assert swarm_obj.free_ports(ip) == free_ports
+    assert swarm_obj.capacity.pending == {}
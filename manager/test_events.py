@@ -0,0 +1,120 @@
+import time
+import events
+import placement
+import fake_docker
+
+'''
+	Tests for the Docker events watcher. Events are produced by
+	an in-memory fake swarm, either as a side effect of changes
+	made behind the manager's back or by replaying a recorded
+	event stream, and the watcher must keep the DockerSwarm
+	object in sync with them.
+'''
+
+# Recorded with `docker events --format '{{json .}}'` while a
+# service was created, relabelled and removed on an access point
+# that then lost power; ids are replaced by the test
+RECORDED_EVENTS = [
+    {"Type": "service", "Action": "create", "Actor": {"ID": "{service}", "Attributes": {"name": "zealous_hopper"}}, "scope": "swarm", "time": 1591300000, "timeNano": 1591300000112604123},
+    {"Type": "service", "Action": "update", "Actor": {"ID": "{service}", "Attributes": {"name": "zealous_hopper"}}, "scope": "swarm", "time": 1591300003, "timeNano": 1591300003413370981},
+    {"Type": "service", "Action": "remove", "Actor": {"ID": "{service}", "Attributes": {"name": "zealous_hopper"}}, "scope": "swarm", "time": 1591300010, "timeNano": 1591300010007219845},
+    {"Type": "node", "Action": "update", "Actor": {"ID": "{node}", "Attributes": {"name": "ap1", "state.new": "down", "state.old": "ready"}}, "scope": "swarm", "time": 1591300042, "timeNano": 1591300042590011392},
+]
+
+REQUEST = {"image": "ubuntu", "application_port": 1234, "protocol": "tcp"}
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for condition")
+        time.sleep(0.01)
+
+def setup(num_nodes=2):
+    (fake_swarm, swarm_obj, _) = fake_docker.create_fake_swarm(num_nodes)
+    watcher = events.EventWatcher(swarm_obj, retry_interval=0.05)
+    watcher.start()
+    return (fake_swarm, swarm_obj, watcher)
+
+def substitute(recorded, **ids):
+    replayed = []
+    for event in recorded:
+        actor = dict(event["Actor"], ID=event["Actor"]["ID"].format(**ids))
+        replayed.append(dict(event, Actor=actor))
+    return replayed
+
+def test_external_changes():
+    (fake_swarm, swarm_obj, watcher) = setup()
+    ip = list(swarm_obj.nodes.keys())[1]
+    # Another client of the manager's daemon creates and removes
+    # a service; the swarm object only learns of it from events
+    other_swarm = fake_docker.create_other_swarm(fake_swarm)
+    service_id = other_swarm.create_service(ip, REQUEST)[1].service_id
+    wait_for(lambda: swarm_obj.has_service(ip, service_id))
+    assert swarm_obj.get_service_port(service_id) in swarm_obj.ports[ip]
+
+    other_swarm.manager_conn.remove_service(service_id)
+    wait_for(lambda: not swarm_obj.has_service(ip, service_id))
+    assert len(swarm_obj.ports[ip]) == 0
+    watcher.stop()
+
+def test_own_changes_counted_once():
+    (fake_swarm, swarm_obj, watcher) = setup()
+    ip = list(swarm_obj.nodes.keys())[0]
+    service_ids = [swarm_obj.create_service(ip, REQUEST)[1].service_id for _ in range(5)]
+    swarm_obj.remove_service(ip, service_ids[0])
+    wait_for(lambda: watcher.handled.get("service.remove") == 1)
+    assert sorted(swarm_obj.services.ids(ip)) == sorted(service_ids[1:])
+    assert len(swarm_obj.ports[ip]) == 4
+    watcher.stop()
+
+def test_node_down():
+    (fake_swarm, swarm_obj, watcher) = setup()
+    ip = list(swarm_obj.nodes.keys())[0]
+    placer = placement.Placer(swarm_obj)
+    fake_swarm.set_node_state(ip, "down")
+    wait_for(lambda: not swarm_obj.is_node_ready(ip))
+    assert all(placer.place(REQUEST) != ip for _ in range(10))
+    fake_swarm.set_node_state(ip, "ready")
+    wait_for(lambda: swarm_obj.is_node_ready(ip))
+    watcher.stop()
+
+def test_replay_recorded():
+    (fake_swarm, swarm_obj, watcher) = setup()
+    ip = list(swarm_obj.nodes.keys())[0]
+    node_id = swarm_obj.get_swarm_node(ip)["ID"]
+
+    # Create the recorded service without emitting events, as if it
+    # was created before the recording started
+    fake_swarm.silent = True
+    other_swarm = fake_docker.create_other_swarm(fake_swarm)
+    service_id = other_swarm.create_service(ip, REQUEST)[1].service_id
+    fake_swarm.silent = False
+
+    recorded = substitute(RECORDED_EVENTS, service=service_id, node=node_id)
+    fake_swarm.replay(recorded[:2])
+    wait_for(lambda: swarm_obj.has_service(ip, service_id))
+
+    # The remove was recorded, apply it to the fake state as well
+    fake_swarm.silent = True
+    fake_swarm.services.pop(service_id)
+    fake_swarm.nodes[node_id]["Status"]["State"] = "down"
+    fake_swarm.silent = False
+    fake_swarm.replay(recorded[2:])
+    wait_for(lambda: not swarm_obj.has_service(ip, service_id))
+    wait_for(lambda: not swarm_obj.is_node_ready(ip))
+    watcher.stop()
+
+def test_reconnect_replays_idempotently():
+    (fake_swarm, swarm_obj, watcher) = setup()
+    ip = list(swarm_obj.nodes.keys())[0]
+    service_id = swarm_obj.create_service(ip, REQUEST)[1].service_id
+    wait_for(lambda: watcher.handled.get("service.create") == 1)
+
+    # Drop the stream; the watcher reconnects from the time of the
+    # last event and sees the create again
+    watcher.stream.close()
+    wait_for(lambda: watcher.handled.get("service.create") == 2)
+    assert swarm_obj.services.ids(ip) == [service_id]
+    assert len(swarm_obj.ports[ip]) == 1
+    watcher.stop()
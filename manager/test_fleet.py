@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import pytest
+import fleet
+import fake_docker
+
+'''
+	Tests for the fleet: connections to access points are opened
+	by their first call and closed once idle or least recently
+	used, a changed config file is noticed, and reloading it
+	joins the access points added and drains the ones removed
+	once their services are gone.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+class Client:
+
+    def __init__(self, node):
+        self.node = node
+        self.closed = False
+
+    def ping(self):
+        return self.node
+
+    def close(self):
+        self.closed = True
+
+class Factory:
+
+    def __init__(self, node):
+        self.node = node
+        self.clients = []
+
+    def __call__(self):
+        self.clients.append(Client(self.node))
+        return self.clients[-1]
+
+def test_connection_opened_by_first_call():
+    pool = fleet.ClientPool(idle_timeout=None)
+    factory = Factory("10.0.0.1")
+    client = pool.add("10.0.0.1", factory)
+    assert not client.is_open() and factory.clients == []
+    assert client.ping() == "10.0.0.1" and client.ping() == "10.0.0.1"
+    assert len(factory.clients) == 1 and pool.get_stats() == {"opened": 1, "evicted": 0, "nodes": 1, "open": 1}
+    # Once reconfigured, the next call opens a connection with the new factory
+    other = Factory("10.0.0.1")
+    client.reconfigure(other)
+    assert factory.clients[0].closed and not client.is_open()
+    client.ping()
+    assert len(other.clients) == 1
+    pool.remove("10.0.0.1")
+    assert other.clients[0].closed and pool.get("10.0.0.1") is None
+
+def test_failed_connection_raised_by_call():
+    pool = fleet.ClientPool(idle_timeout=None)
+    client = pool.add("10.0.0.1", lambda: None)
+    with pytest.raises(ConnectionError):
+        client.ping()
+    assert pool.get_stats()["opened"] == 0
+
+def test_least_recently_used_evicted():
+    pool = fleet.ClientPool(idle_timeout=None, max_open=2)
+    factories = [Factory(ip) for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3")]
+    clients = [pool.add(factory.node, factory) for factory in factories]
+    clients[0].ping()
+    clients[1].ping()
+    clients[0].ping()
+    clients[2].ping()
+    assert [client.is_open() for client in clients] == [True, False, True]
+    assert pool.get_stats()["evicted"] == 1
+    # An evicted client opens a new connection on its next call
+    clients[1].ping()
+    assert len(factories[1].clients) == 2 and not clients[0].is_open()
+
+def test_idle_connections_closed():
+    pool = fleet.ClientPool(idle_timeout=0.05)
+    (busy, idle) = (pool.add("10.0.0.1", Factory("10.0.0.1")), pool.add("10.0.0.2", Factory("10.0.0.2")))
+    busy.ping()
+    idle.ping()
+    time.sleep(0.1)
+    busy.ping()
+    assert pool.evict_idle() == 1
+    assert busy.is_open() and not idle.is_open()
+    assert pool.evict_idle() == 0
+
+def test_config_change_noticed(tmp_path):
+    path = tmp_path / "manager.conf"
+    path.write_text("{}")
+    calls = []
+    watcher = fleet.ConfigWatcher(str(path), lambda: calls.append(1))
+    assert not watcher.check()
+    path.write_text('{"remotes": {}}')
+    assert watcher.check() and calls == [1]
+    assert not watcher.check()
+    # A failed reload is reported and the next change is noticed
+    watcher.callback = lambda: 1 / 0
+    path.write_text('{"remotes": {"x": 1}}')
+    assert watcher.check()
+    # A file that disappears is not a change
+    os.remove(path)
+    assert not watcher.check()
+
+def write_config(path, ips):
+    path.write_text(json.dumps({"manager_ip": fake_docker.MANAGER_IP,
+                                "remotes": {ip: {"port": 2375, "tlsverify": False} for ip in ips}}))
+
+def setup(tmp_path):
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2)
+    ips = sorted(managed_nodes)
+    path = tmp_path / "manager.conf"
+    write_config(path, ips)
+    swarm_obj.config_file = str(path)
+    swarm_obj.remotes = {ip: (2375, None) for ip in ips}
+    # New access points are fake ones
+    swarm_obj.connection_factory = \
+        lambda ip, settings: lambda: fake_docker.FakeNodeClient(fake_swarm, ip, 4, fake_docker.GB)
+    return (fake_swarm, swarm_obj, ips, path)
+
+def joined(fake_swarm):
+    return sorted(node["Status"]["Addr"] for node in fake_swarm.nodes.values())
+
+def test_reload_joins_added_nodes(tmp_path):
+    (fake_swarm, swarm_obj, ips, path) = setup(tmp_path)
+    write_config(path, ips + ["10.0.9.1"])
+    assert swarm_obj.reload_config() == (["10.0.9.1"], [])
+    assert joined(fake_swarm) == sorted(ips + ["10.0.9.1"])
+    assert swarm_obj.create_service("10.0.9.1", REQUEST)[0]
+    # A config that can not be read is ignored
+    path.write_text("{")
+    assert swarm_obj.reload_config() is None
+    assert "10.0.9.1" in swarm_obj.nodes
+
+def test_reload_drains_removed_nodes(tmp_path):
+    (fake_swarm, swarm_obj, (kept, removed), path) = setup(tmp_path)
+    records = [swarm_obj.create_service(removed, REQUEST)[1] for _ in range(2)]
+    write_config(path, [kept])
+    assert swarm_obj.reload_config() == ([], [removed])
+    # The node stays until its services are gone
+    assert swarm_obj.is_node_draining(removed) and removed in joined(fake_swarm)
+    swarm_obj.remove_service(removed, records[0].service_id)
+    assert removed in swarm_obj.nodes
+    swarm_obj.remove_service(removed, records[1].service_id)
+    deadline = time.monotonic() + 5
+    while removed in swarm_obj.nodes:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert joined(fake_swarm) == [kept] and not swarm_obj.is_node_draining(removed)
+
+def test_listed_again_before_drained(tmp_path):
+    (fake_swarm, swarm_obj, (kept, removed), path) = setup(tmp_path)
+    record = swarm_obj.create_service(removed, REQUEST)[1]
+    write_config(path, [kept])
+    swarm_obj.reload_config()
+    write_config(path, [kept, removed])
+    assert swarm_obj.reload_config() == ([], [])
+    assert not swarm_obj.is_node_draining(removed)
+    swarm_obj.remove_service(removed, record.service_id)
+    assert removed in swarm_obj.nodes and removed in joined(fake_swarm)
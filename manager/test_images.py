@@ -0,0 +1,63 @@
+import images
+import fake_docker
+
+'''
+	Tests for the image cache: the images each access point holds
+	are listed under their normalized names, and configured or
+	popular images are pulled to every access point that is not
+	being drained.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+def setup(num_nodes=2, **kwargs):
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(num_nodes)
+    return (fake_swarm, swarm_obj, sorted(managed_nodes), images.ImageCache(swarm_obj, **kwargs))
+
+def test_listed_images_normalized():
+    listing = [{"RepoTags": ["docker.io/library/ubuntu:latest", "app:1.0"]},
+               {"RepoTags": ["<none>:<none>"], "RepoDigests": ["web@sha256:ab"]},
+               {"RepoTags": None, "RepoDigests": ["db@sha256:cd"]}]
+    # Untagged images keep the tags their repository was deployed with
+    assert images.listed_images(listing, {"web:2.0", "other:1"}) == {"ubuntu:latest", "app:1.0", "web:2.0",
+                                                                     "db:latest"}
+
+def test_refresh_lists_images():
+    (fake_swarm, swarm_obj, ips, cache) = setup()
+    assert swarm_obj.create_service(ips[0], REQUEST)[0] is True
+    cache.refresh()
+    assert cache.nodes_with("app:latest") == {ips[0]}
+    assert cache.holds(ips[0], "app") and not cache.holds(ips[1], "app")
+    assert cache.preferred_nodes(REQUEST) == {ips[0]}
+    assert images.ImageCache(swarm_obj, prefer_cached=False).preferred_nodes(REQUEST) == set()
+    assert cache.get_stats()["nodes"] == {ips[0]: 1, ips[1]: 0}
+
+def test_configured_images_prepulled():
+    (fake_swarm, swarm_obj, ips, cache) = setup(3, prepull=["app"])
+    swarm_obj.draining.add(ips[2])
+    cache.prepull_images()
+    cache.executor.shutdown(wait=True)
+    assert cache.nodes_with("app") == set(ips[:2])
+    assert cache.get_stats()["pulls"] == 2
+    # What was pulled is listed by the access points too
+    cache.images = {}
+    cache.refresh()
+    assert cache.nodes_with("app") == set(ips[:2])
+
+def test_popular_images_pulled_everywhere():
+    (fake_swarm, swarm_obj, ips, cache) = setup(popular_threshold=2)
+    cache.record_deploy(ips[0], "app", cached=False)
+    assert cache.nodes_with("app") == {ips[0]}
+    cache.record_deploy(ips[0], "app", cached=True)
+    cache.executor.shutdown(wait=True)
+    assert cache.nodes_with("app") == set(ips)
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["pulls"]) == (1, 1, 1)
+
+def test_failed_pull_counted():
+    (fake_swarm, swarm_obj, ips, cache) = setup(1, prepull=["app"])
+    fake_swarm.nodes.clear()
+    cache.prepull_images()
+    cache.executor.shutdown(wait=True)
+    assert cache.nodes_with("app") == set() and cache.pulling == set()
+    assert cache.get_stats()["pull_failures"] == 1
@@ -0,0 +1,70 @@
+import json
+import journal
+import swarm
+import fake_docker
+
+'''
+	Tests for the journal: entries written after the last
+	snapshot are replayed, a torn last line is ignored, and a
+	restarted DockerSwarm serves the services it tracked from
+	the journal before reconciling with the swarm.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+def test_entries_after_snapshot_replayed(tmp_path):
+    state_journal = journal.Journal(str(tmp_path / "state"))
+    state_journal.append({"op": "track", "n": 1})
+    state_journal.append({"op": "track", "n": 2})
+    seq = state_journal.rotate()
+    # Written while the snapshot is
+    state_journal.append({"op": "untrack", "n": 1})
+    assert state_journal.write_snapshot({"services": [2]}, seq)
+    state_journal.close()
+
+    restarted = journal.Journal(str(tmp_path / "state"))
+    (state, entries) = restarted.load()
+    assert state == {"services": [2], "seq": 2}
+    assert entries == [{"op": "untrack", "n": 1, "seq": 3}]
+    assert restarted.seq == 3 and restarted.entries == 1
+
+def test_failed_snapshot_keeps_entries(tmp_path):
+    state_journal = journal.Journal(str(tmp_path / "state"))
+    state_journal.append({"n": 1})
+    state_journal.rotate()
+    # No snapshot was written, the next rotation keeps both entries
+    state_journal.append({"n": 2})
+    state_journal.rotate()
+    state_journal.close()
+    (state, entries) = journal.Journal(str(tmp_path / "state")).load()
+    assert state is None
+    assert [entry["n"] for entry in entries] == [1, 2]
+
+def test_torn_entry_ignored(tmp_path):
+    state_journal = journal.Journal(str(tmp_path / "state"))
+    state_journal.append({"n": 1})
+    state_journal.close()
+    with open(state_journal.journal_path, "a") as f:
+        f.write(json.dumps({"n": 2, "seq": 2})[:7])
+    (state, entries) = journal.Journal(str(tmp_path / "state")).load()
+    assert entries == [{"n": 1, "seq": 1}]
+
+def test_swarm_restored_from_journal(tmp_path):
+    path = str(tmp_path / "state")
+    (fake_swarm, manager_conn, managed_nodes) = fake_docker.create_fake_fleet(2, 4, fake_docker.GB, None)
+    swarm_obj = swarm.DockerSwarm(None, manager_ip=fake_docker.MANAGER_IP, managed_nodes=dict(managed_nodes),
+                                  manager_conn=manager_conn, journal_path=path)
+    ip = list(managed_nodes)[0]
+    records = [swarm_obj.create_service(ip, REQUEST)[1] for _ in range(3)]
+    swarm_obj.save_snapshot()
+    assert swarm_obj.remove_service(ip, records[0].service_id)
+    records.append(swarm_obj.create_service(ip, REQUEST)[1])
+    swarm_obj.journal.close()
+
+    restarted = swarm.DockerSwarm(None, manager_ip=fake_docker.MANAGER_IP, managed_nodes=dict(managed_nodes),
+                                  manager_conn=fake_docker.FakeManagerClient(fake_swarm), journal_path=path)
+    assert restarted.reconciled.wait(10)
+    tracked = {record.service_id: record.port for record in restarted.services.records()}
+    assert tracked == {record.service_id: record.port for record in records[1:]}
+    # Ports of the restored services are not handed out again
+    assert restarted.create_service(ip, REQUEST)[1].port not in tracked.values()
@@ -0,0 +1,113 @@
+import time
+import leases
+import sharing
+import fake_docker
+
+'''
+	Tests for leases and shared instances on a fake swarm: each
+	client of a shared instance holds a lease of its own, a
+	client whose lease expires is detached, and the instance is
+	only removed once its last client is gone.
+'''
+
+REQUEST = {"image": "shared", "application_port": 5555, "protocol": "tcp", "shared": True}
+
+def setup():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    ip = list(managed_nodes)[0]
+    shared = sharing.SharedInstances(swarm_obj, enabled=True, max_clients=4)
+    lease_table = leases.LeaseTable(swarm_obj, sharing=shared)
+    (resp, record) = swarm_obj.create_service(ip, REQUEST, labels=shared.shared_labels(lease_table.labels(30)))
+    assert resp is True
+    shared.add(ip, REQUEST, record.service_id, lease_table.labels(30))
+    return (swarm_obj, shared, lease_table, ip, record.service_id)
+
+def expire(lease_table, lease_id):
+    with lease_table.lock:
+        lease_table.set_expiry(lease_id, lease_table.leases[lease_id][1], expiry=time.monotonic() - 1)
+
+def test_parse_ttl():
+    assert leases.parse_ttl("2.5") == 2.5
+    for ttl in (0, -1, True, "soon", float("inf"), float("nan"), None):
+        try:
+            leases.parse_ttl(ttl)
+        except ValueError:
+            continue
+        assert False, ttl
+
+def test_lease_reaped():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    ip = list(managed_nodes)[0]
+    lease_table = leases.LeaseTable(swarm_obj)
+    (resp, record) = swarm_obj.create_service(ip, {"image": "app", "application_port": 80, "protocol": "tcp"})
+    lease_table.grant(record.service_id, 30)
+    assert lease_table.renew(record.service_id) == 30
+    lease_table.reap()
+    assert swarm_obj.services.get(record.service_id) is not None
+    expire(lease_table, record.service_id)
+    lease_table.reap()
+    assert swarm_obj.services.get(record.service_id) is None
+    assert lease_table.renew(record.service_id) is None
+    assert lease_table.get_stats()["reaped"] == 1
+
+def test_lease_per_attachment():
+    (swarm_obj, shared, lease_table, ip, service_id) = setup()
+    first = lease_table.attach(service_id, 30)
+    assert shared.attach(ip, REQUEST)[0] == service_id
+    second = lease_table.attach(service_id, 30)
+    assert first != second and shared.client_count(service_id) == 2
+    assert lease_table.service_of(first) == service_id and lease_table.service_of(second) == service_id
+
+    # The crashed client is detached, the other keeps the instance
+    expire(lease_table, first)
+    lease_table.reap()
+    assert swarm_obj.services.get(service_id) is not None
+    assert shared.client_count(service_id) == 1
+    assert lease_table.renew(first) is None and lease_table.renew(second) == 30
+
+    # Once the last client is gone the instance is removed
+    expire(lease_table, second)
+    lease_table.reap()
+    assert swarm_obj.services.get(service_id) is None
+    assert not shared.is_shared(service_id)
+    assert lease_table.get_stats()["detached"] == 2
+
+def test_failed_removal_keeps_last_client():
+    (swarm_obj, shared, lease_table, ip, service_id) = setup()
+    lease_id = lease_table.attach(service_id, 30)
+    remove_service = swarm_obj.remove_service
+    swarm_obj.remove_service = lambda server_ip, id: False
+    expire(lease_table, lease_id)
+    lease_table.reap()
+    assert shared.client_count(service_id) == 1
+    assert lease_table.service_of(lease_id) == service_id
+
+    # Retried on the next run
+    swarm_obj.remove_service = remove_service
+    lease_table.reap()
+    assert swarm_obj.services.get(service_id) is None
+    assert not shared.is_shared(service_id)
+
+def test_closing_instance_takes_no_clients():
+    (swarm_obj, shared, lease_table, ip, service_id) = setup()
+    assert shared.detach(service_id) == 0
+    assert shared.attach(ip, REQUEST) is None
+    assert shared.preferred_nodes(REQUEST) == set()
+    shared.restore(service_id)
+    assert shared.attach(ip, REQUEST)[0] == service_id
+
+def test_attachments_adopted_after_restart():
+    (swarm_obj, shared, lease_table, ip, service_id) = setup()
+    assert shared.attach(ip, REQUEST)[0] == service_id
+    first = lease_table.attach(service_id, 30)
+    second = lease_table.attach(service_id, 30)
+
+    restarted = leases.LeaseTable(swarm_obj, sharing=shared)
+    restarted.adopt()
+    # Only the first client heartbeats after the restart
+    assert restarted.renew(first) == 30
+    expire(restarted, service_id)
+    restarted.reap()
+    assert shared.client_count(service_id) == 1
+    assert restarted.renew(second) is None
+    assert swarm_obj.services.get(service_id) is not None
@@ -0,0 +1,67 @@
+import time
+import threading
+import docker
+import swarm
+import fake_docker
+
+'''
+	Tests for the swarm lifecycle: access points join, are
+	restored and leave several at a time, and one that fails or
+	hangs is reported without holding up the others.
+'''
+
+def test_run_parallel_results():
+    def square(item):
+        if item == 3:
+            raise ValueError("odd one out")
+        return item * item
+    assert swarm.run_parallel(square, range(5), workers=2) == {0: 0, 1: 1, 2: 4, 3: None, 4: 16}
+    assert swarm.run_parallel(square, []) == {}
+
+def test_run_parallel_bounded_and_timed_out():
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(1 if item == "hung" else 0.05)
+        with lock:
+            running[0] -= 1
+        return item
+    start = time.monotonic()
+    results = swarm.run_parallel(work, ["a", "b", "c", "d", "hung"], workers=2, timeout=0.2)
+    # Each of the 3 rounds of 2 calls had the timeout to run
+    assert time.monotonic() - start < 0.9
+    assert results == {"a": "a", "b": "b", "c": "c", "d": "d", "hung": None}
+    assert running[1] == 2
+
+def test_failed_join_reported():
+    (fake_swarm, manager_conn, managed_nodes) = fake_docker.create_fake_fleet(4)
+    nodes = {ip: fake_docker.FaultInjector(client) for ip, client in managed_nodes.items()}
+    bad = sorted(nodes)[0]
+    nodes[bad].fail("join_swarm", error=docker.errors.APIError)
+    swarm_obj = swarm.DockerSwarm(None, manager_ip=fake_docker.MANAGER_IP, managed_nodes=dict(nodes),
+                                  manager_conn=manager_conn)
+    joined = {node["Status"]["Addr"] for node in fake_swarm.nodes.values()}
+    assert joined == set(nodes) - {bad}
+    assert swarm_obj.join_nodes(sorted(nodes)) == [bad]
+
+def test_swarm_restored_and_left():
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(3)
+    request = {"image": "app", "application_port": 80, "protocol": "tcp"}
+    records = [swarm_obj.create_service(ip, request)[1] for ip in sorted(managed_nodes)]
+
+    # A second manager finds the swarm, its nodes and services
+    restarted = swarm.DockerSwarm(None, manager_ip=fake_docker.MANAGER_IP, managed_nodes=dict(managed_nodes),
+                                  manager_conn=fake_docker.FakeManagerClient(fake_swarm))
+    assert {record.service_id for record in restarted.services.records()} == \
+        {record.service_id for record in records}
+    assert len(fake_swarm.nodes) == 3
+    # Their ports are not handed out again
+    for record in records:
+        assert record.port in restarted.ports[record.ip]
+
+    restarted.shutdown_swarm()
+    assert fake_swarm.nodes == {} and not fake_swarm.initialized
@@ -0,0 +1,279 @@
+import json
+import time
+import socket
+import threading
+import manager
+import protocol
+import fake_docker
+
+'''
+	Tests for the manager's servers: requests are routed to the
+	handler of their op and answered with their id, a request
+	that fails costs its client an error response only, and a
+	slow request on one connection does not hold up the others.
+'''
+
+REQUEST = {"op": "deploy", "image": "app", "application_port": 80, "protocol": "tcp"}
+
+def setup(tmp_path, monkeypatch):
+    # Listen on ports picked by the system
+    monkeypatch.setattr(manager, "REQUEST_PORT", 0)
+    monkeypatch.setattr(manager, "SHUTDOWN_PORT", 0)
+    config_file = tmp_path / "manager.conf"
+    config_file.write_text(json.dumps({"reload": {"enabled": False}}))
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2)
+    return manager.Manager(str(config_file), workers=4, docker_swarm=swarm_obj)
+
+def wait_for(condition):
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+'''
+	Function:	block_stats
+
+	Description:	Make stats requests wait until the returned
+			event is set.
+'''
+def block_stats(man):
+    release = threading.Event()
+    handle_stats = man.handlers["stats"]
+
+    def blocked(request, addr):
+        release.wait(10)
+        return handle_stats(request, addr)
+    man.handlers["stats"] = blocked
+    return release
+
+def test_dispatch_routes_and_echoes_id(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        response = man.dispatch(dict(REQUEST, id=7), None, "shutdown")
+        assert response["resp-code"] == 0 and response["id"] == 7
+        # Requests without an op get the default op of their port
+        request = {"ip": response["ip"], "service_id": response["service_id"], "id": "x"}
+        assert man.dispatch(request, None, "shutdown") == {"resp-code": 0, "id": "x"}
+        assert man.swarm.services.get(response["service_id"]) is None
+
+        assert man.dispatch({"op": "reboot", "id": 1}, None, "deploy") == \
+            {"resp-code": -1, "failure-msg": "Unknown op: reboot", "id": 1}
+        assert man.dispatch({"op": ["deploy"]}, None, "deploy")["resp-code"] == -1
+        assert man.dispatch(None, None, "deploy") == {"resp-code": -1, "failure-msg": "Invalid request"}
+        assert man.dispatch({"op": "deploy", "id": 2}, None, "deploy") == \
+            {"resp-code": -1, "failure-msg": "Invalid request", "id": 2}
+    finally:
+        man.shutdown()
+
+def test_deploy_not_inspected(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        inspected = []
+        man.swarm.manager_conn.inspect_service = lambda *args, **kwargs: inspected.append(args)
+        response = man.dispatch(REQUEST, None, "deploy")
+        assert response["resp-code"] == 0 and inspected == []
+        # The response is built from the record of the new service
+        record = man.swarm.services.get(response["service_id"])
+        assert (response["ip"], response["port"]) == (record.ip, record.port)
+        assert {"place", "port", "node", "create", "total"} <= set(response["timings"])
+        stats = man.dispatch({"op": "stats"}, None, "deploy")["deploys"]
+        assert stats["create"]["count"] == 1 and stats["total"]["max_ms"] >= stats["create"]["max_ms"]
+    finally:
+        man.shutdown()
+
+def test_deploy_waits_for_readiness(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        man.readiness.probe = False
+        response = man.dispatch(dict(REQUEST, wait_ready=True), None, "deploy")
+        assert response["resp-code"] == 0 and response["time_to_ready"] == response["timings"]["total"]
+        assert "time_to_ready" not in man.dispatch(REQUEST, None, "deploy")
+
+        # An application that does not become ready is removed
+        man.swarm.get_service_tasks = lambda service_id: [{"Status": {"State": "rejected", "Err": "no image"}}]
+        response = man.dispatch(dict(REQUEST, wait_ready=True), None, "deploy")
+        assert response == {"resp-code": -1,
+                            "failure-msg": "Application did not become ready: task rejected: no image"}
+        assert len(man.swarm.services) == 2
+    finally:
+        man.shutdown()
+
+def test_failing_request_answered(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        channel = manager.SocketChannel(None, protocol.FrameDecoder())
+        response = man.dispatch({"op": "heartbeat", "service_ids": [[1]], "id": 3}, None, "deploy", channel)
+        assert response["resp-code"] == -1 and response["id"] == 3
+
+        # Failing to subscribe the client fails its request only
+        def subscribe(service_id, channel):
+            raise TypeError("unhashable")
+        man.subscribers.subscribe = subscribe
+        response = man.dispatch(REQUEST, None, "deploy", channel)
+        assert response["resp-code"] == -1 and response["failure-msg"].startswith("Internal error")
+    finally:
+        man.shutdown()
+
+def test_shared_instance_removed_with_last_client(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        responses = [man.dispatch(dict(REQUEST, shared=True), None, "deploy") for _ in range(2)]
+        assert [response["clients"] for response in responses] == [1, 2]
+        service_id = responses[0]["service_id"]
+        assert responses[1]["service_id"] == service_id
+        request = {"op": "shutdown", "ip": responses[0]["ip"], "service_id": service_id}
+        assert man.dispatch(request, None, "shutdown") == {"resp-code": 0, "clients": 1}
+        assert man.swarm.services.get(service_id) is not None
+        assert man.dispatch(request, None, "shutdown") == {"resp-code": 0}
+        assert man.swarm.services.get(service_id) is None and not man.sharing.is_shared(service_id)
+    finally:
+        man.shutdown()
+
+def test_shutdown_of_closing_instance(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        response = man.dispatch(dict(REQUEST, shared=True), None, "deploy")
+        assert man.dispatch(dict(REQUEST, shared=True), None, "deploy")["service_id"] == response["service_id"]
+        service_id = response["service_id"]
+        # Both clients detached, the last one's removal is under way
+        assert man.sharing.detach(service_id) == 1 and man.sharing.detach(service_id) == 0
+        removed = []
+        man.swarm.remove_service = lambda ip, service_id: removed.append(service_id)
+        request = {"op": "shutdown", "ip": response["ip"], "service_id": service_id}
+        assert man.dispatch(request, None, "shutdown") == {"resp-code": 0}
+        assert removed == []
+    finally:
+        man.shutdown()
+
+def test_batch_deploy_and_shutdown(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        app = {"image": "app", "application_port": 80, "protocol": "tcp"}
+        response = man.dispatch({"op": "batch_deploy", "requests": [dict(app, count=2), app]}, None, "deploy")
+        assert response["resp-code"] == 0 and response["failed"] == 0
+        service_ids = [result["service_id"] for result in response["results"]]
+        assert len(set(service_ids)) == 3 and len(man.swarm.services) == 3
+
+        # Items are answered one by one, by service id or by ip and id
+        services = [service_ids[0], {"ip": response["results"][1]["ip"], "service_id": service_ids[1]}, "gone"]
+        response = man.dispatch({"op": "batch_shutdown", "services": services}, None, "shutdown")
+        assert [result["resp-code"] for result in response["results"]] == [0, 0, -1]
+        assert response["failed"] == 1 and response["failure-msg"] == "1 of 3 items failed"
+        assert [record.service_id for record in man.swarm.services.records()] == [service_ids[2]]
+    finally:
+        man.shutdown()
+
+def test_batch_validated(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    monkeypatch.setattr(manager, "MAX_BATCH_SIZE", 4)
+    try:
+        app = {"image": "app", "application_port": 80, "protocol": "tcp"}
+        for requests in (None, 5, [5], [dict(app, count=0)], [dict(app, count=-1)], [dict(app, count=True)],
+                         [dict(app, count="2")], [dict(app, count=1.5)], [dict(app, count=3), dict(app, count=2)],
+                         [dict(app, count=10 ** 12)]):
+            response = man.dispatch({"op": "batch_deploy", "requests": requests}, None, "deploy")
+            assert response["resp-code"] == -1 and "results" not in response, requests
+        assert len(man.swarm.services) == 0
+        for services in (None, 5, [5], ["s"] * 5):
+            response = man.dispatch({"op": "batch_shutdown", "services": services}, None, "shutdown")
+            assert response["resp-code"] == -1 and "results" not in response, services
+        # An invalid item fails on its own
+        response = man.dispatch({"op": "batch_deploy", "requests": [app, {"image": "app"}]}, None, "deploy")
+        assert [result["resp-code"] for result in response["results"]] == [0, -1] and response["failed"] == 1
+    finally:
+        man.shutdown()
+
+def test_telemetry_query(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        service_id = man.dispatch(REQUEST, None, "deploy")["service_id"]
+        man.telemetry.collect()
+        response = man.dispatch({"op": "telemetry", "service_id": service_id, "since": 0}, None, "deploy")
+        assert response["resp-code"] == 0 and list(response["services"]) == [service_id]
+        assert len(response["services"][service_id]["time"]) >= 1
+        assert man.dispatch({"op": "telemetry", "since": "yesterday"}, None, "deploy") == \
+            {"resp-code": -1, "failure-msg": "Invalid telemetry request"}
+        man.telemetry.enabled = False
+        assert man.dispatch({"op": "telemetry"}, None, "deploy") == \
+            {"resp-code": -1, "failure-msg": "Telemetry is disabled"}
+    finally:
+        man.shutdown()
+
+def test_selector_server_not_held_by_slow_request(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        man.start_request_server()
+        wait_for(lambda: manager.request_server_str in man.sockets)
+        port = man.sockets[manager.request_server_str].getsockname()[1]
+        release = block_stats(man)
+
+        slow = protocol.Connection("127.0.0.1", port, timeout=10)
+        fast = protocol.Connection("127.0.0.1", port, timeout=10)
+        stats_id = slow.send({"op": "stats"})
+        # Answered while the stats request is still waiting
+        response = fast.request(REQUEST)
+        assert response["resp-code"] == 0
+        heartbeat_id = slow.send({"op": "heartbeat", "service_id": response["service_id"]})
+        assert slow.wait(heartbeat_id)["resp-code"] == -1
+        release.set()
+        assert "deploys" in slow.wait(stats_id)
+        slow.close()
+        fast.close()
+    finally:
+        man.shutdown()
+
+def test_selector_legacy_answered_in_order(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        man.start_shutdown_server()
+        wait_for(lambda: manager.shutdown_server_str in man.sockets)
+        port = man.sockets[manager.shutdown_server_str].getsockname()[1]
+        release = block_stats(man)
+
+        conn = socket.create_connection(("127.0.0.1", port), timeout=10)
+        conn.sendall(json.dumps({"op": "stats"}).encode() + json.dumps({"service_id": "unknown"}).encode())
+        # The client is done sending, its responses still come back
+        conn.shutdown(socket.SHUT_WR)
+        time.sleep(0.1)
+        release.set()
+        received = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            received += data
+        conn.close()
+        decoder = json.JSONDecoder()
+        (first, end) = decoder.raw_decode(received.decode())
+        (second, _) = decoder.raw_decode(received.decode(), end)
+        assert "deploys" in first
+        assert second["resp-code"] == -1
+    finally:
+        man.shutdown()
+
+def test_async_server(tmp_path, monkeypatch):
+    man = setup(tmp_path, monkeypatch)
+    try:
+        man.start_async_server()
+        wait_for(lambda: len(man.async_servers) == 2)
+        # Each address family gets a port of its own
+        (request_port, shutdown_port) = [sock.getsockname()[1] for server in man.async_servers
+                                         for sock in server.sockets if sock.family == socket.AF_INET]
+        release = block_stats(man)
+
+        conn = protocol.Connection("127.0.0.1", request_port, timeout=10)
+        stats_id = conn.send({"op": "stats"})
+        # Pipelined requests are answered as they complete
+        deploy_id = conn.send(REQUEST)
+        response = conn.wait(deploy_id)
+        assert response["resp-code"] == 0 and response["id"] == deploy_id
+        release.set()
+        assert "deploys" in conn.wait(stats_id)
+        conn.close()
+
+        conn = protocol.Connection("127.0.0.1", shutdown_port, timeout=10)
+        assert conn.request({"ip": response["ip"], "service_id": response["service_id"]})["resp-code"] == 0
+        conn.close()
+        assert man.swarm.services.get(response["service_id"]) is None
+    finally:
+        man.shutdown()
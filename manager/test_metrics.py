@@ -0,0 +1,106 @@
+import socket
+import urllib.error
+import urllib.request
+import pytest
+import manager
+import metrics
+import fake_docker
+
+'''
+	Tests for the metrics: counters and histograms render in the
+	Prometheus text format, the Docker API calls of the swarm and
+	the requests of the manager are counted, and the opt-in
+	server answers scrapes on /metrics.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+def test_counter_rendered():
+    registry = metrics.Registry()
+    counter = registry.counter("calls_total", "Calls by method", ("method",))
+    counter.inc("get")
+    counter.inc("get", amount=2)
+    counter.inc('a"b\n')
+    assert counter.get("get") == 3 and counter.get("put") == 0
+    # A name registered twice is the same metric
+    assert registry.counter("calls_total", "Again", ("method",)) is counter
+    assert registry.render() == ('# HELP calls_total Calls by method\n'
+                                 '# TYPE calls_total counter\n'
+                                 'calls_total{method="a\\"b\\n"} 1\n'
+                                 'calls_total{method="get"} 3\n')
+
+def test_histogram_buckets_cumulative():
+    registry = metrics.Registry()
+    histogram = registry.histogram("wait_seconds", "Waits", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.get() == (4, 2.65)
+    assert registry.render().splitlines()[2:] == [
+        'wait_seconds_bucket{le="0.1"} 2',
+        'wait_seconds_bucket{le="1.0"} 3',
+        'wait_seconds_bucket{le="+Inf"} 4',
+        'wait_seconds_sum 2.65',
+        'wait_seconds_count 4']
+    with histogram.time():
+        pass
+    assert histogram.get()[0] == 5
+
+def test_docker_calls_counted():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    calls = metrics.DOCKER_CALLS.get("create_service", "manager")
+    errors = metrics.DOCKER_ERRORS.get("remove_service", "manager")
+    ip = list(managed_nodes)[0]
+    record = swarm_obj.create_service(ip, REQUEST)[1]
+    assert metrics.DOCKER_CALLS.get("create_service", "manager") == calls + 1
+    assert metrics.DOCKER_SECONDS.get("create_service", "manager")[0] >= 1
+    # A call that raises is counted as an error
+    assert swarm_obj.remove_service(ip, record.service_id)
+    assert not swarm_obj.remove_service(ip, record.service_id)
+    assert metrics.DOCKER_ERRORS.get("remove_service", "manager") > errors
+    client = metrics.instrument(swarm_obj.manager_conn, "manager")
+    assert metrics.instrument(client, "manager") is client and metrics.instrument(None, "x") is None
+
+def test_requests_counted(tmp_path, monkeypatch):
+    monkeypatch.setattr(manager, "REQUEST_PORT", 0)
+    monkeypatch.setattr(manager, "SHUTDOWN_PORT", 0)
+    config_file = tmp_path / "manager.conf"
+    config_file.write_text('{"reload": {"enabled": false}, "telemetry": {"enabled": false}}')
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    man = manager.Manager(str(config_file), workers=2, docker_swarm=swarm_obj)
+    try:
+        (answered, failed) = (manager.REQUESTS.get("deploy", "0"), manager.REQUESTS.get("deploy", "-1"))
+        deploys = manager.DEPLOY_PHASE_SECONDS.get("create")[0]
+        assert man.dispatch(dict(REQUEST, op="deploy"), None, "deploy")["resp-code"] == 0
+        assert man.dispatch({"op": "deploy"}, None, "deploy")["resp-code"] == -1
+        assert manager.REQUESTS.get("deploy", "0") == answered + 1
+        assert manager.REQUESTS.get("deploy", "-1") == failed + 1
+        assert manager.DEPLOY_PHASE_SECONDS.get("create")[0] == deploys + 1
+        assert "edgeap_requests_total{op=\"deploy\",code=\"0\"}" in metrics.REGISTRY.render()
+    finally:
+        man.shutdown()
+
+def test_server_serves_metrics():
+    registry = metrics.Registry()
+    registry.counter("calls_total", "Calls").inc()
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    disabled = metrics.MetricsServer(registry, port=port)
+    disabled.start()
+    assert disabled.server is None
+
+    server = metrics.MetricsServer(registry, enabled=True, port=port)
+    server.start()
+    try:
+        url = "http://127.0.0.1:{}".format(port)
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "calls_total 1" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other", timeout=5)
+        # A port in use is reported and metrics are only kept
+        taken = metrics.MetricsServer(registry, enabled=True, port=port)
+        taken.start()
+        assert taken.server is None
+    finally:
+        server.stop()
@@ -0,0 +1,119 @@
+import time
+import threading
+import swarm
+import placement
+import fake_docker
+
+'''
+	Tests for placement: each strategy picks its node among
+	those that can take the service, proximity prefers the node
+	serving the client's subnet and then its neighbours, and the
+	load of an access point is sampled from the stats of all of
+	its containers at once.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+LOADS = [placement.NodeLoad("10.0.0.1", services=3, cpu=0.2, memory=0.1),
+         placement.NodeLoad("10.0.0.2", services=1, cpu=0.6, memory=0.3),
+         placement.NodeLoad("10.0.0.3", services=2, cpu=0.1, memory=0.4)]
+
+def test_strategies():
+    assert placement.LeastLoaded().choose(LOADS).ip == "10.0.0.1"
+    assert placement.BinPack().choose(LOADS).ip == "10.0.0.2"
+    assert placement.Spread().choose(LOADS).ip == "10.0.0.2"
+    # Ties are broken by the other measure
+    tied = [placement.NodeLoad("a", services=2, cpu=0.5), placement.NodeLoad("b", services=1, cpu=0.5)]
+    assert placement.LeastLoaded().choose(tied).ip == "b"
+    assert placement.Spread().choose([placement.NodeLoad("a", services=1, cpu=0.5),
+                                      placement.NodeLoad("b", services=1, cpu=0.2)]).ip == "b"
+
+def test_proximity_subnets_and_neighbours():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    placer = placement.Placer(swarm_obj, strategy="proximity", fallback="spread",
+                              subnets={"10.0.0.1": ["192.168.0.0/16"], "10.0.0.2": ["192.168.1.0/24"],
+                                       "10.0.0.3": ["fd00::/64"]},
+                              neighbours={"10.0.0.2": ["10.0.0.3", "10.0.0.1"]})
+    proximity = placer.strategy
+    # The most specific subnet wins
+    assert proximity.home_node("192.168.1.7") == "10.0.0.2"
+    assert proximity.home_node("192.168.2.7") == "10.0.0.1"
+    assert proximity.home_node("fd00::7") == "10.0.0.3"
+    assert proximity.home_node("172.16.0.1") is None and proximity.home_node("client") is None
+
+    assert proximity.choose(LOADS, "192.168.1.7").ip == "10.0.0.2"
+    # Nearest neighbour first when the home node can not take it
+    assert proximity.choose(LOADS[:1] + LOADS[2:], "192.168.1.7").ip == "10.0.0.3"
+    assert proximity.choose(LOADS[:1], "192.168.1.7").ip == "10.0.0.1"
+    # Clients on none of the subnets get the fallback's choice
+    assert proximity.choose(LOADS, "172.16.0.1").ip == "10.0.0.2"
+    assert proximity.choose(LOADS).ip == "10.0.0.2"
+
+def test_feasible():
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    ip = list(managed_nodes)[0]
+    placer = placement.Placer(swarm_obj, max_utilization=0.8, max_services=2)
+    assert placer.feasible(placement.NodeLoad(ip, cpu=0.6, cost=0.2))
+    assert not placer.feasible(placement.NodeLoad(ip, memory=0.7, cost=0.2))
+    assert not placer.feasible(placement.NodeLoad(ip, services=2))
+    assert not placer.feasible(placement.NodeLoad(ip, free_ports=0))
+
+    swarm_obj.draining.add(ip)
+    assert not placer.feasible(placement.NodeLoad(ip))
+    swarm_obj.draining.discard(ip)
+    fake_swarm.set_node_state(ip, "down")
+    swarm_obj.node_registry.refresh()
+    assert not placer.feasible(placement.NodeLoad(ip))
+    assert placer.place(REQUEST) is None
+
+def test_place_prefers_and_excludes():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(3)
+    (first, second, third) = sorted(managed_nodes)
+    placer = placement.Placer(swarm_obj, strategy="spread")
+    assert placer.place(REQUEST, prefer=[third]) == third
+    assert placer.place(REQUEST, exclude=[first]) == second
+    # Each placement counts until the next sample
+    assert placer.place(REQUEST) == first
+    assert placer.pending[third][0] == 1
+    assert placer.place(REQUEST, reserve=False) == placer.place(REQUEST, reserve=False)
+
+def test_node_load_stats_read_in_parallel(monkeypatch):
+    costs = {"app": (0.5, 64 * fake_docker.MB)}
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1, image_costs=costs)
+    ip = list(managed_nodes)[0]
+    for _ in range(4):
+        assert swarm_obj.create_service(ip, REQUEST)[0] is True
+    get_stats = swarm.get_stats
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def slow_stats(client, container_id):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        # The daemon samples a container's CPU over a while
+        time.sleep(0.2)
+        with lock:
+            running[0] -= 1
+        return get_stats(client, container_id)
+    monkeypatch.setattr(swarm, "get_stats", slow_stats)
+
+    start = time.monotonic()
+    load = swarm_obj.get_node_load(ip)
+    assert time.monotonic() - start < 0.6
+    assert running[1] == 4
+    assert len(load["containers"]) == 4 and load["images"]["app:latest"][2] == 4
+    assert abs(load["cpu"] - 4 * 0.5 / 4) < 1e-6
+
+def test_deploy_near_client():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(3)
+    (first, second, third) = sorted(managed_nodes)
+    config = {"placement": {"strategy": "proximity", "neighbours": {second: [third]}},
+              "remotes": {first: {"subnets": ["192.168.1.0/24"]}, second: {"subnets": ["192.168.2.0/24"]},
+                          third: {}}}
+    placer = placement.create_placer(swarm_obj, config)
+    assert placer.place(REQUEST, ("192.168.2.5", 40000)) == second
+    # Being near the client comes before holding the image
+    assert placer.place(REQUEST, ("192.168.1.5", 40000), prefer=[third]) == first
+    swarm_obj.draining.add(second)
+    assert placer.place(REQUEST, ("192.168.2.5", 40000)) == third
@@ -0,0 +1,54 @@
+import pool
+import fake_docker
+
+'''
+	Tests for the warm pool: warm services are handed out once
+	each, lose their warm label before they are, and a restarted
+	manager adopts only the ones still unclaimed.
+'''
+
+REQUEST = {"image": "app", "application_port": 80, "protocol": "tcp"}
+
+def setup(size=2):
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    ip = list(managed_nodes)[0]
+    warm_pool = pool.WarmPool(swarm_obj, pools=[dict(REQUEST, size=size)])
+    key = pool.pool_key(REQUEST, ip)
+    for _ in range(size):
+        warm_pool.refill(key)
+    return (swarm_obj, warm_pool, ip, key)
+
+def adopted(swarm_obj, key):
+    restarted = pool.WarmPool(swarm_obj, pools=[dict(REQUEST, size=2)])
+    restarted.adopt()
+    return [service_id for (service_id, _) in restarted.warm[key]]
+
+def test_claimed_service_not_adopted():
+    (swarm_obj, warm_pool, ip, key) = setup()
+    (service_id, port) = warm_pool.claim(ip, REQUEST, labels={"edgeap.lease": "30"})
+    assert swarm_obj.get_service_info(service_id)["Spec"]["Labels"] == {"edgeap.lease": "30"}
+    assert warm_pool.get_stats()["hits"] == 1
+    # Only the unclaimed service goes back to the pool
+    assert adopted(swarm_obj, key) == [sid for (sid, _) in warm_pool.warm[key]]
+    assert service_id not in adopted(swarm_obj, key)
+
+def test_failed_relabel_drops_service():
+    (swarm_obj, warm_pool, ip, key) = setup(size=1)
+    (service_id, _) = warm_pool.warm[key][0]
+    set_service_labels = swarm_obj.set_service_labels
+    swarm_obj.set_service_labels = lambda service_id, labels: False
+    warm_pool.schedule_refill = lambda key: None
+    assert warm_pool.claim(ip, REQUEST) is None
+    warm_pool.executor.shutdown(wait=True)
+    swarm_obj.set_service_labels = set_service_labels
+    assert swarm_obj.services.get(service_id) is None
+    assert service_id not in adopted(swarm_obj, key)
+    assert warm_pool.get_stats()["relabel_failures"] == 1
+
+def test_empty_pool_misses():
+    (swarm_obj, warm_pool, ip, key) = setup(size=1)
+    warm_pool.schedule_refill = lambda key: None
+    assert warm_pool.claim(ip, REQUEST) is not None
+    assert warm_pool.claim(ip, REQUEST) is None
+    assert warm_pool.claim(ip, dict(REQUEST, image="other")) is None
+    assert warm_pool.get_stats()["misses"] == 1
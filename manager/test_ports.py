@@ -0,0 +1,65 @@
+import threading
+import ports
+
+'''
+	Tests for the host port allocator: ports are handed out once
+	each, released ports come back only after every other free
+	port, and reserved ports are never handed out.
+'''
+
+def test_exhausted_and_released_last():
+    allocator = ports.PortAllocator(100, 103)
+    assert [allocator.allocate() for _ in range(4)] == [100, 101, 102, 103]
+    assert allocator.allocate() is None and allocator.free_count() == 0
+    allocator.release(101)
+    allocator.release(101)
+    assert len(allocator) == 3 and 101 not in allocator
+    assert allocator.allocate() == 101
+    assert allocator.allocate() is None
+
+def test_released_port_reused_after_others():
+    allocator = ports.PortAllocator(100, 104)
+    first = allocator.allocate()
+    allocator.release(first)
+    assert [allocator.allocate() for _ in range(5)] == [101, 102, 103, 104, 100]
+
+def test_used_and_reserved_ports_skipped():
+    allocator = ports.PortAllocator(100, 104, reserved=[101, 7])
+    assert allocator.mark_used(103) is True
+    assert allocator.mark_used(103) is False and allocator.mark_used(200) is False
+    assert [allocator.allocate() for _ in range(3)] == [100, 102, 104]
+    assert allocator.allocate() is None
+    # Reserved ports stay used, out of range ones are ignored
+    allocator.release(101)
+    allocator.release(7)
+    assert 101 in allocator and allocator.allocate() is None
+    allocator.release(103)
+    assert allocator.allocate() == 103
+
+def test_parallel_allocations_unique():
+    allocator = ports.PortAllocator(1000, 1999)
+    allocated = []
+    lock = threading.Lock()
+
+    def allocate():
+        mine = [allocator.allocate() for _ in range(100)]
+        with lock:
+            allocated.extend(mine)
+    threads = [threading.Thread(target=allocate) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(allocated) == list(range(1000, 2000))
+
+def test_configuration():
+    allocator = ports.create_allocator({"range": [50000, 50009], "reserved": [50000, "50002-50004"]})
+    assert (allocator.start, allocator.end) == (50000, 50009)
+    assert allocator.reserved == {50000, 50002, 50003, 50004}
+    assert allocator.free_count() == 6
+    for config in ({"range": 5}, {"range": [60000, 50000]}, {"reserved": ["a-b"]}):
+        try:
+            ports.create_allocator(config)
+        except ValueError:
+            continue
+        assert False, config
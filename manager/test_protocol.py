@@ -0,0 +1,102 @@
+import json
+import socket
+import threading
+import protocol
+
+'''
+	Tests for the control protocol: framed and legacy requests
+	split or batched across reads, malformed messages, and a
+	client Connection matching pipelined responses and pushed
+	messages against a local server.
+'''
+
+def test_frames_split_and_batched():
+    decoder = protocol.FrameDecoder()
+    data = protocol.encode_frame({"id": 1, "op": "deploy"}) + protocol.encode_frame({"id": 2})
+    assert decoder.feed(data[:3]) == []
+    assert decoder.feed(data[3:10]) == []
+    assert decoder.feed(data[10:]) == [{"id": 1, "op": "deploy"}, {"id": 2}]
+    assert decoder.framed is True
+    assert decoder.encode({"resp-code": 0}) == protocol.encode_frame({"resp-code": 0})
+
+def test_invalid_frames():
+    decoder = protocol.FrameDecoder()
+    body = b"[1, 2]"
+    assert decoder.feed(protocol.HEADER.pack(len(body)) + body) == [None]
+    body = b"{not json"
+    assert decoder.feed(protocol.HEADER.pack(len(body)) + body) == [None]
+    try:
+        decoder.feed(protocol.HEADER.pack(protocol.MAX_FRAME_SIZE + 1))
+    except protocol.FrameError:
+        return
+    assert False, "oversized frame accepted"
+
+def test_legacy_requests():
+    decoder = protocol.FrameDecoder()
+    assert decoder.feed(b'  {"image": "a"}{"image"') == [{"image": "a"}]
+    assert decoder.framed is False
+    assert decoder.feed(b': "b"}') == [{"image": "b"}]
+    # A character split across reads
+    data = json.dumps({"image": "café"}, ensure_ascii=False).encode()
+    split = data.index(b"\xc3") + 1
+    assert decoder.feed(data[:split]) == []
+    assert decoder.feed(data[split:]) == [{"image": "café"}]
+    assert decoder.feed(b'{"image": }') == [None]
+    assert decoder.encode({"resp-code": 0}) == b'{"resp-code": 0}'
+
+def test_legacy_stream_bounded():
+    # Trailing bytes that can not begin a request are answered
+    decoder = protocol.FrameDecoder()
+    assert decoder.feed(b'{"image": "a"} x') == [{"image": "a"}, None]
+    assert decoder.feed(b'{"image": "b"}') == [{"image": "b"}]
+    assert decoder.feed(b'{"image": "\xff\xff\xff\xff') == [None]
+    # A request that is never completed is not buffered forever
+    decoder.feed(b'{"image": "')
+    chunk = b"a" * 4096
+    try:
+        for _ in range(protocol.MAX_LEGACY_SIZE // len(chunk) + 1):
+            assert decoder.feed(chunk) == []
+    except protocol.FrameError as e:
+        assert str(e) == "Invalid request"
+        assert len(decoder.buffer) == 0
+        return
+    assert False, "oversized legacy request buffered"
+
+def serve_once(listener, handle):
+    (conn, _) = listener.accept()
+    decoder = protocol.FrameDecoder()
+    requests = []
+    while len(requests) < 2:
+        requests += decoder.feed(conn.recv(4096))
+    handle(conn, requests)
+    conn.close()
+
+def test_connection_matches_responses():
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def handle(conn, requests):
+        # Answer out of order, with a pushed message in between
+        (first, second) = requests
+        conn.sendall(protocol.encode_frame({"id": second["id"], "resp-code": 0}) +
+                     protocol.encode_frame({"op": "migrate", "service_id": "s1", "new_service_id": "s2"}) +
+                     protocol.encode_frame({"id": first["id"], "resp-code": -1}))
+    thread = threading.Thread(target=serve_once, args=(listener, handle))
+    thread.start()
+
+    connection = protocol.Connection("127.0.0.1", listener.getsockname()[1], timeout=5)
+    first = connection.send({"op": "deploy"})
+    second = connection.send({"op": "shutdown"})
+    assert first != second
+    assert connection.wait(first) == {"id": first, "resp-code": -1}
+    assert connection.wait(second) == {"id": second, "resp-code": 0}
+    assert connection.take_pushed() == [{"op": "migrate", "service_id": "s1", "new_service_id": "s2"}]
+    assert connection.take_pushed() == []
+    thread.join()
+    try:
+        connection.wait(3)
+    except ConnectionError:
+        pass
+    else:
+        assert False, "closed connection not reported"
+    connection.close()
+    listener.close()
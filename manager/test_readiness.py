@@ -0,0 +1,63 @@
+import socket
+import readiness
+import registry
+import fake_docker
+
+'''
+	Tests for readiness: a service is ready once one of its tasks
+	runs and, for TCP services, its published port accepts
+	connections; a failed task or the timeout end the wait.
+'''
+
+def setup(task_states, **kwargs):
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    polls = []
+
+    # Each poll returns the tasks in the next of task_states
+    def get_service_tasks(service_id):
+        states = task_states[min(len(polls), len(task_states) - 1)]
+        polls.append(service_id)
+        return [{"Status": dict({"State": state}, **({"Err": "exit 1"} if state == "failed" else {}))}
+                for state in states]
+    swarm_obj.get_service_tasks = get_service_tasks
+    options = dict({"timeout": 1, "poll_interval": 0.01, "probe": False}, **kwargs)
+    return (readiness.ReadinessChecker(swarm_obj, **options), polls)
+
+def record(port=50000, protocol="tcp"):
+    return registry.ServiceRecord("s1", "127.0.0.1", port, "app:latest", 80, protocol)
+
+def test_ready_once_running():
+    (checker, polls) = setup([[], ["pending"], ["preparing"], ["failed", "running"]])
+    assert checker.wait_ready(record()) == (True, None)
+    assert len(polls) == 4
+
+def test_failed_task_ends_wait():
+    (checker, polls) = setup([["pending"], ["rejected", "failed"]])
+    assert checker.wait_ready(record()) == (False, "task failed: exit 1")
+    assert len(polls) == 2
+
+def test_timeout():
+    (checker, polls) = setup([["pending"]], timeout=0.1)
+    assert checker.wait_ready(record()) == (False, "not running after 0.1s (task pending)")
+    (checker, polls) = setup([[]])
+    assert checker.wait_ready(record(), timeout=0.05) == (False, "not running after 0.05s (task not scheduled)")
+
+def test_port_probed():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+    (checker, polls) = setup([["running"]], probe=True, timeout=0.2)
+    try:
+        assert checker.wait_ready(record(port)) == (True, None)
+    finally:
+        listener.close()
+    assert checker.wait_ready(record(port)) == (False, "port {} not accepting connections after 0.2s".format(port))
+    # UDP services can not be probed, running is enough
+    assert checker.wait_ready(record(port, "udp")) == (True, None)
+
+def test_should_wait():
+    (checker, polls) = setup([["running"]])
+    assert not checker.should_wait({}) and checker.should_wait({"wait_ready": True})
+    (checker, polls) = setup([["running"]], wait=True)
+    assert checker.should_wait({}) and not checker.should_wait({"wait_ready": False})
@@ -0,0 +1,155 @@
+import placement
+import readiness
+import leases
+import telemetry
+import rebalancer
+import fake_docker
+
+'''
+	Simulation tests for the rebalancer. Services run on a fake
+	swarm whose containers use the CPU set per image, so that
+	deploying several busy services on one access point makes
+	it hot. Clients are fake channels recording what the
+	manager pushes to them.
+'''
+
+BUSY = "busy"
+# 1.5 of the 4 cores of an access point per container
+IMAGE_COSTS = {BUSY: (1.5, 64 * fake_docker.MB)}
+REQUEST = {"image": BUSY, "application_port": 5555, "protocol": "tcp"}
+
+class FakeChannel:
+
+    def __init__(self, connected=True, on_send=None):
+        self.connected = connected
+        self.on_send = on_send
+        self.messages = []
+
+    def send(self, message):
+        if not self.connected:
+            return False
+        self.messages.append(message)
+        if self.on_send is not None:
+            self.on_send(message)
+        return True
+
+class NeverReady:
+
+    def wait_ready(self, record, timeout=None):
+        return (False, "not running after 0s (task pending)")
+
+def setup(services=2, channel=None, ready=None, request=REQUEST):
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2, image_costs=IMAGE_COSTS)
+    (hot, cold) = list(managed_nodes)
+    collector = telemetry.TelemetryCollector(swarm_obj)
+    lease_table = leases.LeaseTable(swarm_obj)
+    subscribers = rebalancer.Subscribers()
+    records = []
+    for _ in range(services):
+        (resp, record) = swarm_obj.create_service(hot, request, labels=lease_table.labels(30))
+        assert resp is True
+        lease_table.grant(record.service_id, 30)
+        records.append(record)
+    if channel is not None:
+        for record in records:
+            subscribers.subscribe(record.service_id, channel)
+    collector.collect()
+
+    balancer = rebalancer.Rebalancer(swarm_obj, placement.Placer(swarm_obj), collector,
+                                     ready or readiness.ReadinessChecker(swarm_obj, timeout=1, probe=False),
+                                     subscribers, leases=lease_table, enabled=True,
+                                     hot_threshold=0.7, grace=0)
+    return (swarm_obj, balancer, hot, cold, records)
+
+def test_service_moved_and_client_told():
+    channel = FakeChannel()
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=channel)
+    # The old service must still run when the client is told
+    alive = []
+    channel.on_send = lambda message: alive.append(swarm_obj.services.get(message["service_id"]) is not None)
+    assert balancer.hot_nodes() == [hot]
+
+    moved = balancer.rebalance()
+    assert len(moved) == 1
+    (old_id, new_record) = moved[0]
+    assert new_record.ip == cold
+    assert alive == [True]
+    assert channel.messages == [{"op": "migrate", "service_id": old_id,
+                                 "new_service_id": new_record.service_id,
+                                 "ip": cold, "port": new_record.port}]
+    assert swarm_obj.services.get(old_id) is None
+    assert swarm_obj.services.count(hot) == 1 and swarm_obj.services.count(cold) == 1
+    # The lease and the subscription follow the service
+    assert balancer.leases.renew(old_id) is None
+    assert balancer.leases.renew(new_record.service_id) == 30
+    assert balancer.subscribers.has(new_record.service_id) and not balancer.subscribers.has(old_id)
+    # The node is left alone until its samples catch up
+    assert balancer.rebalance() == []
+
+def test_cold_node_left_alone():
+    (swarm_obj, balancer, hot, cold, records) = setup(services=1, channel=FakeChannel())
+    assert balancer.hot_nodes() == []
+    assert balancer.rebalance() == []
+
+def test_services_without_clients_not_moved():
+    (swarm_obj, balancer, hot, cold, records) = setup()
+    assert balancer.hot_nodes() == [hot]
+    assert balancer.rebalance() == []
+    assert swarm_obj.services.count(hot) == 2
+
+def test_unready_replacement_removed():
+    channel = FakeChannel()
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=channel, ready=NeverReady())
+    assert balancer.rebalance() == []
+    assert channel.messages == []
+    assert swarm_obj.services.count(hot) == 2 and swarm_obj.services.count(cold) == 0
+    assert balancer.get_stats()["not_ready"] == 2
+
+def test_disconnected_client_rolls_back():
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=FakeChannel(connected=False))
+    assert balancer.rebalance() == []
+    assert swarm_obj.services.count(hot) == 2 and swarm_obj.services.count(cold) == 0
+    for record in records:
+        assert balancer.leases.renew(record.service_id) == 30
+    assert balancer.get_stats()["client_gone"] == 2
+
+def test_migration_metrics_recorded():
+    migrated = rebalancer.MIGRATIONS.get("migrated")
+    totals = rebalancer.MIGRATION_SECONDS.get("total")[0]
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=FakeChannel())
+    assert len(balancer.rebalance()) == 1
+    assert rebalancer.MIGRATIONS.get("migrated") == migrated + 1
+    assert rebalancer.MIGRATION_SECONDS.get("total")[0] == totals + 1
+    assert balancer.get_stats()["migrated"] == 1
+
+def test_abandoned_moves_reserve_nothing():
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=FakeChannel(connected=False))
+    assert balancer.rebalance() == []
+    assert balancer.placer.pending.get(cold, [0])[0] == 0
+
+def test_old_service_removal_retried():
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=FakeChannel())
+    remove_service = swarm_obj.remove_service
+    swarm_obj.remove_service = lambda ip, service_id: False if ip == hot else remove_service(ip, service_id)
+    (old_id, new_record) = balancer.rebalance()[0]
+    assert balancer.placer.pending[cold][0] == 1
+    assert swarm_obj.services.get(old_id) is not None
+    assert balancer.get_stats()["old_not_removed"] == 1 and balancer.get_stats()["orphans"] == 1
+
+    swarm_obj.remove_service = remove_service
+    balancer.rebalance()
+    assert swarm_obj.services.get(old_id) is None
+    assert balancer.get_stats()["orphans"] == 0 and balancer.get_stats()["orphans_removed"] == 1
+
+def test_limits_carried_over():
+    limited = dict(REQUEST, resources={"cpu_limit": 2, "memory_limit": "256m"})
+    (swarm_obj, balancer, hot, cold, records) = setup(channel=FakeChannel(), request=limited)
+    assert (records[0].cpu_limit, records[0].memory_limit) == (2.0, 256 << 20)
+    # Limits are also read back from the spec of services found in the swarm
+    parsed = swarm_obj.parse_service(swarm_obj.get_service_info(records[0].service_id))
+    assert (parsed.cpu_limit, parsed.memory_limit) == (2.0, 256 << 20)
+
+    (old_id, new_record) = balancer.rebalance()[0]
+    assert (new_record.cpu_limit, new_record.memory_limit) == (2.0, 256 << 20)
+    limits = swarm_obj.get_service_info(new_record.service_id)["Spec"]["TaskTemplate"]["Resources"]["Limits"]
+    assert limits == {"NanoCPUs": 2 * 10 ** 9, "MemoryBytes": 256 << 20}
@@ -0,0 +1,122 @@
+import registry
+import fake_docker
+
+'''
+	Tests for the in-memory registries: nodes are looked up by IP
+	or id without listing the swarm each time, and an address
+	shared by several nodes maps to a ready one; services are
+	indexed by id and by node, and their records round-trip
+	through the journal.
+'''
+
+def node(node_id, ip, state="ready"):
+    return {"ID": node_id, "Status": {"State": state, "Addr": ip}}
+
+class Lister:
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.nodes
+
+def test_lookups_without_listing():
+    lister = Lister([node("n1", "10.0.0.1"), node("n2", "10.0.0.2")])
+    nodes = registry.NodeRegistry(lister, min_refresh_interval=60)
+    assert nodes.get(server_ip="10.0.0.1")["ID"] == "n1"
+    assert nodes.get(node_id="n2")["Status"]["Addr"] == "10.0.0.2"
+    assert nodes.get(server_ip="10.0.0.2")["ID"] == "n2"
+    assert lister.calls == 1
+    # A miss refreshes at most once per interval
+    assert nodes.get(server_ip="10.0.0.3") is None
+    assert lister.calls == 1
+    nodes.invalidate()
+    lister.nodes.append(node("n3", "10.0.0.3"))
+    assert nodes.get(server_ip="10.0.0.3")["ID"] == "n3"
+    assert lister.calls == 2
+
+def test_failed_listing_keeps_nodes():
+    lister = Lister([node("n1", "10.0.0.1")])
+    nodes = registry.NodeRegistry(lister)
+    assert nodes.refresh()
+    lister.nodes = None
+    assert not nodes.refresh()
+    assert nodes.lookup(server_ip="10.0.0.1")["ID"] == "n1"
+
+def test_rejoined_node_ready_one_wins():
+    nodes = registry.NodeRegistry(Lister([]))
+    nodes.add(node("old", "10.0.0.1"))
+    nodes.add(node("old", "10.0.0.1", state="down"))
+    nodes.add(node("new", "10.0.0.1"))
+    assert nodes.lookup(server_ip="10.0.0.1")["ID"] == "new"
+    # A down node does not take the address of a ready one
+    nodes.add(node("stale", "10.0.0.1", state="down"))
+    assert nodes.lookup(server_ip="10.0.0.1")["ID"] == "new"
+    nodes.remove("new")
+    assert nodes.lookup(server_ip="10.0.0.1")["ID"] in ("old", "stale")
+    assert nodes.lookup(node_id="new") is None
+    assert len(nodes.nodes()) == 2
+
+def test_deploys_do_not_list_nodes():
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2)
+    ip = sorted(managed_nodes)[0]
+    swarm_obj.node_registry.refresh()
+    listed = []
+    nodes = swarm_obj.manager_conn.nodes
+
+    def count_nodes(*args, **kwargs):
+        listed.append(1)
+        return nodes(*args, **kwargs)
+    swarm_obj.manager_conn.nodes = count_nodes
+    for _ in range(3):
+        assert swarm_obj.create_service(ip, {"image": "app", "application_port": 80, "protocol": "tcp"})[0]
+        assert swarm_obj.is_node_ready(ip)
+    assert listed == []
+    # Until a node joins
+    swarm_obj.node_registry.invalidate()
+    assert swarm_obj.node_registry.get(server_ip="10.9.9.9") is None
+    assert listed == [1]
+
+def test_service_registry_indexes():
+    services = registry.ServiceRegistry()
+    first = registry.ServiceRecord("s1", "10.0.0.1", 50000, "app:latest")
+    assert services.add(first) is first
+    # A service registered again keeps its record
+    assert services.add(registry.ServiceRecord("s1", "10.0.0.2", 50001)) is first
+    services.add(registry.ServiceRecord("s2", "10.0.0.1", 50001))
+    services.add(registry.ServiceRecord("s3", "10.0.0.2", 50000))
+    assert len(services) == 3 and services.get("s1").port == 50000
+    assert sorted(services.ids("10.0.0.1")) == ["s1", "s2"] and services.count("10.0.0.2") == 1
+    assert services.remove("s1") is first and services.remove("s1") is None
+    assert services.ids("10.0.0.1") == ["s2"] and services.get("s1") is None
+    # The node stays known once emptied
+    services.remove("s2")
+    assert services.has_node("10.0.0.1") and services.count("10.0.0.1") == 0
+    assert not services.has_node("10.0.0.3")
+    assert [record.service_id for record in services.records()] == ["s3"]
+
+def test_service_record_round_trip():
+    record = registry.ServiceRecord("s1", "10.0.0.1", 50000, "app:latest", 80, "tcp", 1.5, 0.5, 1 << 20,
+                                    1.0, 1 << 21)
+    assert registry.ServiceRecord(**record.to_dict()).to_dict() == record.to_dict()
+    # Records journaled before resources were tracked still load
+    old = {"service_id": "s2", "ip": "10.0.0.1", "port": 50001, "image": "app:latest"}
+    loaded = registry.ServiceRecord(**old).to_dict()
+    assert loaded.pop("created_at") is not None
+    assert loaded == dict(old, application_port=None, protocol=None, cpu=0.0, memory=0,
+                          cpu_limit=0.0, memory_limit=0)
+
+def test_swarm_tracks_services():
+    (fake_swarm, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2)
+    (first, second) = sorted(managed_nodes)
+    request = {"image": "app", "application_port": 80, "protocol": "tcp"}
+    records = [swarm_obj.create_service(ip, request)[1] for ip in (first, first, second)]
+    assert swarm_obj.services.count(first) == 2 and swarm_obj.services.count(second) == 1
+    assert swarm_obj.has_service(first, records[0].service_id)
+    assert not swarm_obj.has_service(second, records[0].service_id)
+    record = swarm_obj.services.get(records[0].service_id)
+    assert (record.ip, record.image, record.application_port, record.protocol) == (first, "app:latest", 80, "tcp")
+    assert swarm_obj.remove_service(first, records[0].service_id)
+    assert swarm_obj.services.ids(first) == [records[1].service_id]
@@ -1,60 +1,59 @@
-import socket
 import sys
-import os
 import json
 import time
+import protocol
 
 manager_ip = "172.0.0.2"
 request_port = 60001
-shutdown_port = 60002
 
 def create_connection(ip, port):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        s.connect((ip, port))
+        conn = protocol.Connection(ip, port)
     except (ConnectionRefusedError, OSError):
         print("Error connecting to manager", file=sys.stderr)
         sys.exit(-1)
 
     print("Successfully connected to {}".format(ip), file=sys.stderr)
-    return s
+    return conn
 
 print("Connecting to the request server...")
-s = create_connection(manager_ip, request_port)
+conn = create_connection(manager_ip, request_port)
 
 print("Sending request...")
-request = {"image":"ubuntu","application_port":1234,"protocol":"tcp"}
-s.sendall(json.dumps(request).encode())
+request = {"op":"deploy","image":"ubuntu","application_port":1234,"protocol":"tcp"}
+resp = conn.request(request)
 print("Successfully sent: \n{}".format(json.dumps(request, indent=3)))
-resp = s.recv(1024)
-resp = json.loads(resp.decode())
 print("RESPONSE: ", resp)
-s.close()
 
 print("Sleeping...")
 time.sleep(5)
 
-print("Connecting to the shutdown server...")
-s = create_connection(manager_ip, shutdown_port)
-
+# Reuse the same connection for the shutdown request
 print("Sending shutdown request...")
-request = resp
-s.sendall(json.dumps(request).encode())
+request = dict(resp, op="shutdown")
+del request["id"]
+resp = conn.request(request)
 print("Successfully sent: \n{}".format(json.dumps(request, indent=3)))
-resp = s.recv(1024)
-resp = json.loads(resp.decode())
 print("RESPONSE: ", resp)
-s.close()
-
-
-
-
-
-
 
-
-
-
-
-
-    
+# Pipeline several requests on one connection and match the
+# responses up by request id
+print("Sending pipelined requests...")
+ids = [conn.send({"op":"deploy","image":"ubuntu","application_port":1234,"protocol":"tcp"})
+       for _ in range(3)]
+responses = [conn.wait(request_id) for request_id in ids]
+print("RESPONSES: ", responses)
+ids = [conn.send({"op":"shutdown","ip":r["ip"],"service_id":r["service_id"]})
+       for r in responses if r["resp-code"] == 0]
+print("RESPONSES: ", [conn.wait(request_id) for request_id in ids])
+
+# Deploy several instances in one batch request, then remove
+# them all at once
+print("Sending batch requests...")
+resp = conn.request({"op":"batch_deploy",
+                     "requests":[{"image":"ubuntu","application_port":1234,"protocol":"tcp","count":3}]})
+print("RESPONSE: ", resp)
+resp = conn.request({"op":"batch_shutdown",
+                     "services":[r["service_id"] for r in resp["results"] if r["resp-code"] == 0]})
+print("RESPONSE: ", resp)
+conn.close()
@@ -0,0 +1,107 @@
+import time
+import docker
+import swarm
+import placement
+import resilience
+import fake_docker
+
+'''
+	Tests for the resilience layer under DockerSwarm. Access
+	points are fake clients wrapped in a FaultInjector, which
+	makes their calls fail like those of an access point that
+	dropped off the network.
+'''
+
+REQUEST = {"image": "ubuntu", "application_port": 1234, "protocol": "tcp"}
+
+# Fast retries and breakers, so the tests do not wait for long
+POLICY = {"retries": 2, "backoff": 0.01, "max_backoff": 0.02, "deadline": 1,
+          "failure_threshold": 3, "reset_timeout": 0.2}
+
+def setup(num_nodes=2, policy=POLICY):
+    (_, swarm_obj, faulty) = fake_docker.create_fake_swarm(num_nodes, wrap=fake_docker.FaultInjector,
+                                                           resilience_config=policy)
+    return (swarm_obj, faulty)
+
+def test_idempotent_calls_retried():
+    (swarm_obj, faulty) = setup()
+    ip = list(faulty)[0]
+    faulty[ip].fail("info", times=2)
+    assert swarm.get_info(swarm_obj.nodes[ip]) is not None
+    assert faulty[ip].calls["info"] == 3
+    assert swarm_obj.is_node_available(ip)
+
+def test_other_calls_not_retried():
+    (swarm_obj, faulty) = setup()
+    ip = list(faulty)[0]
+    faulty[ip].fail("pull", times=1)
+    try:
+        swarm_obj.nodes[ip].pull("ubuntu")
+    except resilience.NodeUnavailable:
+        pass
+    else:
+        raise AssertionError("pull did not fail")
+    assert faulty[ip].calls["pull"] == 1
+
+def test_api_errors_not_retried():
+    (swarm_obj, faulty) = setup()
+    ip = list(faulty)[0]
+    faulty[ip].fail("info", error=docker.errors.NotFound)
+    assert swarm.get_info(swarm_obj.nodes[ip]) is None
+    assert faulty[ip].calls["info"] == 1
+    # The node answered, so it is not held against it
+    assert swarm_obj.resilience.breaker(ip).failures == 0
+
+def test_deadline_bounds_retries():
+    policy = dict(POLICY, retries=100, failure_threshold=1000)
+    (swarm_obj, faulty) = setup(policy=policy)
+    ip = list(faulty)[0]
+    faulty[ip].fail("info", delay=0.1)
+    start = time.monotonic()
+    assert swarm.get_info(swarm_obj.nodes[ip]) is None
+    assert time.monotonic() - start < policy["deadline"] + 0.5
+    assert faulty[ip].calls["info"] < 15
+
+def test_breaker_fails_fast_and_placement_skips_node():
+    (swarm_obj, faulty) = setup()
+    (down, up) = list(faulty)
+    placer = placement.Placer(swarm_obj)
+    faulty[down].fail(delay=0.05)
+    # The first call retries until the breaker opens
+    assert swarm_obj.get_node_load(down) is None
+    assert not swarm_obj.is_node_available(down)
+
+    calls = dict(faulty[down].calls)
+    start = time.monotonic()
+    assert swarm_obj.get_node_load(down) is None
+    assert time.monotonic() - start < 0.05
+    assert faulty[down].calls == calls
+
+    for _ in range(5):
+        assert placer.place(REQUEST) == up
+
+def test_breaker_closes_once_node_recovers():
+    (swarm_obj, faulty) = setup()
+    ip = list(faulty)[0]
+    faulty[ip].fail()
+    assert swarm_obj.get_node_load(ip) is None
+    assert not swarm_obj.is_node_available(ip)
+
+    faulty[ip].heal()
+    time.sleep(POLICY["reset_timeout"])
+    # Placement considers the node again once a trial call may go through
+    assert swarm_obj.is_node_available(ip)
+    assert swarm_obj.get_node_load(ip) is not None
+    assert swarm_obj.resilience.breaker(ip).state == resilience.CLOSED
+
+def test_failed_trial_reopens_breaker():
+    (swarm_obj, faulty) = setup()
+    ip = list(faulty)[0]
+    faulty[ip].fail()
+    swarm_obj.get_node_load(ip)
+    time.sleep(POLICY["reset_timeout"])
+    calls = faulty[ip].calls["info"]
+    assert swarm.get_info(swarm_obj.nodes[ip]) is None
+    # One trial call, no retries once it failed
+    assert faulty[ip].calls["info"] == calls + 1
+    assert swarm_obj.resilience.breaker(ip).state == resilience.OPEN
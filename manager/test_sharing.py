@@ -0,0 +1,73 @@
+import sharing
+import fake_docker
+
+'''
+	Tests for shared instances: identical deploys join the
+	running instance with the fewest clients, up to max_clients,
+	each shutdown detaches one client, and a restarted manager
+	adopts the client counts saved in the instances' labels.
+'''
+
+REQUEST = {"image": "shared", "application_port": 5555, "protocol": "tcp"}
+
+def setup(instances=1, **kwargs):
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2)
+    (ip, other) = sorted(managed_nodes)
+    shared = sharing.SharedInstances(swarm_obj, **dict({"enabled": True, "max_clients": 3}, **kwargs))
+    service_ids = []
+    for _ in range(instances):
+        (resp, record) = swarm_obj.create_service(ip, REQUEST, labels=shared.shared_labels({"team": "a"}))
+        shared.add(ip, REQUEST, record.service_id, {"team": "a"})
+        service_ids.append(record.service_id)
+    return (swarm_obj, shared, ip, other, service_ids)
+
+def label(swarm_obj, shared, service_id):
+    shared.executor.shutdown(wait=True)
+    return swarm_obj.get_service_info(service_id)["Spec"]["Labels"]
+
+def test_attach_fewest_clients_up_to_max():
+    (swarm_obj, shared, ip, other, (first, second)) = setup(instances=2)
+    attached = [shared.attach(ip, REQUEST)[:3:2] for _ in range(4)]
+    assert sorted(attached) == [(first, 2), (first, 3), (second, 2), (second, 3)]
+    assert shared.attach(ip, REQUEST) is None
+    assert shared.preferred_nodes(REQUEST) == set()
+    # Other access points and other requests have instances of their own
+    assert shared.attach(other, REQUEST) is None
+    assert shared.attach(ip, dict(REQUEST, application_port=80)) is None
+    assert shared.get_stats() == {"attached": 4, "started": 2, "detached": 0, "removed": 0,
+                                  "instances": 2, "clients": 6}
+
+def test_detach_counts_down():
+    (swarm_obj, shared, ip, other, (service_id,)) = setup()
+    assert shared.preferred_nodes(REQUEST) == {ip}
+    shared.attach(ip, REQUEST)
+    assert shared.detach(service_id) == 1
+    assert label(swarm_obj, shared, service_id) == {"team": "a", sharing.SHARED_LABEL: "1"}
+    # The last client leaves the instance to be removed
+    assert shared.detach(service_id) == 0
+    assert shared.is_closing(service_id) and shared.detach(service_id) is None
+    shared.removed(service_id)
+    assert not shared.is_shared(service_id) and not shared.is_closing(service_id)
+    assert shared.detach("other") is None
+    assert shared.get_stats()["removed"] == 1
+
+def test_client_counts_adopted_after_restart():
+    (swarm_obj, shared, ip, other, (first, second)) = setup(instances=2)
+    shared.attach(ip, REQUEST)
+    shared.attach(ip, REQUEST)
+    counts = {service_id: shared.client_count(service_id) for service_id in (first, second)}
+    shared.executor.shutdown(wait=True)
+    swarm_obj.set_service_labels(second, {sharing.SHARED_LABEL: "many"})
+
+    restarted = sharing.SharedInstances(swarm_obj, enabled=True, max_clients=3)
+    restarted.start()
+    # An instance whose count can not be read is not shared
+    assert restarted.client_count(first) == counts[first] and not restarted.is_shared(second)
+    assert restarted.attach(ip, REQUEST)[0] == first
+
+def test_should_share():
+    (swarm_obj, shared, ip, other, _) = setup(instances=0, images=["shared:latest"])
+    assert shared.should_share(REQUEST) and not shared.should_share(dict(REQUEST, shared=False))
+    assert not shared.should_share(dict(REQUEST, image="other"))
+    shared.enabled = False
+    assert not shared.should_share(REQUEST) and shared.should_share(dict(REQUEST, shared=True))
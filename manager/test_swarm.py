@@ -19,7 +19,8 @@ def main():
                "application_port": 4000,
                "protocol": "tcp"
                }
-    (resp, service_id) = swarm_obj.create_service("172.0.0.1", request)
+    (resp, record) = swarm_obj.create_service("172.0.0.1", request)
+    service_id = record.service_id
 
     # Print out service info
     print(json.dumps(swarm_obj.get_service_info(service_id), indent=3))
@@ -30,7 +31,7 @@ def main():
     # Remove service
     #service_id = swarm_obj.services["172.0.0.1"][0]
     resp = swarm_obj.remove_service("172.0.0.1", service_id)
-    print(swarm_obj.services)
+    print(swarm_obj.services.records())
     print(swarm_obj.ports)
 
     # Shutdown swarm
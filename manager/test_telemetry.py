@@ -0,0 +1,79 @@
+import time
+import telemetry
+import fake_docker
+
+'''
+	Tests for the telemetry collector: samples are kept in fixed
+	size ring buffers per access point and per service, byte
+	counts become rates, and queries return the latest samples
+	or the history since a given time.
+'''
+
+REQUEST = {"image": "busy", "application_port": 80, "protocol": "tcp"}
+
+def sample(containers, services=1):
+    return {"cpu": 0.5, "memory": 0.25, "services": services,
+            "containers": {container_id: {"service_id": service_id, "cpu": 0.5, "memory": 0.25,
+                                          "rx_bytes": rx_bytes, "tx_bytes": tx_bytes}
+                           for container_id, (service_id, rx_bytes, tx_bytes) in containers.items()}}
+
+def test_ring_buffer_wraps():
+    buffer = telemetry.RingBuffer(3, ("cpu",))
+    assert buffer.latest() is None and buffer.mean("cpu") is None
+    for i in range(5):
+        buffer.append(float(i), {"cpu": i / 10})
+    assert len(buffer) == 3
+    assert buffer.series() == {"time": [2.0, 3.0, 4.0], "cpu": [0.2, 0.3, 0.4]}
+    assert buffer.series(since=3.0) == {"time": [4.0], "cpu": [0.4]}
+    assert buffer.latest() == {"time": 4.0, "cpu": 0.4}
+    assert abs(buffer.mean("cpu") - 0.3) < 1e-9
+    # Samples older than the window do not count
+    now = time.time()
+    buffer.append(now - 100, {"cpu": 1.0})
+    buffer.append(now, {"cpu": 0.0})
+    assert buffer.mean("cpu", window=10) == 0.0
+
+def test_byte_counts_become_rates():
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(1)
+    ip = list(managed_nodes)[0]
+    record = swarm_obj.create_service(ip, REQUEST)[1]
+    collector = telemetry.TelemetryCollector(swarm_obj)
+    collector.record({ip: sample({"c1": (record.service_id, 1000, 500), "c2": (None, 0, 0)})}, 100.0)
+    collector.record({ip: sample({"c1": (record.service_id, 3000, 500), "c2": (None, 400, 200)}),
+                      "10.9.9.9": None}, 102.0)
+    node = collector.query(ip)["nodes"][ip]
+    assert node["time"] == [100.0, 102.0]
+    assert node["rx_rate"] == [0.0, 1200.0] and node["tx_rate"] == [0.0, 100.0]
+    service = collector.query(service_id=record.service_id)["services"][record.service_id]
+    assert service["rx_rate"] == [0.0, 1000.0] and service["cpu"] == [0.5, 0.5]
+    # A container restarted with lower counters is not a negative rate
+    collector.record({ip: sample({"c1": (record.service_id, 10, 0)})}, 103.0)
+    assert collector.query(ip, since=102.0)["nodes"][ip]["rx_rate"] == [0.0]
+    assert set(collector.counters) == {"c1"}
+
+def test_collect_and_forget():
+    costs = {"busy": (1.0, 128 * fake_docker.MB)}
+    (_, swarm_obj, managed_nodes) = fake_docker.create_fake_swarm(2, image_costs=costs)
+    (ip, other) = sorted(managed_nodes)
+    records = [swarm_obj.create_service(ip, REQUEST)[1] for _ in range(2)]
+    collector = telemetry.TelemetryCollector(swarm_obj, history=4)
+    rounds = []
+    collector.subscribe(rounds.append)
+    for _ in range(6):
+        collector.collect()
+    assert len(rounds) == 6 and set(rounds[0]) == {ip, other}
+
+    latest = collector.query()
+    assert set(latest["nodes"]) == {ip, other}
+    assert latest["nodes"][ip]["services"] == 2 and abs(latest["nodes"][ip]["cpu"] - 0.5) < 1e-6
+    assert abs(latest["services"][records[0].service_id]["cpu"] - 0.25) < 1e-6
+    assert len(collector.query(ip)["nodes"][ip]["time"]) == 4
+    assert abs(collector.node_mean(ip, "cpu") - 0.5) < 1e-6
+    assert collector.node_mean("10.9.9.9", "cpu") is None
+
+    # Removed services lose their history
+    swarm_obj.remove_service(ip, records[0].service_id)
+    collector.collect()
+    assert records[0].service_id not in collector.query()["services"]
+    assert collector.service_mean(records[0].service_id, "cpu") is None
+    assert collector.service_mean(records[1].service_id, "cpu") is not None